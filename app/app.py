@@ -1,52 +1,300 @@
 import asyncio
 import logging
 from utils import database
-import os
+import signal
 import tempfile
-from functools import wraps
+from functools import partial, wraps
 from io import BytesIO
 from dotenv import load_dotenv
-from pydub import AudioSegment
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
 from aiogram.utils import executor
 from aiogram.utils import exceptions
 
-from integrations.openai_integration import *
+from integrations.openai_integration import IntegrationOpenAI, ImageResolution, MAX_USER_CONTEXT, RATE_LIMIT_MODELS, UsageType
+from integrations.providers import OpenAIBackend, ProviderRouter
 from utils.config import Config
 from utils.text_to_voice import TextToVoice
+from utils.audio import AudioPipeline, AudioTooLarge
+from utils.response_cache import ResponseCache
+from utils.rate_limit import RateLimiter
+from utils.access import ADMIN, BANNED, USER, AccessControl, parseChatId
+from utils.log import setupLogging
+from utils.tokenizer import getEncoding
+from utils import metrics
+from utils.metrics import timed
 from utils.utils import getHelpReport
 
 from utils import utils
+from app.streaming import TELEGRAM_MAX_MESSAGE, EditRateLimiter, LatencyStats, StreamingReply
+from app.scheduler import ChatScheduler
+from app.webhook import SecretWebhookHandler, UpdateDeduplication, createBot, setWebhook
+from app.router import Router
+from app.voice import VoiceTurn
+
+START_REPLY = "Hello, how can I assist you today?"
+
+# Settings buttons: callback data -> (option, new value from the old one)
+SETTINGS_ACTIONS = {
+    "/setting_inc_temp": ("temperature", lambda value: min(value + 0.1, 1)),
+    "/setting_dec_temp": ("temperature", lambda value: max(value - 0.1, 0)),
+    "/setting_inc_resolution": ("image_resolution", lambda value: ImageResolution.LARGE.value),
+    "/setting_dec_resolution": ("image_resolution", lambda value: ImageResolution.MEDIUM.value),
+    "/setting_en_whisper": ("whisper_to_chat", lambda value: True),
+    "/setting_dis_whisper": ("whisper_to_chat", lambda value: False),
+    "/setting_en_voice": ("assistant_voice_chat", lambda value: True),
+    "/setting_dis_voice": ("assistant_voice_chat", lambda value: False),
+    "/setting_inc_context": ("max-context", lambda value: min(value + 1, MAX_USER_CONTEXT)),
+    "/setting_dec_context": ("max-context", lambda value: max(value - 1, 1)),
+}
 
 class AIBot:
     def __init__(self):
         load_dotenv()
         self.config = Config()
-        self.openai_integration = IntegrationOpenAI(self.config.openai_key)
-        self.textToVoice = TextToVoice(self.config.bot_default_tts_language)
+        setupLogging(self.config.log_level, self.config.log_format)
+        self.responseCache = None
+        if self.config.response_cache:
+            self.responseCache = ResponseCache(self.config.response_cache_size,
+                                               chat_ttl=self.config.response_cache_ttl,
+                                               image_ttl=self.config.response_cache_image_ttl,
+                                               max_temperature=self.config.response_cache_max_temperature)
+        # Transcripts are cached by the digest of the audio so resent media isn't billed again
+        self.transcriptCache = None
+        if self.config.asr_cache:
+            self.transcriptCache = ResponseCache(self.config.asr_cache_size, asr_ttl=self.config.asr_cache_ttl)
+        self.scheduler = ChatScheduler(self.config.scheduler_max_jobs, self.config.scheduler_provider_limits)
+        self.providerRouter = self.buildProviders()
+        self.openai_integration = IntegrationOpenAI(self.config.openai_key,
+                                                    api_base=self.config.openai_api_base,
+                                                    max_concurrency=self.config.openai_max_concurrency,
+                                                    pool_size=self.config.openai_pool_size,
+                                                    request_timeout=self.config.openai_request_timeout,
+                                                    max_retries=self.config.openai_max_retries,
+                                                    retry_backoff=self.config.openai_retry_backoff,
+                                                    context_tokens=self.config.openai_context_tokens,
+                                                    response_tokens=self.config.openai_response_tokens,
+                                                    response_cache=self.responseCache,
+                                                    summary_model=self.config.chat_summary_model if self.config.chat_compaction else None,
+                                                    summary_tokens=self.config.chat_summary_tokens,
+                                                    usage_ledger=database.usage,
+                                                    router=self.providerRouter,
+                                                    transcript_cache=self.transcriptCache,
+                                                    segment_concurrency=self.config.asr_segment_concurrency)
+        self.textToVoice = TextToVoice(self.config.bot_default_tts_language,
+                                       use_gtts=self.config.bot_use_tts,
+                                       workers=self.config.bot_tts_workers,
+                                       cache_bytes=self.config.bot_tts_cache_bytes)
+        self.audioPipeline = AudioPipeline(self.config.audio_max_concurrency,
+                                           self.config.audio_max_download_bytes,
+                                           self.config.asr_max_upload_bytes,
+                                           segment_seconds=self.config.asr_segment_seconds)
 
-        self.bot = Bot(token=self.config.bot_access_token)
+        self.bot = createBot(self.config)
         self.dp = Dispatcher(self.bot)
         self.dp.middleware.setup(LoggingMiddleware())
-        self.allowedUsers = self.config.bot_allowed_users
+        self.dp.middleware.setup(UpdateDeduplication())
+        self.access = AccessControl(self.config.bot_allowed_users, self.config.bot_admins, self.config.access_file)
+        self.accessTask = None
+        # Replies that never change are built once
+        self.helpReport = getHelpReport()
+        self.adminHelpReport = getHelpReport(admin=True)
+        self.settingsMarkup = utils.generateInlineKeyboard()
+        self.router = self.buildRouter()
+        self.editLimiter = EditRateLimiter(self.config.bot_edit_interval)
+        self.timeToFirstToken = LatencyStats()
+        self.statsTask = None
+        self.backgroundTasks = set()
+        # Final Markdown edits of streamed replies, which run off the chat's queue
+        self.finishingReplies = set()
+        # (index, count) of this process among webhook workers; it resumes the journaled jobs of its own chats
+        self.shard = (0, 1)
+        self.metricsPort = self.config.metrics_port
+        self.metricsRunner = None
+        self.rateLimiter = None
+        if self.config.rate_limits or self.config.daily_quotas:
+            self.rateLimiter = RateLimiter(self.config.rate_limits, self.config.daily_quotas)
+        metrics.REGISTRY.addCollector(self.collectMetrics)
 
-        database.init_database()
+        database.init_database(cache_size=self.config.db_cache_size,
+                               flush_interval=self.config.db_flush_interval,
+                               flush_batch=self.config.db_flush_batch)
+        self.access.reload(database.get_access())
 
-        logging.basicConfig(
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            level=logging.INFO
-        )
         self.logger = logging.getLogger(__name__)
-        if (self.config.chat_provider == "openai"):
-            self.currentLLM = self.config.openai_chat_models[0]
+        self.currentLLM = self.config.openai_chat_models[0]
 
-    async def messageHandler(self, message: types.Message):
-        if (not self.checkAccess(message)):
-            await message.reply("Access Denied")
+    def buildProviders(self) -> ProviderRouter:
+        providers = {name: OpenAIBackend(name, settings["api_key"], settings["api_base"],
+                                         max_concurrency=self.config.openai_max_concurrency,
+                                         pool_size=self.config.openai_pool_size,
+                                         request_timeout=self.config.openai_request_timeout,
+                                         max_retries=self.config.openai_max_retries,
+                                         retry_backoff=self.config.openai_retry_backoff,
+                                         asr_model=self.config.asr_model)
+                     for name, settings in self.config.providers.items()}
+        defaults = {"chat": self.config.chat_provider, "image": self.config.tti_provider,
+                    "asr": self.config.asr_provider}
+        for capability, name in defaults.items():
+            if name and name not in providers:
+                raise ValueError(f"Unknown {capability} provider {name!r}, configured providers: {', '.join(providers)}")
+        return ProviderRouter(providers, defaults,
+                              hedge=self.config.provider_hedge,
+                              hedge_min_delay=self.config.provider_hedge_min_delay,
+                              max_error_rate=self.config.provider_max_error_rate,
+                              slot=self.scheduler.providers.slot)
+
+    def availableProviders(self):
+        # Provider names per capability, the configured default first
+        available = {}
+        for capability in ("chat", "image", "asr"):
+            names = self.providerRouter.names(capability)
+            default = self.providerRouter.defaults.get(capability)
+            available[capability] = sorted(names, key=lambda name: name != default)
+        available["tts"] = self.textToVoice.candidates()
+        return available
+
+    # Updates are queued per chat so turns of one conversation never interleave
+    async def onMessage(self, message: types.Message):
+        if not await self.admitted(message):
+            return
+        usageType = UsageType.CHAT if message.chat.type == types.ChatType.PRIVATE else None
+        if (message.is_command()):
+            imagine = message.get_command() == "/imagine"
+            usageType = UsageType.IMAGE if imagine else None
+        if usageType is not None and await self.overLimit(message, usageType):
+            return
+        await self.submitJob(str(message.chat.id), partial(self.messageHandler, message))
+
+    async def onAttachment(self, message: types.Message):
+        if not await self.admitted(message):
+            return
+        if (message.voice or message.video or message.audio) and await self.overLimit(message, UsageType.VOICE):
+            return
+        # With whisper_to_chat a voice note is answered by the chat model too, so it counts against its limits
+        if (message.voice and self.rateLimiter is not None
+                and (await database.getUserData(str(message.chat.id), self.config))["options"]["whisper_to_chat"]
+                and await self.overLimit(message, UsageType.CHAT)):
+            return
+        await self.submitJob(str(message.chat.id), partial(self.handleAttachment, message))
+
+    async def admitted(self, message: types.Message) -> bool:
+        # Checked once before anything is queued, so a chat that is not allowed never reaches
+        # the rate limits, the scheduler or a provider
+        if self.checkAccess(message):
+            return True
+        await message.reply("Access Denied")
+        return False
+
+    async def submitJob(self, chat_id: str, handler):
+        # The update was journaled when it was claimed and its row is deleted when the job
+        # finishes. Once shutdown has begun nothing new starts and the update stays journaled.
+        update_id = types.Update.get_current().update_id
+        database.journal.submit(update_id)
+        if self.scheduler.closed:
+            return
+        await self.scheduler.submit(chat_id, partial(self.runJob, chat_id, update_id, handler))
+
+    async def runJob(self, chat_id: str, update_id: int, handler):
+        database.beginJob(chat_id, update_id)
+        try:
+            await handler()
+        except asyncio.CancelledError:
+            # Cut short by shutdown: what it did since its last checkpoint is dropped and it runs again
+            database.abortJob(chat_id)
+            metrics.JOBS.inc(outcome="cancelled")
+            raise
+        except Exception:
+            # It would fail the same way again, so it is finished with whatever it got done
+            await database.finishJob(chat_id)
+            metrics.JOBS.inc(outcome="failed")
+            raise
+        await database.finishJob(chat_id)
+        metrics.JOBS.inc(outcome="finished")
+
+    async def overLimit(self, message: types.Message, usageType: UsageType) -> bool:
+        # Checked before the job is queued, so a rejected request never waits or reaches OpenAI
+        if self.rateLimiter is None:
+            return False
+        if database.journal.isResumed(types.Update.get_current().update_id):
+            # Counted against the limits when it first arrived
+            return False
+        chat_id = str(message.chat.id)
+        quota = True
+        retryAfter = 0.0
+        if self.rateLimiter.quotas:
+            used = (await database.getDailyUsage(chat_id)).get(usageType.value, 0)
+            retryAfter = self.rateLimiter.quotaRetry(usageType.value, used)
+        if not retryAfter and self.rateLimiter.limits:
+            quota = False
+            if usageType == UsageType.CHAT:
+                model = (await database.getUserData(chat_id, self.config))["options"]["gpt_model"]
+            else:
+                model = RATE_LIMIT_MODELS[usageType]
+            retryAfter = self.rateLimiter.acquire(chat_id, model)
+        if not retryAfter:
+            return False
+        metrics.RATE_LIMITED.inc(kind=usageType.value, reason="quota" if quota else "rate")
+        self.logger.info("Request rate limited", extra={"chat_id": chat_id, "kind": usageType.value,
+                                                        "retry_after": round(retryAfter, 1), "quota": quota})
+        await message.reply(utils.getRateLimitReport(usageType.value, retryAfter, quota))
+        return True
+
+    async def onSettings(self, callback_query: types.CallbackQuery):
+        if not self.checkAccess(callback_query.message):
+            await callback_query.answer("Access Denied")
             return
+        await self.submitJob(str(callback_query.message.chat.id), partial(self.settingsCallback, callback_query))
+
+    async def reloadAccess(self):
+        self.access.reload(await database.run(database.get_access))
+
+    async def watchAccess(self):
+        # Picks up changes to the access file and to the access table made by other workers
+        while True:
+            await asyncio.sleep(self.config.access_reload_interval)
+            try:
+                await self.reloadAccess()
+            except Exception as e:
+                self.logger.error("Failed to reload the access list", extra={"error": str(e)})
+
+    async def logSchedulerStats(self):
+        while True:
+            await asyncio.sleep(self.config.scheduler_stats_interval)
+            self.logger.info("Scheduler stats", extra=self.scheduler.stats())
+
+    def collectMetrics(self):
+        scheduler = self.scheduler.stats()
+        metrics.QUEUE_DEPTH.set(scheduler["running"], queue="scheduler_running")
+        metrics.QUEUE_DEPTH.set(scheduler["queued"], queue="scheduler_queued")
+        metrics.QUEUE_DEPTH.set(scheduler["waiting_chats"], queue="scheduler_waiting_chats")
+        metrics.QUEUE_DEPTH.set(len(database.cache.dirty), queue="db_dirty_users")
+        metrics.QUEUE_DEPTH.set(database.journal.stats()["active"], queue="journal_active")
+        metrics.QUEUE_DEPTH.set(len(self.textToVoice.inflight), queue="tts_inflight")
+        if self.rateLimiter is not None:
+            metrics.QUEUE_DEPTH.set(len(self.rateLimiter.buckets), queue="rate_limit_buckets")
+        caches = [("users", database.cache.hits, database.cache.hits + database.cache.misses),
+                  ("tts", self.textToVoice.cache.hits, self.textToVoice.cache.hits + self.textToVoice.cache.misses)]
+        if self.responseCache is not None:
+            stats = self.responseCache.stats()
+            caches.append(("responses", stats["hits"], stats["lookups"]))
+        for (name, capability), stats in list(self.providerRouter.stats.items()):
+            p95 = stats.p95()
+            if p95 is not None:
+                metrics.PROVIDER_P95.set(p95, provider=name, capability=capability)
+            metrics.PROVIDER_ERROR_RATE.set(stats.errorRate(), provider=name, capability=capability)
+        if self.transcriptCache is not None:
+            stats = self.transcriptCache.stats()
+            caches.append(("transcripts", stats["hits"], stats["lookups"]))
+        for name, hits, lookups in caches:
+            metrics.CACHE_HITS.set(hits, cache=name)
+            metrics.CACHE_LOOKUPS.set(lookups, cache=name)
+
+    @timed("handle_message")
+    async def messageHandler(self, message: types.Message):
         if (message.is_command()):
             await self.handleCommand(message)
         elif (message.chat.type == types.ChatType.PRIVATE and not message.text.startswith("/")):
@@ -55,15 +303,16 @@ class AIBot:
             
             user_prompt = message.text
             await self.bot.send_chat_action(chat_id, action=types.ChatActions.TYPING)
-            assistant_message, user_data = await self.messageLLM(user_prompt, chat_id, message.from_user.full_name, user_data)
-            
-            await message.reply(assistant_message, parse_mode=ParseMode.MARKDOWN)
-            
+            if self.config.chat_streaming:
+                assistant_message, user_data = await self.messageLLMStream(user_prompt, chat_id, message, user_data)
+            else:
+                assistant_message, user_data = await self.messageLLM(user_prompt, chat_id, message.from_user.full_name, user_data)
+                await message.reply(assistant_message, parse_mode=ParseMode.MARKDOWN)
+
             if user_data["options"]["assistant_voice_chat"]:
-                await self.bot.send_chat_action(chat_id, action=types.ChatActions.TYPING)
-                voice_data = await self.textToVoice.textToVoice(assistant_message)
-                await message.reply_voice(voice_data)
+                await self.replyVoice(message, assistant_message, user_data)
 
+    @timed("handle_attachment")
     async def handleAttachment(self, message: types.Message):
         chat_id = message.chat.id
         user_data = await database.getUserData(chat_id, self.config)
@@ -87,136 +336,383 @@ class AIBot:
             await message.reply("Can't handle such file. Reason: unknown.")
             return
 
-        file = await self.bot.get_file(file_id)
-        user_id = message.chat.id
-        await file.download(f"{user_id}.{file_format}")
-        
-        if file_format == "ogg":
-            ogg_audio = AudioSegment.from_file(f"{user_id}.ogg", format="ogg")
-            ogg_audio.export(f"{user_id}.mp3", format="mp3")
-            os.remove(f"{user_id}.ogg")
-            file_format = "mp3"
+        restored = database.journal.restored(str(chat_id))
+        if restored is not None and restored[0] == "transcribed":
+            # Resumed after a restart: the transcript was saved, and billed, before it
+            transcript['text'] = restored[1]["text"]
+        else:
+            try:
+                segments = await self.audioPipeline.loadSegments(self.bot, file_id, file_format, duration)
+            except AudioTooLarge as e:
+                await message.reply(str(e))
+                return
+            except Exception as e:
+                self.logger.error("Audio conversion failed", extra={"chat_id": chat_id, "error": str(e)})
+                await message.reply("Can't handle such file. Reason: conversion failed.")
+                return
 
-        with open(f"{user_id}.{file_format}", "rb") as audio_file:
             await self.bot.send_chat_action(chat_id, action=types.ChatActions.TYPING)
-            transcript = self.openai_integration.transcribeAudio(user_data, audio_file, duration)
+            transcript = await self.openai_integration.transcribeSegments(user_data, segments,
+                                                                          await self.transcriptionProgress(message, segments))
 
-        os.remove(f"{user_id}.{file_format}")
+            if transcript['text'] == "":
+                transcript['text'] = "[Silence]"
+            await database.checkpointJob(chat_id, user_data, "transcribed", {"text": transcript['text']})
 
-        if transcript['text'] == "":
-            transcript['text'] = "[Silence]"
+        if (audioMessage and user_data["options"]["whisper_to_chat"] and user_data["options"]["assistant_voice_chat"]
+                and self.config.voice_pipeline):
+            # The transcript goes out right away and the answer is spoken while it is written
+            quoted = "> " + transcript['text']
+            for start in range(0, len(quoted), TELEGRAM_MAX_MESSAGE):
+                await message.reply(quoted[start:start + TELEGRAM_MAX_MESSAGE])
+            await self.messageVoiceTurn(transcript['text'], str(chat_id), message, user_data)
+            return
 
         chatGPT_response = False
         if audioMessage and user_data["options"]["whisper_to_chat"]:
             chatGPT_response, user_data = await self.messageLLM(transcript['text'], str(chat_id), message.from_user.full_name, user_data)
             transcript['text'] = "> " + transcript['text'] + "\n\n" + chatGPT_response
         
-        await message.reply(transcript['text'])
+        # Transcripts of long media can run past one message
+        for start in range(0, len(transcript['text']), TELEGRAM_MAX_MESSAGE):
+            await message.reply(transcript['text'][start:start + TELEGRAM_MAX_MESSAGE])
         if user_data["options"]["assistant_voice_chat"] and chatGPT_response:
-                await self.bot.send_chat_action(chat_id, action=types.ChatActions.TYPING)
-                voice_data = await self.textToVoice.textToVoice(chatGPT_response)
-                await message.reply_voice(voice_data)
+            await self.replyVoice(message, chatGPT_response, user_data)
         
-        database.update_user(str(chat_id), user_data)
+        await database.saveUserData(str(chat_id), user_data)
+
+
+    async def transcriptionProgress(self, message: types.Message, segments):
+        # Long media gets a status message that is edited as segments finish, within the edit rate limit
+        if len(segments) < 2:
+            return None
+        status = await message.reply(f"Transcribing {len(segments)} parts...")
 
+        async def progress(done, total):
+            if done < total and not self.editLimiter.ready(message.chat.id):
+                return
+            try:
+                await status.edit_text(f"Transcribed {done} of {total} parts." if done == total
+                                       else f"Transcribing... {done} of {total} parts done.")
+            except exceptions.TelegramAPIError as e:
+                self.logger.debug("Progress edit skipped", extra={"chat_id": message.chat.id, "error": str(e)})
+        return progress
+
+    @timed("voice_reply")
+    async def replyVoice(self, message: types.Message, text: str, user_data=None):
+        # Long answers arrive as several voice notes, the first one as soon as it is synthesized
+        await self.bot.send_chat_action(message.chat.id, action=types.ChatActions.RECORD_VOICE)
+        preferred = user_data["options"].get("providers", {}).get("tts") if user_data else None
+        async for voice_data in self.textToVoice.textToVoiceChunks(text, preferred):
+            await message.reply_voice(voice_data)
 
     async def messageLLM(self, text: str, chat_id: str, user_name="User", user_data={}):
         await self.bot.send_chat_action(chat_id, action=types.ChatActions.TYPING)
-        if (self.config.chat_provider == "openai"):
-            assistant_message = self.openai_integration.gptCompletion(text, self.config.chat_default_system_prompt,
-                                                                      user_name, user_data["options"]["gpt_model"], user_data)
-        database.update_user(chat_id, user_data)
+        assistant_message = await self.openai_integration.gptCompletion(text, self.config.chat_default_system_prompt,
+                                                                        user_name, user_data["options"]["gpt_model"], user_data)
+        await database.saveUserData(chat_id, user_data)
+        self.scheduleCompaction(chat_id, user_data)
         return assistant_message, user_data
 
 
+    async def messageLLMStream(self, text: str, chat_id: str, message: types.Message, user_data={}):
+        await self.bot.send_chat_action(chat_id, action=types.ChatActions.TYPING)
+        reply = StreamingReply(message, self.editLimiter, defer=self.finishReply)
+        chunks = self.openai_integration.gptCompletionStream(text, self.config.chat_default_system_prompt,
+                                                             message.from_user.full_name, user_data["options"]["gpt_model"], user_data)
+        assistant_message = await reply.stream(chunks)
+        if reply.time_to_first_token is not None:
+            self.timeToFirstToken.add(reply.time_to_first_token)
+            metrics.STAGE_SECONDS.observe(reply.time_to_first_token, stage="llm_first_token")
+            self.logger.info("Time to first token", extra={"seconds": round(reply.time_to_first_token, 3),
+                                                           "p50": round(self.timeToFirstToken.percentile(0.5), 3),
+                                                           "p95": round(self.timeToFirstToken.percentile(0.95), 3)})
+        await database.saveUserData(chat_id, user_data)
+        self.scheduleCompaction(chat_id, user_data)
+        return assistant_message, user_data
+
+    @timed("voice_turn")
+    async def messageVoiceTurn(self, text: str, chat_id: str, message: types.Message, user_data):
+        await self.bot.send_chat_action(chat_id, action=types.ChatActions.TYPING)
+        turn = VoiceTurn(message, self.editLimiter, self.textToVoice,
+                         preferred=user_data["options"]["providers"].get("tts"),
+                         buffer=self.config.voice_pipeline_buffer, defer=self.finishReply)
+        chunks = self.openai_integration.gptCompletionStream(text, self.config.chat_default_system_prompt,
+                                                             message.from_user.full_name, user_data["options"]["gpt_model"], user_data)
+        assistant_message = await turn.run(chunks)
+        self.logger.info("Voice turn", extra={"chat_id": chat_id, "voice_notes": turn.voice_notes,
+                                              **{name: round(seconds, 3) for name, seconds in turn.timings.items()}})
+        await database.saveUserData(chat_id, user_data)
+        self.scheduleCompaction(chat_id, user_data)
+        return assistant_message, user_data
+
+    def finishReply(self, finishing):
+        # The last edit waits out the chat's edit interval; the job is done before it is
+        task = asyncio.get_running_loop().create_task(self.awaitReply(finishing))
+        self.finishingReplies.add(task)
+        task.add_done_callback(self.finishingReplies.discard)
+
+    async def awaitReply(self, finishing):
+        try:
+            await finishing
+        except Exception as e:
+            self.logger.error("Failed to finish a streamed reply", extra={"error": str(e)})
+
+    def scheduleCompaction(self, chat_id, user_data):
+        # Summarizing runs after the reply is out, off the chat's queue
+        if self.openai_integration.needsCompaction(user_data):
+            user_data["history"]["compacting"] = True
+            task = asyncio.get_running_loop().create_task(self.compactContext(chat_id, user_data))
+            self.backgroundTasks.add(task)
+            task.add_done_callback(self.backgroundTasks.discard)
+
+    async def compactContext(self, chat_id, user_data):
+        if await self.openai_integration.compactContext(user_data):
+            await database.saveUserData(chat_id, user_data)
+
+    def buildRouter(self) -> Router:
+        router = Router()
+        router.command("/start", self.commandStart, needs_user=False)
+        router.command("/help", self.commandHelp, needs_user=False)
+        router.command("/settings", self.commandSettings, needs_user=False)
+        router.command("/clear", self.commandClear)
+        router.command("/switch", self.commandSwitch)
+        router.command("/config", self.commandConfig)
+        router.command("/imagine", self.commandImagine)
+        router.command("/usage", self.commandUsage)
+        router.command("/provider", self.commandProvider)
+        for command in ("/users", "/adduser", "/ban", "/removeuser"):
+            router.command(command, self.handleAdminCommand, needs_user=False, admin=True)
+        for action, (option, change) in SETTINGS_ACTIONS.items():
+            router.callback(action, partial(self.changeSetting, option, change))
+        return router
+
+    @timed("handle_command")
     async def handleCommand(self, message: types.Message):
+        route = self.router.commands.get(message.get_command())
+        if route is None or (route.admin and not self.access.isAdmin(message.chat.id)):
+            return
+        user_data = await database.getUserData(str(message.chat.id), self.config) if route.needs_user else None
+        await route.handler(message, user_data)
+
+    async def commandStart(self, message: types.Message, user_data):
+        await message.reply(START_REPLY)
+
+    async def commandHelp(self, message: types.Message, user_data):
+        await message.reply(self.adminHelpReport if self.access.isAdmin(message.chat.id) else self.helpReport)
+
+    async def commandSettings(self, message: types.Message, user_data):
+        await message.reply(text='Settings:', reply_markup=self.settingsMarkup)
+
+    async def commandClear(self, message: types.Message, user_data):
         chat_id = str(message.chat.id)
-        user_data = await database.getUserData(chat_id, self.config)
-        if (message.get_command() == "/start"):
-            await message.reply("Hello, how can I assist you today?")
-        elif (message.get_command() == "/clear"):
-            if user_data:
-                database.clearUserContext(chat_id, user_data)
-                print(f"Cleared context for {message.from_user.full_name}")
-            await message.reply("Your message context history was cleared.")
-        elif (message.get_command() == "/switch"):
-            if (self.config.chat_provider == "openai"):
-                if (user_data["options"]["gpt_model"] == self.config.openai_chat_models[0]):
-                    user_data["options"]["gpt_model"] = self.config.openai_chat_models[1]
-                elif (user_data["options"]["gpt_model"] == self.config.openai_chat_models[1]):
-                    user_data["options"]["gpt_model"] = self.config.openai_chat_models[0]
-            model = user_data["options"]["gpt_model"]
-            await message.reply(f"Switched model to {model}")
-            database.update_user(chat_id, user_data)
-            print(f"Using {model}:")
-            database.update_user(chat_id, user_data)
-        elif (message.get_command() == "/config"):
-            status = utils.getSettingsReport(user_data["options"])
-            await message.reply(status)
-        elif (message.get_command() == "/settings"):
-            self.settingsMarkup = utils.generateInlineKeyboard(chat_id)
-            await message.reply(text='Settings:', reply_markup=self.settingsMarkup)
-        elif (message.get_command() == "/imagine"):
-            await self.bot.send_chat_action(message.chat.id, action=types.ChatActions.TYPING)
-            resolution = user_data["options"]["image_resolution"]
-            url = self.openai_integration.generateImage(user_data, message.text, ImageResolution(resolution))
-            database.update_user(str(message.chat.id), user_data)
-            await message.reply(url)
-        elif (message.get_command() == "/usage"):
-            usage = utils.getUsageReport(user_data)
-            await message.reply(usage)
-        elif (message.get_command() == "/help"):
-            help_msg = getHelpReport()
-            await message.reply(help_msg)
+        if user_data:
+            await database.clearUserContext(chat_id, user_data)
+            self.logger.info("Cleared context", extra={"chat_id": chat_id})
+        await message.reply("Your message context history was cleared.")
+
+    async def commandSwitch(self, message: types.Message, user_data):
+        chat_id = str(message.chat.id)
+        if (user_data["options"]["gpt_model"] == self.config.openai_chat_models[0]):
+            user_data["options"]["gpt_model"] = self.config.openai_chat_models[1]
+        elif (user_data["options"]["gpt_model"] == self.config.openai_chat_models[1]):
+            user_data["options"]["gpt_model"] = self.config.openai_chat_models[0]
+        model = user_data["options"]["gpt_model"]
+        await message.reply(f"Switched model to {model}")
+        await database.saveUserData(chat_id, user_data)
+        self.logger.info("Switched model", extra={"chat_id": chat_id, "model": model})
 
+    async def commandConfig(self, message: types.Message, user_data):
+        await message.reply(utils.getSettingsReport(user_data["options"]))
+
+    async def commandImagine(self, message: types.Message, user_data):
+        await self.bot.send_chat_action(message.chat.id, action=types.ChatActions.TYPING)
+        resolution = user_data["options"]["image_resolution"]
+        url = await self.openai_integration.generateImage(user_data, message.text, ImageResolution(resolution))
+        await database.saveUserData(str(message.chat.id), user_data)
+        await message.reply(url)
+
+    async def commandUsage(self, message: types.Message, user_data):
+        if message.get_args().strip() == "all" and self.access.isAdmin(message.chat.id):
+            usage = utils.getTotalUsageReport(await database.getUsageReport())
+        else:
+            ledger = await database.getUsageReport(str(message.chat.id))
+            usage = utils.getUsageReport(user_data, self.responseCache.stats() if self.responseCache else None, ledger)
+        await message.reply(usage)
+
+    async def commandProvider(self, message: types.Message, user_data):
+        # /provider lists the choices, /provider <capability> <name> picks one, "default" goes back to the default
+        available = self.availableProviders()
+        choices = user_data["options"]["providers"]
+        args = message.get_args().split()
+        if len(args) == 2 and args[0] in available and (args[1] in available[args[0]] or args[1] == "default"):
+            capability, name = args
+            if name == "default":
+                choices.pop(capability, None)
+            else:
+                choices[capability] = name
+            await database.saveUserData(str(message.chat.id), user_data)
+            self.logger.info("Switched provider", extra={"chat_id": message.chat.id, "capability": capability,
+                                                         "provider": name})
+        elif args:
+            await message.reply(f"Usage: /provider [{'|'.join(available)}] [name|default]")
+            return
+        latencies = {key: stats.p95() for key, stats in self.providerRouter.stats.items()}
+        await message.reply(utils.getProviderReport(choices, available, latencies))
+
+    async def handleAdminCommand(self, message: types.Message, user_data=None):
+        command = message.get_command()
+        args = message.get_args().split()
+        if command == "/users":
+            await message.reply(utils.getAccessReport(self.access))
+            return
+        target = parseChatId(args[0]) if args else None
+        role = args[1].lower() if command == "/adduser" and len(args) > 1 else USER
+        if target is None or role not in (ADMIN, USER):
+            await message.reply(f"Usage: {command} <chat_id>" + (" [admin|user]" if command == "/adduser" else ""))
+            return
+        if command == "/adduser":
+            await database.run(database.set_access, target, role)
+        elif command == "/ban":
+            await database.run(database.set_access, target, BANNED)
+        else:
+            await database.run(database.delete_access, target)
+        await self.reloadAccess()
+        self.logger.info("Access changed", extra={"chat_id": message.chat.id, "command": command, "target": target})
+        current = self.access.role(target) or (USER if self.access.open else "no access")
+        await message.reply(f"{target}: {current}")
+
+    @timed("handle_settings")
     async def settingsCallback(self, callback_query: types.CallbackQuery):
-        user_data = await database.getUserData(callback_query.message.chat.id, self.config)
-        chat_id = callback_query.message.chat.id
-        action = callback_query.data
-        options = user_data["options"]
+        route = self.router.callbacks.get(callback_query.data)
+        if route is None:
+            await callback_query.answer()
+            return
+        user_data = None
+        if route.needs_user:
+            user_data = await database.getUserData(str(callback_query.message.chat.id), self.config)
+        await route.handler(callback_query, user_data)
 
-        if action.startswith("/setting_inc_temp"):
-           options["temperature"] = min(options["temperature"] + 0.1, 1)
-        elif action.startswith("/setting_dec_temp"):
-            options["temperature"] = max(options["temperature"] - 0.1, 0)
-        elif action.startswith("/setting_inc_resolution"):
-            options["image_resolution"] = ImageResolution.LARGE.value
-        elif action.startswith("/setting_dec_resolution"):
-            options["image_resolution"] = ImageResolution.MEDIUM.value
-        elif action.startswith("/setting_en_whisper"):
-            options["whisper_to_chat"] = True
-        elif action.startswith("/setting_dis_whisper"):
-            options["whisper_to_chat"] = False
-        elif action.startswith("/setting_en_voice"):
-            options["assistant_voice_chat"] = True
-        elif action.startswith("/setting_dis_voice"):
-            options["assistant_voice_chat"] = False
-        elif action.startswith("/setting_inc_context"):
-            options["max-context"] = min(options["max-context"] + 1, MAX_USER_CONTEXT)
-        elif action.startswith("/setting_dec_context"):
-            options["max-context"] = max(options["max-context"] - 1, 1)
-
-        database.update_user(chat_id, user_data)
+    async def changeSetting(self, option, change, callback_query: types.CallbackQuery, user_data):
+        options = user_data["options"]
+        options[option] = change(options[option])
+        await database.saveUserData(str(callback_query.message.chat.id), user_data)
         await callback_query.answer()
-        settings_text = utils.getSettingsReport(user_data["options"])
+        settings_text = utils.getSettingsReport(options)
         await callback_query.message.reply(text=settings_text)
 
     def checkAccess(self, message: types.Message):
-        user_id = str(message.chat.id)
-        if user_id not in self.allowedUsers:
-            if "*" != self.allowedUsers[0]:
-                print(f"Unauthorized access denied for {user_id}.")
-                return False
-        print("Access Granted")
-        return True
+        if self.access.isAllowed(message.chat.id):
+            return True
+        metrics.ACCESS_DENIED.inc()
+        self.logger.warning("Unauthorized access denied", extra={"chat_id": message.chat.id})
+        return False
+
+    async def onStartup(self, dp: Dispatcher):
+        database.startFlusher()
+        # Loading the tokenizer may download its BPE file, which would block the event loop
+        # if it happened with the first count
+        asyncio.get_running_loop().run_in_executor(None, getEncoding, self.config.chatgpt_default_model)
+        if self.rateLimiter is not None and self.config.rate_limit_persist:
+            self.rateLimiter.restore(await database.run(database.load_rate_limits))
+        if self.config.access_reload_interval > 0:
+            self.accessTask = asyncio.get_running_loop().create_task(self.watchAccess())
+        if self.config.scheduler_stats_interval > 0:
+            self.statsTask = asyncio.get_running_loop().create_task(self.logSchedulerStats())
+        if self.metricsPort:
+            self.metricsRunner = await metrics.startServer(self.config.metrics_host, self.metricsPort)
+            self.logger.info("Serving metrics", extra={"host": self.config.metrics_host, "port": self.metricsPort})
+        await self.resumeJobs()
+
+    async def resumeJobs(self):
+        # Updates journaled by the previous run that never finished are handled again, oldest
+        # first so each chat keeps its order, ahead of anything new
+        jobs, expired = await database.run(database.take_unfinished_jobs, *self.shard)
+        if expired:
+            metrics.JOBS.inc(expired, outcome="expired")
+            self.logger.warning("Gave up on journaled updates", extra={"updates": expired})
+        if not jobs:
+            return
+        self.logger.info("Resuming journaled updates", extra={"updates": len(jobs)})
+        for update_id, payload, stage, checkpoint in jobs:
+            database.journal.resume(update_id, stage, checkpoint)
+            task = asyncio.get_running_loop().create_task(self.resumeUpdate(types.Update.to_object(payload)))
+            self.backgroundTasks.add(task)
+            task.add_done_callback(self.backgroundTasks.discard)
+        metrics.JOBS.inc(len(jobs), outcome="resumed")
+
+    async def resumeUpdate(self, update: types.Update):
+        # Straight to the handlers: the update was claimed, and journaled, the first time
+        try:
+            await self.dp.process_update(update)
+        except Exception as e:
+            self.logger.error("Resumed update failed", extra={"update_id": update.update_id, "error": str(e)})
+        finally:
+            await database.settleUpdate(update.update_id)
+
+    async def onPollingStartup(self, dp: Dispatcher):
+        # docker stop sends SIGTERM; stopping the loop shuts down through onShutdown like Ctrl+C does
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+    async def onShutdown(self, dp: Dispatcher):
+        # Running jobs get SHUTDOWN_TIMEOUT seconds to finish; queued and cut-short ones stay
+        # journaled and are resumed on the next start
+        dp.stop_polling()
+        finished, cancelled = await self.scheduler.drain(self.config.shutdown_timeout)
+        if self.finishingReplies:
+            await asyncio.wait(list(self.finishingReplies), timeout=self.config.bot_edit_interval + 5)
+        self.logger.info("Drained jobs", extra={"finished": finished, "cancelled": cancelled,
+                                                "queued": self.scheduler.queued})
+        if self.statsTask is not None:
+            self.statsTask.cancel()
+        if self.accessTask is not None:
+            self.accessTask.cancel()
+        if self.metricsRunner is not None:
+            await self.metricsRunner.cleanup()
+        # Unfinished summaries are dropped; their turns are still in the context and the database.
+        # Resumed updates still waiting in the queue keep their journal rows.
+        for task in list(self.backgroundTasks):
+            task.cancel()
+        await self.openai_integration.close()
+        self.textToVoice.close()
+        if self.rateLimiter is not None and self.config.rate_limit_persist:
+            await database.run(database.save_rate_limits, self.rateLimiter.snapshot(), self.rateLimiter.window())
+        await database.shutdown()
+
+    def registerHandlers(self):
+        self.logger.info("Starting bot", extra={"allowed_users": "*" if self.access.open else len(self.access.allowed),
+                                                "system_prompt": self.config.chat_default_system_prompt,
+                                                "tts": self.config.bot_use_tts, "model": self.currentLLM})
+        self.dp.register_message_handler(self.onMessage)
+        self.dp.register_message_handler(self.onAttachment, content_types=['photo', 'video', 'audio', 'voice'])
+        self.dp.register_callback_query_handler(self.onSettings, lambda c: c.data.startswith('/setting_'))
 
     def run(self):
-        print(f"Allowed users: {self.allowedUsers}")
-        print(f"System prompt: {self.config.chat_default_system_prompt}")
-        print(f"TTS: {self.config.bot_use_tts}")
-        print(f"Using " + self.currentLLM)
-        self.dp.register_message_handler(self.messageHandler)
-        self.dp.register_message_handler(self.handleAttachment, content_types=['photo', 'video', 'audio', 'voice'])
-        self.dp.register_callback_query_handler(self.settingsCallback, lambda c: c.data.startswith('/setting_'))
-
-        executor.start_polling(self.dp, skip_updates=True)
+        if self.config.bot_mode == "webhook":
+            self.runWebhook(self.config.webhook_host, self.config.webhook_port)
+            return
+        self.registerHandlers()
+        # Updates sent while the bot was down are handled rather than skipped; claims and the
+        # journal keep an update from being handled twice
+        pollingExecutor = executor.Executor(self.dp, skip_updates=False)
+        pollingExecutor.on_startup(self.onStartup, webhook=False)
+        pollingExecutor.on_startup(self.onPollingStartup, webhook=False)
+        pollingExecutor.on_shutdown(self.onShutdown, webhook=False)
+        pollingExecutor.start_polling()
+
+    def runWebhook(self, host, port, setWebhook=True):
+        self.registerHandlers()
+        webhookExecutor = executor.Executor(self.dp, skip_updates=False)
+        webhookExecutor.on_startup(self.onStartup, polling=False)
+        if setWebhook:
+            webhookExecutor.on_startup(self.onWebhookStartup, polling=False)
+        webhookExecutor.on_shutdown(self.onShutdown, polling=False)
+        web_app = web.Application()
+        web_app["WEBHOOK_SECRET"] = self.config.webhook_secret
+        webhookExecutor.set_webhook(webhook_path=self.config.webhook_path, request_handler=SecretWebhookHandler,
+                                    web_app=web_app)
+        webhookExecutor.run_app(host=host, port=port)
+
+    async def onWebhookStartup(self, dp: Dispatcher):
+        await setWebhook(self.config, self.bot)
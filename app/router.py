@@ -0,0 +1,22 @@
+class Route:
+    __slots__ = ("handler", "needs_user", "admin")
+
+    def __init__(self, handler, needs_user=True, admin=False):
+        self.handler = handler
+        self.needs_user = needs_user
+        self.admin = admin
+
+class Router:
+    # Commands and callback data mapped straight to their handlers. A route says whether its
+    # handler needs the user record, so commands with fixed replies never touch the database,
+    # and whether only admins may use it. Handlers are called as handler(event, user_data),
+    # with user_data None for routes that don't need it.
+    def __init__(self):
+        self.commands = {}
+        self.callbacks = {}
+
+    def command(self, name: str, handler, needs_user=True, admin=False):
+        self.commands[name] = Route(handler, needs_user, admin)
+
+    def callback(self, data: str, handler, needs_user=True):
+        self.callbacks[data] = Route(handler, needs_user)
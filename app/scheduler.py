@@ -0,0 +1,125 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from app.streaming import LatencyStats
+
+class Job:
+    def __init__(self, factory, future):
+        self.factory = factory
+        self.future = future
+        self.enqueued = time.monotonic()
+
+class ProviderSlots:
+    # Caps in-flight requests per provider. A slot is held for the provider call only, not the
+    # job around it, so Telegram edits, speech synthesis and uploads never hold one.
+    def __init__(self, limits=None):
+        self.semaphores = {name: asyncio.Semaphore(limit) for name, limit in (limits or {}).items()}
+        self.running = {}
+        self.waiting = {}
+        self.waits = LatencyStats()
+
+    @asynccontextmanager
+    async def slot(self, provider):
+        semaphore = self.semaphores.get(provider)
+        if semaphore is None:
+            yield
+            return
+        start = time.monotonic()
+        self.waiting[provider] = self.waiting.get(provider, 0) + 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting[provider] -= 1
+        self.waits.add(time.monotonic() - start)
+        self.running[provider] = self.running.get(provider, 0) + 1
+        try:
+            yield
+        finally:
+            self.running[provider] -= 1
+            semaphore.release()
+
+class ChatScheduler:
+    # Runs work for one chat strictly in order while different chats run in parallel.
+    # Chats with queued work wait in a round-robin ring, so a chat with a long backlog gets
+    # one job at a time and then goes to the back, behind everyone else who is waiting.
+    # Provider limits are enforced by the provider router around each call, through `providers`.
+    def __init__(self, max_jobs=32, provider_limits=None):
+        self.max_jobs = max_jobs
+        self.providers = ProviderSlots(provider_limits)
+        self.queues = {}
+        self.ready = deque()
+        self.running = 0
+        self.queued = 0
+        self.tasks = set()
+        self.waits = LatencyStats()
+        self.closed = False
+
+    async def submit(self, chat_id, factory):
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+            self.ready.append(chat_id)
+        queue.append(Job(factory, future))
+        self.queued += 1
+        self.dispatch()
+        return await future
+
+    def dispatch(self):
+        # Start waiting chats, in turn, while there is room under the global limit
+        while not self.closed and self.running < self.max_jobs and self.ready:
+            chat_id = self.ready.popleft()
+            job = self.queues[chat_id].popleft()
+            self.queued -= 1
+            self.running += 1
+            task = asyncio.get_running_loop().create_task(self.run(chat_id, job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, chat_id, job: Job):
+        self.waits.add(time.monotonic() - job.enqueued)
+        try:
+            result = await job.factory()
+            if not job.future.done():
+                job.future.set_result(result)
+        except BaseException as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            self.running -= 1
+            if self.queues[chat_id]:
+                self.ready.append(chat_id)
+            else:
+                del self.queues[chat_id]
+            self.dispatch()
+
+    async def drain(self, timeout: float):
+        # Starts nothing new and waits up to timeout for the running jobs; the ones still going
+        # are cancelled. Queued jobs never start, their submitters keep waiting. Returns the
+        # number of jobs that finished and that were cancelled.
+        self.closed = True
+        running = set(self.tasks)
+        if not running:
+            return 0, 0
+        done, pending = await asyncio.wait(running, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        return len(done), len(pending)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "waiting_chats": len(self.ready),
+            "max_chat_queue": max((len(queue) for queue in self.queues.values()), default=0),
+            "providers": dict(self.providers.running),
+            "provider_waiting": dict(self.providers.waiting),
+            "provider_wait_p95": self.providers.waits.percentile(0.95),
+            "wait_p50": self.waits.percentile(0.5),
+            "wait_p95": self.waits.percentile(0.95),
+        }
@@ -0,0 +1,146 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import aclosing
+
+from aiogram import types
+from aiogram.types import ParseMode
+from aiogram.utils import exceptions
+
+TELEGRAM_MAX_MESSAGE = 4096
+# Characters that can make the Markdown edit render differently from the plain text shown
+MARKDOWN_MARKS = frozenset("*_`[")
+
+class EditRateLimiter:
+    # Telegram throttles edits per chat (roughly one per second); slots are shared by
+    # every reply streaming into the same chat.
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.next_edit = {}
+
+    def ready(self, chat_id) -> bool:
+        now = time.monotonic()
+        if now < self.next_edit.get(chat_id, 0):
+            return False
+        self.next_edit[chat_id] = now + self.interval
+        if len(self.next_edit) > 10000:
+            self.next_edit = {chat: at for chat, at in self.next_edit.items() if at > now}
+        return True
+
+    async def wait(self, chat_id):
+        delay = self.next_edit.get(chat_id, 0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.next_edit[chat_id] = time.monotonic() + self.interval
+
+    def backoff(self, chat_id, seconds):
+        self.next_edit[chat_id] = time.monotonic() + seconds
+
+class LatencyStats:
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+class StreamingReply:
+    # Replies with the first tokens as soon as they arrive and keeps editing that message.
+    # Tokens arriving while an edit is in flight or rate limited are coalesced into the next edit.
+    # With `defer` the last edit of each message is handed over instead of awaited, so the caller
+    # doesn't sit out the edit interval for it.
+    def __init__(self, message: types.Message, limiter: EditRateLimiter, defer=None):
+        self.message = message
+        self.limiter = limiter
+        self.defer = defer
+        self.chat_id = message.chat.id
+        self.sent = None
+        self.shown = ""
+        self.time_to_first_token = None
+
+    async def stream(self, chunks) -> str:
+        start = time.monotonic()
+        parts = []
+        # Deltas of the message being written, joined only when it is sent or edited
+        current = []
+        length = 0
+        visible = False
+        async with aclosing(chunks):
+            async for delta in chunks:
+                parts.append(delta)
+                current.append(delta)
+                length += len(delta)
+                visible = visible or bool(delta.strip())
+                # One delta can hold several messages' worth, e.g. a cached answer
+                while length > TELEGRAM_MAX_MESSAGE:
+                    text = "".join(current)
+                    cut = text.rfind("\n", 0, TELEGRAM_MAX_MESSAGE)
+                    if cut <= 0:
+                        cut = TELEGRAM_MAX_MESSAGE
+                    if self.sent is not None:
+                        await self.complete(text[:cut])
+                    else:
+                        await self.message.reply(text[:cut])
+                    self.sent = None
+                    current = [text[cut:]]
+                    length = len(current[0])
+                    visible = bool(current[0].strip())
+                if self.sent is None:
+                    if visible:
+                        text = "".join(current)
+                        self.sent = await self.message.reply(text)
+                        self.shown = text
+                        self.limiter.ready(self.chat_id)
+                        if self.time_to_first_token is None:
+                            self.time_to_first_token = time.monotonic() - start
+                elif self.limiter.ready(self.chat_id):
+                    await self.edit("".join(current))
+        full = "".join(parts)
+        text = "".join(current)
+        if self.sent is not None:
+            await self.complete(text)
+        elif text.strip():
+            try:
+                self.sent = await self.message.reply(text, parse_mode=ParseMode.MARKDOWN)
+            except exceptions.CantParseEntities:
+                self.sent = await self.message.reply(text)
+        return full
+
+    async def edit(self, text, parse_mode=None, sent=None) -> bool:
+        try:
+            await (sent or self.sent).edit_text(text, parse_mode=parse_mode)
+            if sent is None:
+                self.shown = text
+        except exceptions.MessageNotModified:
+            pass
+        except exceptions.RetryAfter as e:
+            self.limiter.backoff(self.chat_id, e.timeout)
+            return False
+        return True
+
+    async def complete(self, text):
+        if text == self.shown and MARKDOWN_MARKS.isdisjoint(text):
+            # Already on screen and Markdown would not change it
+            return
+        if self.defer is not None:
+            self.defer(self.finish(self.sent, self.shown, text))
+        else:
+            await self.finish(self.sent, self.shown, text)
+
+    async def finish(self, sent, shown, text):
+        # The last edit applies Markdown; partial text is sent plain since it may not parse yet
+        parse_mode = ParseMode.MARKDOWN
+        while True:
+            await self.limiter.wait(self.chat_id)
+            try:
+                if await self.edit(text, parse_mode=parse_mode, sent=sent):
+                    return
+            except exceptions.CantParseEntities:
+                if text == shown:
+                    return
+                parse_mode = None
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+
+from aiogram import types
+
+from app.streaming import StreamingReply
+from utils.metrics import STAGE_ERRORS, STAGE_SECONDS
+from utils.text_to_voice import SentenceChunker
+
+logger = logging.getLogger(__name__)
+
+class VoiceTurn:
+    # Answers a voice note while the answer is still being written. The streamed text goes to
+    # a StreamingReply and, cut into sentence chunks, through two bounded queues: chunks waiting
+    # for synthesis, and syntheses waiting to be sent, started in order but running side by
+    # side. A full queue holds back the stage before it, down to the LLM stream, so a slow TTS
+    # engine or Telegram never piles up audio in memory.
+    def __init__(self, message: types.Message, limiter, textToVoice, preferred=None, buffer=2,
+                 chunk_chars=400, first_chars=60, defer=None):
+        self.message = message
+        self.reply = StreamingReply(message, limiter, defer)
+        self.textToVoice = textToVoice
+        self.preferred = preferred
+        self.chunker = SentenceChunker(chunk_chars, first_chars)
+        self.sentences = asyncio.Queue(maxsize=buffer)
+        self.audio = asyncio.Queue(maxsize=buffer)
+        self.start = None
+        # Seconds from the start of the turn to each milestone
+        self.timings = {}
+        self.voice_notes = 0
+
+    def mark(self, name: str):
+        if name not in self.timings:
+            self.timings[name] = time.monotonic() - self.start
+            STAGE_SECONDS.observe(self.timings[name], stage=f"voice_{name}")
+
+    async def run(self, chunks) -> str:
+        self.start = time.monotonic()
+        tasks = [asyncio.ensure_future(self.synthesizeChunks()), asyncio.ensure_future(self.sendVoice())]
+        try:
+            answer = await self.reply.stream(self.splitChunks(chunks))
+            self.mark("text_done")
+            await self.sentences.put(None)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # A turn cut short leaves syntheses queued that nobody will send
+            pending = []
+            while not self.audio.empty():
+                synthesis = self.audio.get_nowait()
+                if synthesis is not None:
+                    synthesis.cancel()
+                    pending.append(synthesis)
+            await asyncio.gather(*pending, return_exceptions=True)
+        self.mark("voice_done")
+        return answer
+
+    async def splitChunks(self, chunks):
+        # Passes the deltas on to the text reply and queues every finished sentence chunk
+        async for delta in chunks:
+            self.mark("first_token")
+            for sentence in self.chunker.feed(delta):
+                await self.queueSentence(sentence)
+            yield delta
+        for sentence in self.chunker.flush():
+            await self.queueSentence(sentence)
+
+    async def queueSentence(self, sentence: str):
+        self.mark("first_sentence")
+        await self.sentences.put(sentence)
+
+    async def synthesizeChunks(self):
+        while (sentence := await self.sentences.get()) is not None:
+            synthesis = asyncio.ensure_future(self.textToVoice.synthesizeChunk(sentence, self.preferred))
+            try:
+                await self.audio.put(synthesis)
+            except asyncio.CancelledError:
+                synthesis.cancel()
+                raise
+        await self.audio.put(None)
+
+    async def sendVoice(self):
+        # Failed chunks are skipped so the rest of the answer is still spoken
+        while (synthesis := await self.audio.get()) is not None:
+            try:
+                voice_data = await synthesis
+                self.mark("first_audio")
+                await self.message.reply_voice(voice_data)
+                self.voice_notes += 1
+                self.mark("first_voice")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                STAGE_ERRORS.inc(stage="voice_chunk")
+                logger.error("Voice chunk failed", extra={"chat_id": self.message.chat.id, "error": str(e)})
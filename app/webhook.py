@@ -0,0 +1,153 @@
+import json
+import logging
+import multiprocessing
+from contextlib import nullcontext
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot
+from aiogram.bot.api import Methods, TelegramAPIServer
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+
+from utils import database
+from utils.config import Config
+from utils.metrics import TELEGRAM_REQUESTS, timed
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class UpdateDeduplication(BaseMiddleware):
+    # Telegram redelivers an update when the webhook didn't answer in time; the update_id
+    # is claimed in the shared database so a retry, on any worker, is dropped instead of re-billed.
+    # The claim also journals the update, which stays in the jobs table until it is handled.
+    async def on_pre_process_update(self, update, data):
+        payload = update.to_python()
+        if not await database.claimUpdate(update.update_id, chatKey(payload), json.dumps(payload)):
+            raise CancelHandler()
+
+    async def on_post_process_update(self, update, results, data):
+        await database.settleUpdate(update.update_id)
+
+class SecretWebhookHandler(WebhookRequestHandler):
+    async def post(self):
+        secret = self.request.app.get("WEBHOOK_SECRET")
+        if secret and self.request.headers.get(SECRET_HEADER) != secret:
+            raise web.HTTPUnauthorized()
+        return await super().post()
+
+def chatKey(update: dict) -> int:
+    for kind in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if kind in update:
+            return update[kind]["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback and callback.get("message"):
+        return callback["message"]["chat"]["id"]
+    for kind in ("inline_query", "chosen_inline_result", "callback_query", "my_chat_member", "chat_member"):
+        if kind in update and "from" in update[kind]:
+            return update[kind]["from"]["id"]
+    return update.get("update_id", 0)
+
+class WebhookRouter:
+    # Front process for multi-worker mode: every update of a chat goes to the same worker,
+    # which keeps per-chat ordering and lets each worker trust its own user cache
+    def __init__(self, config: Config, worker_ports):
+        self.config = config
+        self.worker_ports = worker_ports
+        self.session = None
+
+    async def handle(self, request: web.Request):
+        if self.config.webhook_secret and request.headers.get(SECRET_HEADER) != self.config.webhook_secret:
+            raise web.HTTPUnauthorized()
+        body = await request.read()
+        try:
+            worker = chatKey(json.loads(body)) % len(self.worker_ports)
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPBadRequest()
+        url = f"http://127.0.0.1:{self.worker_ports[worker]}{self.config.webhook_path}"
+        headers = {"Content-Type": "application/json"}
+        if self.config.webhook_secret:
+            headers[SECRET_HEADER] = self.config.webhook_secret
+        try:
+            async with self.session.post(url, data=body, headers=headers) as response:
+                return web.Response(status=response.status, body=await response.read(),
+                                    content_type=response.content_type)
+        except aiohttp.ClientError:
+            # Telegram retries failed deliveries, and the retry is deduplicated by update_id
+            raise web.HTTPServiceUnavailable()
+
+    async def onStartup(self, app):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None))
+        await setWebhook(self.config)
+
+    async def onCleanup(self, app):
+        await self.session.close()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.config.webhook_path, self.handle)
+        app.on_startup.append(self.onStartup)
+        app.on_cleanup.append(self.onCleanup)
+        return app
+
+class InstrumentedBot(Bot):
+    # Every Bot API call, sends and edits included, goes through request(). getUpdates is a long
+    # poll that mostly waits for updates to arrive, so it is counted but not timed as a send.
+    async def request(self, method, data=None, files=None, **kwargs):
+        try:
+            with nullcontext() if method == Methods.GET_UPDATES else timed("telegram_send"):
+                result = await super().request(method, data, files, **kwargs)
+        except Exception:
+            TELEGRAM_REQUESTS.inc(method=method, outcome="error")
+            raise
+        TELEGRAM_REQUESTS.inc(method=method, outcome="ok")
+        return result
+
+def createBot(config: Config) -> Bot:
+    if config.telegram_api_base:
+        return InstrumentedBot(token=config.bot_access_token, server=TelegramAPIServer.from_base(config.telegram_api_base))
+    return InstrumentedBot(token=config.bot_access_token)
+
+async def setWebhook(config: Config, bot: Bot = None):
+    if not config.webhook_url:
+        logger.info("WEBHOOK_URL is not set, expecting updates to be posted directly")
+        return
+    own_bot = bot is None
+    bot = bot or createBot(config)
+    try:
+        await bot.set_webhook(config.webhook_url.rstrip("/") + config.webhook_path,
+                              secret_token=config.webhook_secret or None,
+                              max_connections=config.webhook_max_connections)
+    finally:
+        if own_bot:
+            await bot.close()
+
+def runWorker(index: int, port: int):
+    # Imported here: app.app imports this module, and each spawned worker builds its own bot
+    from app.app import AIBot
+    bot = AIBot()
+    bot.shard = (index, bot.config.webhook_workers)
+    # Each worker serves its own metrics, on the ports right after METRICS_PORT
+    if bot.config.metrics_port:
+        bot.metricsPort = bot.config.metrics_port + 1 + index
+    logger.info("Webhook worker listening", extra={"worker": index, "port": port})
+    bot.runWebhook("127.0.0.1", port, setWebhook=False)
+
+def runWebhookCluster(config: Config):
+    # Migrate once up front instead of racing in every worker
+    database.init_database()
+    database.close_database()
+    ports = [config.webhook_port + 1 + i for i in range(config.webhook_workers)]
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=runWorker, args=(i, port), daemon=True) for i, port in enumerate(ports)]
+    for worker in workers:
+        worker.start()
+    try:
+        web.run_app(WebhookRouter(config, ports).app(), host=config.webhook_host, port=config.webhook_port)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join(timeout=config.shutdown_timeout + 10)
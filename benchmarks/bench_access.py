@@ -0,0 +1,56 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.access import AccessControl
+
+# Microbenchmark for the access check on every message: the compiled frozenset lookup on the
+# integer chat id, against the old `str(chat_id) in list` scan over BOT_ALLOWED_USERS. Also
+# checks that the compiled lookup allocates nothing.
+
+def legacyCheck(allowedUsers, chat_id):
+    user_id = str(chat_id)
+    if user_id not in allowedUsers:
+        if "*" != allowedUsers[0]:
+            return False
+    return True
+
+def timeIt(function, chat_ids, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for chat_id in chat_ids:
+            function(chat_id)
+    return (time.perf_counter() - start) / (repeat * len(chat_ids))
+
+def allocatedBlocks(function, chat_ids):
+    function(chat_ids[0])
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for chat_id in chat_ids:
+        function(chat_id)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum(stat.count_diff for stat in after.compare_to(before, "lineno")
+               if stat.traceback[0].filename.endswith("access.py") and stat.count_diff > 0)
+
+def main(repeat):
+    print(f"{'users':>8} {'set lookup':>12} {'list scan':>12} {'allocations':>12}")
+    for users in (10, 1000, 10000, 100000):
+        allowedUsers = [str(1000000 + i) for i in range(users)]
+        access = AccessControl(allowedUsers, admins=[allowedUsers[0]])
+        # Half of the lookups hit the last user in the list, half miss
+        chat_ids = [1000000 + users - 1, 42] * 50
+        compiled = timeIt(access.isAllowed, chat_ids, repeat)
+        legacy = timeIt(lambda chat_id: legacyCheck(allowedUsers, chat_id), chat_ids, max(1, repeat * 10 // users))
+        print(f"{users:>8} {compiled * 1e9:>10.0f}ns {legacy * 1e9:>10.0f}ns "
+              f"{allocatedBlocks(access.isAllowed, chat_ids):>12}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+    main(args.repeat)
@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Microbenchmark for command and settings dispatch: the router, where /start, /help and
+# /settings skip the user lookup and reply with text and keyboards built at startup, against
+# the previous if/elif chain that loaded the user first and rebuilt its replies every time.
+# "cached" repeats one chat whose record is in memory; "cold" sends each update from a chat
+# that exists in the database but not in the user cache.
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+class FakeMessage:
+    def __init__(self, chat_id, text):
+        self.chat = FakeChat(chat_id)
+        self.text = text
+
+    def get_command(self):
+        return self.text.split()[0]
+
+    def get_args(self):
+        parts = self.text.split(maxsplit=1)
+        return parts[1] if len(parts) > 1 else ""
+
+    async def reply(self, text=None, **kwargs):
+        pass
+
+class FakeCallback:
+    def __init__(self, chat_id, data):
+        self.message = FakeMessage(chat_id, "Settings:")
+        self.data = data
+
+    async def answer(self):
+        pass
+
+def configureEnvironment():
+    defaults = {
+        "OPENAI_API_KEY": "sk-fake",
+        "BOT_TOKEN": "123456:bench",
+        "BOT_ALLOWED_USERS": "*",
+        "CHAT_PROVIDER": "openai",
+        "CHATGPT_CHAT_MODELS": "gpt-3.5-turbo;gpt-4",
+        "CHATGPT_DEFAULT_MODEL": "gpt-3.5-turbo",
+        "CHATGPT_DEFAULT_TEMPERATURE": "0.7",
+        "CHAT_MAX_CONTEXT": "20",
+        "VOICE_LANGUAGE": "en",
+        "METRICS_PORT": "0",
+        "LOG_LEVEL": "WARNING",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+def legacyCommand(bot, database, utils):
+    async def handleCommand(message):
+        chat_id = str(message.chat.id)
+        user_data = await database.getUserData(chat_id, bot.config)
+        if (message.get_command() == "/start"):
+            await message.reply("Hello, how can I assist you today?")
+        elif (message.get_command() == "/clear"):
+            pass
+        elif (message.get_command() == "/switch"):
+            pass
+        elif (message.get_command() == "/config"):
+            status = utils.getSettingsReport(user_data["options"])
+            await message.reply(status)
+        elif (message.get_command() == "/settings"):
+            settingsMarkup = utils.generateInlineKeyboard()
+            await message.reply(text='Settings:', reply_markup=settingsMarkup)
+        elif (message.get_command() == "/imagine"):
+            pass
+        elif (message.get_command() == "/usage"):
+            pass
+        elif (message.get_command() == "/help"):
+            await message.reply(utils.getHelpReport(bot.access.isAdmin(message.chat.id)))
+    return handleCommand
+
+def legacySettings(bot, database, utils):
+    async def settingsCallback(callback_query):
+        user_data = await database.getUserData(callback_query.message.chat.id, bot.config)
+        action = callback_query.data
+        options = user_data["options"]
+        if action.startswith("/setting_inc_temp"):
+            options["temperature"] = min(options["temperature"] + 0.1, 1)
+        elif action.startswith("/setting_dec_temp"):
+            options["temperature"] = max(options["temperature"] - 0.1, 0)
+        elif action.startswith("/setting_inc_resolution"):
+            options["image_resolution"] = "1024x1024"
+        elif action.startswith("/setting_dec_resolution"):
+            options["image_resolution"] = "512x512"
+        elif action.startswith("/setting_en_whisper"):
+            options["whisper_to_chat"] = True
+        elif action.startswith("/setting_dis_whisper"):
+            options["whisper_to_chat"] = False
+        elif action.startswith("/setting_en_voice"):
+            options["assistant_voice_chat"] = True
+        elif action.startswith("/setting_dis_voice"):
+            options["assistant_voice_chat"] = False
+        elif action.startswith("/setting_inc_context"):
+            options["max-context"] = min(options["max-context"] + 1, 100)
+        elif action.startswith("/setting_dec_context"):
+            options["max-context"] = max(options["max-context"] - 1, 1)
+        await database.saveUserData(callback_query.message.chat.id, user_data)
+        await callback_query.answer()
+        await callback_query.message.reply(text=utils.getSettingsReport(user_data["options"]))
+    return settingsCallback
+
+async def timeIt(handler, events, database, cold):
+    if cold:
+        database.init_database(cache_size=len(events))
+    start = time.perf_counter()
+    for event in events:
+        await handler(event)
+    return (time.perf_counter() - start) / len(events)
+
+async def main(repeat, chats):
+    configureEnvironment()
+    os.chdir(tempfile.mkdtemp(prefix="bench-commands-"))
+    os.makedirs("db_data")
+    from app.app import AIBot
+    from utils import database, utils
+    bot = AIBot()
+    database.FLUSH_INTERVAL = 3600
+    for chat_id in range(chats):
+        await database.getUserData(str(chat_id), bot.config)
+    await database.flushUsers()
+
+    handleCommand = bot.handleCommand.__wrapped__.__get__(bot)
+    settingsCallback = bot.settingsCallback.__wrapped__.__get__(bot)
+    cases = [(command, lambda chat_id, command=command: FakeMessage(chat_id, command), handleCommand,
+              legacyCommand(bot, database, utils)) for command in ("/start", "/help", "/settings", "/config")]
+    cases.append(("settings button", lambda chat_id: FakeCallback(chat_id, "/setting_dec_context"), settingsCallback,
+                  legacySettings(bot, database, utils)))
+
+    print(f"{'update':<16} {'cached: router':>15} {'if/elif':>10} {'cold: router':>14} {'if/elif':>10}")
+    for name, makeEvent, routed, legacy in cases:
+        warmEvents = [makeEvent(0)] * repeat
+        coldEvents = [makeEvent(chat_id) for chat_id in range(chats)]
+        results = []
+        for cold, events in ((False, warmEvents), (True, coldEvents)):
+            for handler in (routed, legacy):
+                results.append(await timeIt(handler, events, database, cold))
+        print(f"{name:<16} " + " ".join(f"{value * 1e6:>{width - 2}.1f}us"
+                                        for value, width in zip(results, (15, 10, 14, 10))))
+    await database.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20000)
+    parser.add_argument("--chats", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.repeat, args.chats))
@@ -0,0 +1,57 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from integrations.openai_integration import IntegrationOpenAI
+from utils.tokenizer import countTokens
+
+# Microbenchmark for context assembly: packing by token budget with the counts stored
+# on each turn, against re-tokenizing the whole history on every request.
+
+WORDS = "the quick brown fox jumps over a lazy dog while markdown tables render code blocks".split()
+
+def makeHistory(turns, model):
+    random.seed(turns)
+    history = []
+    for i in range(turns):
+        content = " ".join(random.choices(WORDS, k=random.randint(3, 200)))
+        history.append({"role": "user" if i % 2 == 0 else "assistant", "content": content,
+                        "tokens": countTokens(content, model)})
+    return history
+
+def retokenizeAndPack(context, budget, model):
+    counts = [countTokens.__wrapped__(turn["content"], model) for turn in context]
+    start, used = len(context), 0
+    while start > 0 and used + counts[start - 1] <= budget:
+        start -= 1
+        used += counts[start]
+    return [{"role": turn["role"], "content": turn["content"]} for turn in context[start:]]
+
+def timeIt(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+def main(model, repeat):
+    integration = IntegrationOpenAI("sk-fake")
+    budget = integration.contextBudget(model)
+    print(f"model {model}, budget {budget} tokens")
+    print(f"{'turns':>8} {'packed':>8} {'stored counts':>15} {'re-tokenized':>15}")
+    for turns in (10, 100, 1000, 10000):
+        context = makeHistory(turns, model)
+        packed = len(integration.packContext(context, budget, model))
+        stored = timeIt(lambda: integration.packContext(context, budget, model), repeat)
+        naive = timeIt(lambda: retokenizeAndPack(context, budget, model), max(1, repeat // 100))
+        print(f"{turns:>8} {packed:>8} {stored * 1e6:>12.1f}us {naive * 1e6:>12.1f}us")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="gpt-4")
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+    main(args.model, args.repeat)
@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from integrations.openai_integration import IntegrationOpenAI, MessageRole
+from utils import database
+
+# Simulates the DB traffic of one text message (getUserData followed by a save of the
+# updated user) for many chats at once, and reports per-message latency and updates/sec.
+# --legacy replays the same load against the old open-connection-per-call access pattern,
+# --write-through disables the in-memory write-behind cache.
+
+CONFIG = SimpleNamespace(
+    bot_asr_to_chat="1",
+    openai_gpt_default_temperature="0.7",
+    chat_max_context="20",
+    chatgpt_default_model="gpt-3.5-turbo",
+)
+
+integration = IntegrationOpenAI("sk-fake")
+
+def legacyGet(chat_id):
+    conn = sqlite3.connect(database.DB_PATH)
+    user = conn.execute(database.SELECT_USER, (chat_id,)).fetchone()
+    messages = conn.execute(database.SELECT_CONTEXT, (chat_id, user[1], user[9])).fetchall() if user else []
+    conn.close()
+    return database.user_from_row(user, messages) if user else None
+
+def legacyAdd(chat_id, user_data):
+    user_row, _, _ = database.take_rows(chat_id, user_data)
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute(database.INSERT_USER, user_row[-1:] + user_row[:-1])
+    conn.commit()
+    conn.close()
+
+def legacyUpdate(chat_id, user_data):
+    user_row, message_rows, _ = database.take_rows(chat_id, user_data)
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute(database.UPDATE_USER, user_row)
+    conn.executemany(database.INSERT_MESSAGE, message_rows)
+    conn.commit()
+    conn.close()
+
+def simulateTurn(user_data):
+    integration.updateContext(user_data, "hello " * 20, MessageRole.USER)
+    integration.updateContext(user_data, "hi there " * 20, MessageRole.ASSISTANT)
+    user_data["usage"]["chatgpt"] += 80
+
+async def legacyMessage(chat_id):
+    user_data = legacyGet(chat_id)
+    if not user_data:
+        legacyAdd(chat_id, database.newUserData(CONFIG))
+        user_data = legacyGet(chat_id)
+    simulateTurn(user_data)
+    legacyUpdate(chat_id, user_data)
+
+async def pooledMessage(chat_id):
+    user_data = await database.getUserData(chat_id, CONFIG)
+    simulateTurn(user_data)
+    await database.saveUserData(chat_id, user_data)
+
+async def chatLoop(chat_id, messages, handler, latencies):
+    for _ in range(messages):
+        start = time.perf_counter()
+        await handler(chat_id)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0)
+
+async def loopLag(lags, stop):
+    # How late a 1ms timer fires is how long other chats would be kept waiting
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+async def main(chats, messages, legacy, write_through):
+    with tempfile.TemporaryDirectory() as tmp:
+        database.init_database(os.path.join(tmp, "bench.db"), flush_interval=0 if write_through else 1.0)
+        database.startFlusher()
+        handler = legacyMessage if legacy else pooledMessage
+        latencies, lags, stop = [], [], asyncio.Event()
+        ticker = asyncio.create_task(loopLag(lags, stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(chatLoop(str(chat_id), messages, handler, latencies) for chat_id in range(chats)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await ticker
+        await database.shutdown()
+
+    latencies.sort()
+    mode = "legacy open-per-call" if legacy else "write-through" if write_through else "write-behind cache"
+    print(f"{mode}: {chats} chats x {messages} messages")
+    print(f"updates/sec: {len(latencies) / elapsed:.0f}")
+    print(f"per-message latency: mean {statistics.mean(latencies) * 1000:.2f}ms, "
+          f"p50 {latencies[len(latencies) // 2] * 1000:.2f}ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f}ms")
+    print(f"event loop lag: max {max(lags) * 1000:.2f}ms over {len(lags)} ticks")
+    if not legacy:
+        print(f"cache: {database.cache.stats()}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--legacy", action="store_true")
+    parser.add_argument("--write-through", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(main(args.chats, args.messages, args.legacy, args.write_through))
@@ -0,0 +1,59 @@
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_openai import FakeOpenAI
+from integrations.openai_integration import IntegrationOpenAI, ImageResolution
+
+# Fires concurrent completions through IntegrationOpenAI against the local fake server
+# to check that slow requests overlap instead of queueing behind each other.
+
+def newUserData():
+    return {
+        "context": [],
+        "history": {"start_seq": 0, "last_seq": 0, "pending": []},
+        "usage": {"chatgpt": 0, "whisper": 0, "dalle": 0},
+        "options": {"temperature": 0.7, "max-context": 10, "gpt_model": "gpt-3.5-turbo"},
+    }
+
+async def main(chats, latency, concurrency, port):
+    server = FakeOpenAI(latency=latency)
+    runner = await server.start(port=port)
+    integration = IntegrationOpenAI("sk-fake", api_base=f"http://127.0.0.1:{port}/v1", max_concurrency=concurrency)
+    try:
+        users = [newUserData() for _ in range(chats)]
+        start = time.perf_counter()
+        await asyncio.gather(*(integration.gptCompletion(f"hello {i}", "Be brief.", "Bench", "gpt-3.5-turbo", users[i])
+                               for i in range(chats)))
+        chat_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await asyncio.gather(*(integration.generateImage(users[i], f"cat {i}", ImageResolution.SMALL)
+                               for i in range(chats)))
+        image_elapsed = time.perf_counter() - start
+
+        audio = io.BytesIO(b"\0" * 4096)
+        audio.name = "voice.mp3"
+        transcript = await integration.transcribeAudio(users[0], audio, 1)
+    finally:
+        await integration.close()
+        await runner.cleanup()
+
+    print(f"{chats} chats, {latency * 1000:.0f}ms simulated latency, concurrency {concurrency}")
+    print(f"chat completions: {chat_elapsed:.3f}s ({chats / chat_elapsed:.1f} req/s)")
+    print(f"image generations: {image_elapsed:.3f}s ({chats / image_elapsed:.1f} req/s)")
+    print(f"transcription: {transcript['text']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    asyncio.run(main(args.chats, args.latency, args.concurrency, args.port))
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from contextlib import aclosing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_openai import FakeOpenAI
+from integrations.providers import OpenAIBackend, ProviderRouter
+from utils import metrics
+
+# Chat completions through the ProviderRouter against two local fake backends. The primary
+# has a long tail (--slow-rate of its requests take --slow-latency); the backup is steady.
+# "primary only" is the baseline, "failover" makes every primary request fail, and "hedged"
+# resends requests still running after the primary's p95 to the backup. In "failover" the
+# primary's errors during warm-up move it behind the backup, so few requests try it at all.
+# With --stream the answers are streamed and latency is the time to the first delta.
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def firstDelta(router, messages):
+    async with aclosing(router.stream("chat", "stream", "gpt-3.5-turbo", messages, 0.7, hedge=True)) as deltas:
+        async for _ in deltas:
+            return
+
+async def runScenario(router, requests, concurrency, stream=False):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                messages = [{"role": "user", "content": f"hello {i}"}]
+                if stream:
+                    await firstDelta(router, messages)
+                else:
+                    await router.call("chat", "complete", "gpt-3.5-turbo", messages, 0.7, hedge=True)
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies, errors, time.perf_counter() - start
+
+def failovers():
+    return {labels[1]: value for labels, value in metrics.PROVIDER_FAILOVERS.values.items()}
+
+async def main(args):
+    logging.basicConfig(level=logging.ERROR)
+    primary = FakeOpenAI(latency=args.latency, slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    backup = FakeOpenAI(latency=args.latency)
+    runners = [await primary.start(port=args.port), await backup.start(port=args.port + 1)]
+
+    def backends():
+        return {name: OpenAIBackend(name, "sk-fake", f"http://127.0.0.1:{port}/v1", max_retries=0)
+                for name, port in (("primary", args.port), ("backup", args.port + 1))}
+
+    scenarios = [
+        ("primary only", lambda: ProviderRouter({"primary": backends()["primary"]}), 0.0),
+        ("failover", lambda: ProviderRouter(backends(), {"chat": "primary"}), 1.0),
+        ("hedged", lambda: ProviderRouter(backends(), {"chat": "primary"}, hedge=True,
+                                          hedge_min_delay=args.hedge_min_delay), 0.0),
+    ]
+    print(f"{args.requests} {'streamed ' if args.stream else ''}requests, concurrency {args.concurrency}, {args.latency * 1000:.0f}ms latency, "
+          f"{args.slow_rate:.0%} of primary requests at {args.slow_latency * 1000:.0f}ms")
+    print(f"{'scenario':<14} {'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7} {'failovers':>10}  requests primary/backup")
+    try:
+        for name, makeRouter, errorRate in scenarios:
+            primary.error_rate = errorRate
+            primary.requests = backup.requests = 0
+            metrics.PROVIDER_FAILOVERS.values.clear()
+            router = makeRouter()
+            try:
+                # Warm-up requests give the router its latency samples
+                await runScenario(router, router.min_samples, args.concurrency, args.stream)
+                primary.requests = backup.requests = 0
+                metrics.PROVIDER_FAILOVERS.values.clear()
+                latencies, errors, _ = await runScenario(router, args.requests, args.concurrency, args.stream)
+            finally:
+                await router.close()
+            counts = failovers()
+            print(f"{name:<14} " + " ".join(f"{percentile(latencies, fraction) * 1000:>7.0f}ms"
+                                            for fraction in (0.5, 0.95, 0.99)) +
+                  f" {errors:>7} {sum(counts.values()):>10.0f}  {primary.requests}/{backup.requests}")
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-latency", type=float, default=1.0)
+    parser.add_argument("--hedge-min-delay", type=float, default=0.1)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--port", type=int, default=8183)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Cold-start benchmark: each run is a fresh interpreter that imports app.app and constructs
+# an AIBot, and reports the time for each step, RSS after init and which of the heavy
+# provider and media libraries got loaded. --eager imports those libraries up front the way
+# the bot used to, for comparison. One extra run under -X importtime gives the import time
+# broken down by top-level package.
+
+HEAVY_MODULES = ("openai", "tiktoken", "gtts", "pyttsx3")
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)")
+
+def configureEnvironment():
+    defaults = {
+        "OPENAI_API_KEY": "sk-fake",
+        "BOT_TOKEN": "123456:bench",
+        "BOT_ALLOWED_USERS": "*",
+        "CHAT_PROVIDER": "openai",
+        "TTI_PROVIDER": "openai",
+        "ASR_PROVIDER": "openai",
+        "CHATGPT_CHAT_MODELS": "gpt-3.5-turbo;gpt-4",
+        "CHATGPT_DEFAULT_MODEL": "gpt-3.5-turbo",
+        "CHATGPT_DEFAULT_TEMPERATURE": "0.7",
+        "CHAT_MAX_CONTEXT": "20",
+        "VOICE_LANGUAGE": "en",
+        "METRICS_PORT": "0",
+        "LOG_LEVEL": "WARNING",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+def rssBytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def child(eager):
+    # Runs inside the fresh interpreter and prints one JSON line
+    configureEnvironment()
+    os.chdir(tempfile.mkdtemp(prefix="bench-startup-"))
+    os.makedirs("db_data")
+    start = time.perf_counter()
+    if eager:
+        for name in HEAVY_MODULES:
+            try:
+                __import__(name)
+            except ImportError:
+                pass
+    from app.app import AIBot
+    imported = time.perf_counter()
+    AIBot()
+    constructed = time.perf_counter()
+    print(json.dumps({
+        "import_seconds": imported - start,
+        "init_seconds": constructed - imported,
+        "rss_bytes": rssBytes(),
+        "loaded": [name for name in HEAVY_MODULES if name in sys.modules],
+    }))
+
+def runChild(eager, importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [os.path.abspath(__file__), "--child"]
+    if eager:
+        command.append("--eager")
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True, cwd=ROOT, check=True)
+    wall = time.perf_counter() - start
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report["wall_seconds"] = wall
+    return report, result.stderr
+
+def importBreakdown(stderr, top):
+    # Self time of every imported module, added up per top-level package
+    totals = {}
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            package = match.group(4).split(".")[0]
+            totals[package] = totals.get(package, 0) + int(match.group(1))
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+
+def main(runs, top):
+    print(f"{'mode':<6} {'wall':>9} {'import':>9} {'init':>9} {'rss':>9}  loaded")
+    breakdowns = {}
+    for eager in (False, True):
+        reports = [runChild(eager)[0] for _ in range(runs)]
+        median = {key: statistics.median(report[key] for report in reports)
+                  for key in ("wall_seconds", "import_seconds", "init_seconds", "rss_bytes")}
+        print(f"{'eager' if eager else 'lazy':<6} {median['wall_seconds'] * 1000:>7.0f}ms "
+              f"{median['import_seconds'] * 1000:>7.0f}ms {median['init_seconds'] * 1000:>7.0f}ms "
+              f"{median['rss_bytes'] / 2 ** 20:>7.1f}MB  {', '.join(reports[0]['loaded']) or '-'}")
+        breakdowns[eager] = importBreakdown(runChild(eager, importtime=True)[1], top)
+    for eager, breakdown in breakdowns.items():
+        print(f"\nimport time by package ({'eager' if eager else 'lazy'}):")
+        for package, micros in breakdown:
+            print(f"  {package:<24} {micros / 1000:>8.1f}ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=12)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--eager", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.eager)
+    else:
+        main(args.runs, args.top)
@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.streaming import EditRateLimiter, LatencyStats, StreamingReply
+from benchmarks.fake_openai import FakeOpenAI
+from integrations.openai_integration import IntegrationOpenAI
+
+# Streams answers from the fake OpenAI server into stand-in Telegram messages and reports
+# time to first visible token against time to the full answer, plus how many edits were sent.
+# The final edit is deferred like the bot does it, so "stream done" is how long the job is held.
+
+class FakeSentMessage:
+    def __init__(self, chat, text):
+        self.chat = chat
+        self.text = text
+
+    async def edit_text(self, text, parse_mode=None):
+        self.chat.edits += 1
+        await asyncio.sleep(self.chat.telegram_latency)
+        self.text = text
+
+class FakeChat:
+    def __init__(self, chat_id, telegram_latency):
+        self.id = chat_id
+        self.telegram_latency = telegram_latency
+        self.edits = 0
+
+    async def reply(self, text, parse_mode=None):
+        await asyncio.sleep(self.telegram_latency)
+        return FakeSentMessage(self, text)
+
+def newUserData():
+    return {
+        "context": [],
+        "history": {"start_seq": 0, "last_seq": 0, "pending": []},
+        "usage": {"chatgpt": 0, "whisper": 0, "dalle": 0},
+        "options": {"temperature": 0.7, "max-context": 10, "gpt_model": "gpt-3.5-turbo"},
+    }
+
+async def streamOne(integration, limiter, chat, prompt, firstToken, streamed, complete):
+    message = SimpleNamespace(chat=chat, reply=chat.reply)
+    finishing = []
+    reply = StreamingReply(message, limiter, defer=lambda edit: finishing.append(asyncio.ensure_future(edit)))
+    start = time.monotonic()
+    chunks = integration.gptCompletionStream(prompt, "Be brief.", "Bench", "gpt-3.5-turbo", newUserData())
+    await reply.stream(chunks)
+    firstToken.add(reply.time_to_first_token)
+    streamed.add(time.monotonic() - start)
+    await asyncio.gather(*finishing)
+    complete.add(time.monotonic() - start)
+
+async def main(chats, words, latency, token_latency, telegram_latency, concurrency, port):
+    server = FakeOpenAI(latency=latency, token_latency=token_latency)
+    runner = await server.start(port=port)
+    integration = IntegrationOpenAI("sk-fake", api_base=f"http://127.0.0.1:{port}/v1", max_concurrency=concurrency)
+    limiter = EditRateLimiter(1.0)
+    firstToken, streamed, complete = LatencyStats(), LatencyStats(), LatencyStats()
+    fakeChats = [FakeChat(i, telegram_latency) for i in range(chats)]
+    prompt = " ".join(["word"] * words)
+    try:
+        await asyncio.gather(*(streamOne(integration, limiter, chat, prompt, firstToken, streamed, complete) for chat in fakeChats))
+    finally:
+        await integration.close()
+        await runner.cleanup()
+
+    print(f"{chats} chats, {words + 1}-word answers, {token_latency * 1000:.0f}ms per token")
+    print(f"time to first token: p50 {firstToken.percentile(0.5):.3f}s, p95 {firstToken.percentile(0.95):.3f}s")
+    print(f"stream done:         p50 {streamed.percentile(0.5):.3f}s, p95 {streamed.percentile(0.95):.3f}s")
+    print(f"time to full answer: p50 {complete.percentile(0.5):.3f}s, p95 {complete.percentile(0.95):.3f}s")
+    print(f"edits per answer: {sum(chat.edits for chat in fakeChats) / chats:.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--words", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.05)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    asyncio.run(main(args.chats, args.words, args.latency, args.token_latency, args.telegram_latency,
+                     args.concurrency, args.port))
@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import io
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.streaming import EditRateLimiter, LatencyStats
+from app.voice import VoiceTurn
+from benchmarks.fake_openai import FakeOpenAI
+from integrations.openai_integration import IntegrationOpenAI
+from integrations.providers import TtsProvider
+from utils.text_to_voice import TextToVoice
+
+# A voice note answered with voice, against the fake OpenAI server and a stand-in TTS engine
+# that takes --tts-latency plus --tts-char-latency per character. "sequential" is the previous
+# handling: transcribe, wait for the whole answer, reply with text, then synthesize and send
+# the voice notes. "pipelined" sends the transcript right away and speaks the answer through
+# VoiceTurn while it streams. Times are from the start of the turn, p50 / p95 over --chats
+# concurrent turns.
+
+class FakeTTS(TtsProvider):
+    def __init__(self, latency, char_latency):
+        self.latency = latency
+        self.char_latency = char_latency
+
+    def synthesize(self, text: str, language: str) -> bytes:
+        time.sleep(self.latency + self.char_latency * len(text))
+        return text.encode()
+
+class FakeSentMessage:
+    def __init__(self, chat):
+        self.chat = chat
+
+    async def edit_text(self, text, parse_mode=None):
+        await asyncio.sleep(self.chat.telegram_latency)
+
+class FakeMessage:
+    # Stands in for the incoming voice note and records when replies go out
+    def __init__(self, chat_id, telegram_latency):
+        self.chat = self
+        self.id = chat_id
+        self.telegram_latency = telegram_latency
+        self.start = time.monotonic()
+        self.timings = {}
+
+    def mark(self, name):
+        self.timings.setdefault(name, time.monotonic() - self.start)
+
+    async def reply(self, text, parse_mode=None):
+        await asyncio.sleep(self.telegram_latency)
+        self.mark("first_text")
+        return FakeSentMessage(self)
+
+    async def reply_voice(self, voice):
+        await asyncio.sleep(self.telegram_latency)
+        self.mark("first_voice")
+        self.timings["voice_done"] = time.monotonic() - self.start
+
+def newUserData():
+    return {
+        "context": [],
+        "history": {"start_seq": 0, "last_seq": 0, "pending": []},
+        "usage": {"chatgpt": 0, "whisper": 0, "dalle": 0},
+        "options": {"temperature": 0.7, "max-context": 10, "gpt_model": "gpt-3.5-turbo"},
+    }
+
+def audioFile():
+    audio = io.BytesIO(b"\0" * 16000)
+    audio.name = "voice.ogg"
+    return audio
+
+async def sequential(integration, textToVoice, message, prompt):
+    user_data = newUserData()
+    await integration.transcribeAudio(user_data, audioFile(), 5)
+    message.mark("asr")
+    answer = await integration.gptCompletion(prompt, "Be brief.", "Bench", "gpt-3.5-turbo", user_data)
+    message.mark("text_done")
+    await message.reply("> transcript\n\n" + answer)
+    async for voice_data in textToVoice.textToVoiceChunks(answer):
+        await message.reply_voice(voice_data)
+
+async def pipelined(integration, textToVoice, message, prompt, limiter, buffer):
+    user_data = newUserData()
+    await integration.transcribeAudio(user_data, audioFile(), 5)
+    message.mark("asr")
+    await message.reply("> transcript")
+    turn = VoiceTurn(message, limiter, textToVoice, buffer=buffer)
+    await turn.run(integration.gptCompletionStream(prompt, "Be brief.", "Bench", "gpt-3.5-turbo", user_data))
+    offset = message.timings["asr"]
+    for name in ("first_token", "first_sentence", "first_audio", "text_done"):
+        message.timings[name] = offset + turn.timings[name]
+
+async def main(args):
+    logging.basicConfig(level=logging.ERROR)
+    server = FakeOpenAI(latency=args.latency, token_latency=args.token_latency)
+    runner = await server.start(port=args.port)
+    integration = IntegrationOpenAI("sk-fake", api_base=f"http://127.0.0.1:{args.port}/v1")
+    sentence = "This sentence stands in for one part of a longer spoken answer from the assistant."
+    prompt = " ".join([sentence] * args.sentences)
+    stages = ("asr", "first_text", "first_token", "first_sentence", "first_audio", "first_voice", "text_done",
+              "voice_done")
+    print(f"{args.chats} turns, {args.sentences}-sentence answers, {args.latency * 1000:.0f}ms API latency, "
+          f"{args.token_latency * 1000:.0f}ms per token, TTS {args.tts_latency * 1000:.0f}ms + "
+          f"{args.tts_char_latency * 1000:.1f}ms per char")
+    print(f"{'stage':<16} {'sequential p50':>15} {'p95':>8} {'pipelined p50':>15} {'p95':>8}")
+    results = {}
+    try:
+        for mode in ("sequential", "pipelined"):
+            # A fresh engine per mode so nothing is served from the voice cache
+            textToVoice = TextToVoice("en", workers=args.tts_workers,
+                                      providers={"fake": FakeTTS(args.tts_latency, args.tts_char_latency)})
+            limiter = EditRateLimiter(1.0)
+            messages = [FakeMessage(chat_id, args.telegram_latency) for chat_id in range(args.chats)]
+            if mode == "sequential":
+                turns = [sequential(integration, textToVoice, message, prompt) for message in messages]
+            else:
+                turns = [pipelined(integration, textToVoice, message, prompt, limiter, args.buffer)
+                         for message in messages]
+            await asyncio.gather(*turns)
+            textToVoice.close()
+            results[mode] = {}
+            for stage in stages:
+                stats = LatencyStats()
+                for message in messages:
+                    if stage in message.timings:
+                        stats.add(message.timings[stage])
+                results[mode][stage] = stats if stats.samples else None
+    finally:
+        await integration.close()
+        await runner.cleanup()
+
+    for stage in stages:
+        cells = []
+        for mode in ("sequential", "pipelined"):
+            stats = results[mode][stage]
+            cells += [f"{stats.percentile(0.5):.3f}s", f"{stats.percentile(0.95):.3f}s"] if stats else ["-", "-"]
+        print(f"{stage:<16} {cells[0]:>15} {cells[1]:>8} {cells[2]:>15} {cells[3]:>8}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--sentences", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.03)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--tts-char-latency", type=float, default=0.002)
+    parser.add_argument("--tts-workers", type=int, default=4)
+    parser.add_argument("--buffer", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8184)
+    asyncio.run(main(parser.parse_args()))
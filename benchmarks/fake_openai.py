@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from aiohttp import web
+
+# Minimal stand-in for the OpenAI endpoints used by IntegrationOpenAI.
+# Point the bot at it with OPENAI_API_BASE=http://localhost:8081/v1
+
+class FakeOpenAI:
+    def __init__(self, latency=0.0, error_rate=0.0, token_latency=0.0, slow_rate=0.0, slow_latency=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token_latency = token_latency
+        # A share of requests takes slow_latency instead, for a long tail
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.requests = 0
+
+    async def simulate(self):
+        self.requests += 1
+        latency = self.slow_latency if self.slow_rate and random.random() < self.slow_rate else self.latency
+        if latency:
+            await asyncio.sleep(latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise web.HTTPServiceUnavailable(
+                text='{"error": {"message": "Injected failure", "type": "server_error"}}',
+                content_type="application/json")
+
+    async def chatCompletion(self, request: web.Request):
+        body = await request.json()
+        await self.simulate()
+        prompt = body["messages"][-1]["content"]
+        answer = f"Echo: {prompt}"
+        if body.get("max_tokens"):
+            # Roughly a word per token, like the real API cutting off at max_tokens
+            answer = " ".join(answer.split(" ")[:body["max_tokens"]])
+        if body.get("stream"):
+            return await self.streamCompletion(request, body, answer)
+        if self.token_latency:
+            # Generating the whole answer takes as long as streaming it
+            await asyncio.sleep(self.token_latency * len(answer.split(" ")))
+        prompt_tokens = sum(len(m["content"].split()) for m in body["messages"])
+        completion_tokens = len(answer.split())
+        return web.json_response({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    async def streamCompletion(self, request, body, answer):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        words = answer.split(" ")
+        try:
+            await response.prepare(request)
+            for i, word in enumerate(words):
+                delta = {"content": word if i == 0 else " " + word}
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "model": body["model"],
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                if self.token_latency:
+                    await asyncio.sleep(self.token_latency)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client stopped reading, e.g. a hedged stream that lost
+            pass
+        return response
+
+    async def imageGeneration(self, request: web.Request):
+        body = await request.json()
+        await self.simulate()
+        return web.json_response({
+            "created": int(time.time()),
+            "data": [{"url": f"https://example.invalid/{body['size']}/{abs(hash(body['prompt']))}.png"}],
+        })
+
+    async def audioTranscription(self, request: web.Request):
+        size = 0
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == "file":
+                while chunk := await part.read_chunk():
+                    size += len(chunk)
+        await self.simulate()
+        return web.json_response({"text": f"Transcribed {size} bytes"})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chatCompletion)
+        app.router.add_post("/v1/images/generations", self.imageGeneration)
+        app.router.add_post("/v1/audio/transcriptions", self.audioTranscription)
+        return app
+
+    async def start(self, host="127.0.0.1", port=8081) -> web.AppRunner:
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-latency", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(FakeOpenAI(args.latency, args.error_rate, args.token_latency, args.slow_rate, args.slow_latency).app(),
+                host=args.host, port=args.port)
@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+from aiohttp import web
+
+# Minimal stand-in for the Telegram Bot API. Point the bot at it with
+# TELEGRAM_API_BASE=http://localhost:8082; GET /stats returns the calls it received.
+
+class FakeTelegram:
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.chats = Counter()
+        self.message_id = 0
+        self.files = {}
+
+    def newMessage(self, chat_id, **fields):
+        self.message_id += 1
+        message = {"message_id": self.message_id, "date": int(time.time()),
+                   "chat": {"id": int(chat_id), "type": "private"}}
+        message.update(fields)
+        return message
+
+    async def method(self, request: web.Request):
+        name = request.match_info["method"].lower()
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate and name not in ("getme", "setwebhook"):
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            self.chats[str(chat_id)] += 1
+        if name == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        elif name in ("sendmessage", "editmessagetext"):
+            result = self.newMessage(chat_id, text=params.get("text", ""))
+        elif name == "sendvoice":
+            result = self.newMessage(chat_id, voice={"file_id": "voice", "file_unique_id": "voice", "duration": 1})
+        elif name == "getfile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files.get(file_id, b"")),
+                      "file_path": f"files/{file_id}"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(self, request: web.Request):
+        file_id = request.match_info["path"].split("/")[-1]
+        return web.Response(body=self.files.get(file_id, b""))
+
+    async def stats(self, request: web.Request):
+        return web.json_response({"calls": dict(self.calls), "chats": len(self.chats)})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.file)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+    async def start(self, host="127.0.0.1", port=8082) -> web.AppRunner:
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake Telegram Bot API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(FakeTelegram(args.latency, args.error_rate).app(), host=args.host, port=args.port)
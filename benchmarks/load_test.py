@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, types
+
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.fake_telegram import FakeTelegram
+
+# Drives a real AIBot with synthetic updates from many chats, against in-process fake Telegram
+# and OpenAI servers, and reports throughput, latency percentiles per update kind and memory.
+# Updates go through Dispatcher.process_updates, so the update claim and journal, middleware and
+# the per-chat scheduler are included and each update is timed until messageHandler,
+# handleCommand, handleAttachment or settingsCallback has finished with it. Any bot setting can
+# be overridden through the environment. Results are written as JSON; --compare prints the
+# change against an older run.
+
+VOICE_FILE_ID = "bench-voice"
+
+# Share of each kind of update in the synthetic traffic
+MIX = (
+    ("text", 0.70),
+    ("command", 0.15),
+    ("settings", 0.10),
+    ("voice", 0.05),
+)
+
+COMMANDS = ("/usage", "/config", "/help", "/switch", "/start", "/clear")
+SETTINGS = ("/setting_inc_temp", "/setting_dec_temp", "/setting_inc_context", "/setting_dec_context",
+            "/setting_en_whisper", "/setting_dis_whisper")
+
+def chatUser(chat_id):
+    return {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"}
+
+def messageUpdate(update_id, chat_id, **fields):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"},
+        "from": chatUser(chat_id),
+    }
+    message.update(fields)
+    return {"update_id": update_id, "message": message}
+
+def buildUpdate(kind, update_id, chat_id, rng):
+    if kind == "text":
+        return messageUpdate(update_id, chat_id, text=f"Question {rng.randrange(1000)} from chat {chat_id}")
+    if kind == "command":
+        command = rng.choice(COMMANDS)
+        entity = {"type": "bot_command", "offset": 0, "length": len(command)}
+        return messageUpdate(update_id, chat_id, text=command, entities=[entity])
+    if kind == "voice":
+        voice = {"file_id": VOICE_FILE_ID, "file_unique_id": VOICE_FILE_ID, "duration": 3}
+        return messageUpdate(update_id, chat_id, voice=voice)
+    update = messageUpdate(update_id, chat_id, text="Settings:")
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": chatUser(chat_id),
+            "message": update["message"],
+            "chat_instance": str(chat_id),
+            "data": rng.choice(SETTINGS),
+        },
+    }
+
+def pickKind(rng):
+    point = rng.random()
+    for kind, share in MIX:
+        point -= share
+        if point < 0:
+            return kind
+    return MIX[0][0]
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "max": max(latencies, default=0.0),
+    }
+
+def memoryBytes():
+    # Current and peak RSS read together from /proc/self/status, so both share a source and
+    # units and the peak can never trail the current figure; elsewhere only the peak is known
+    current = peak = None
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == "darwin" else peak * 1024
+    return current or 0, max(peak, current or 0)
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def configureEnvironment(args):
+    # Defaults for a self-contained run; anything already set in the environment wins
+    defaults = {
+        "OPENAI_API_KEY": "sk-fake",
+        "OPENAI_API_BASE": f"http://127.0.0.1:{args.openai_port}/v1",
+        "TELEGRAM_API_BASE": f"http://127.0.0.1:{args.telegram_port}",
+        "BOT_TOKEN": "123456:load-test",
+        "BOT_ALLOWED_USERS": "*",
+        "CHAT_PROVIDER": "openai",
+        "TTI_PROVIDER": "openai",
+        "ASR_PROVIDER": "openai",
+        "ASR_TO_CHAT": "1",
+        "CHAT_DEFAULT_SYSTEM_PROMPT": "You are a helpful assistant.",
+        "CHAT_MAX_CONTEXT": "20",
+        "CHATGPT_CHAT_MODELS": "gpt-3.5-turbo;gpt-4",
+        "CHATGPT_DEFAULT_MODEL": "gpt-3.5-turbo",
+        "CHATGPT_DEFAULT_TEMPERATURE": "0.7",
+        "VOICE_LANGUAGE": "en",
+        "BOT_EDIT_INTERVAL": str(args.edit_interval),
+        "METRICS_PORT": "0",
+        "SCHEDULER_STATS_INTERVAL": "0",
+        "LOG_LEVEL": "WARNING",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+def stageSummary():
+    from utils import metrics
+    return {key[0]: {"count": count, "mean": total / count if count else 0.0}
+            for key, (_, total, count) in sorted(metrics.STAGE_SECONDS.values.items())}
+
+async def runChat(dp, updates, args, rng, results, errors):
+    for kind, update in updates:
+        start = time.perf_counter()
+        try:
+            await dp.process_updates([types.Update(**update)])
+        except Exception as e:
+            errors[f"{kind}: {type(e).__name__}"] += 1
+        results[kind].append(time.perf_counter() - start)
+        if args.think_time:
+            await asyncio.sleep(rng.expovariate(1.0 / args.think_time))
+
+async def main(args):
+    configureEnvironment(args)
+    workdir = tempfile.mkdtemp(prefix="load-test-")
+    os.makedirs(os.path.join(workdir, "db_data"))
+    os.chdir(workdir)
+
+    openaiServer = FakeOpenAI(latency=args.openai_latency, error_rate=args.openai_error_rate,
+                              token_latency=args.token_latency)
+    telegramServer = FakeTelegram(latency=args.telegram_latency, error_rate=args.telegram_error_rate)
+    telegramServer.files[VOICE_FILE_ID] = os.urandom(16 * 1024)
+    runners = [await openaiServer.start(port=args.openai_port), await telegramServer.start(port=args.telegram_port)]
+
+    # Imported after the environment is set up, as the bot reads it on import and construction
+    from app.app import AIBot
+    bot = AIBot()
+    bot.registerHandlers()
+    Bot.set_current(bot.bot)
+    Dispatcher.set_current(bot.dp)
+    await bot.onStartup(bot.dp)
+
+    rng = random.Random(args.seed)
+    update_id = 0
+    workload = []
+    for chat in range(args.chats):
+        updates = []
+        for _ in range(args.messages):
+            update_id += 1
+            kind = pickKind(rng)
+            updates.append((kind, buildUpdate(kind, update_id, 100000 + chat, rng)))
+        workload.append(updates)
+
+    results = defaultdict(list)
+    errors = Counter()
+    rssBefore, _ = memoryBytes()
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(runChat(bot.dp, updates, args, random.Random(args.seed + chat),
+                                       results, errors)
+                               for chat, updates in enumerate(workload)))
+        elapsed = time.perf_counter() - start
+        rssAfter, peakRss = memoryBytes()
+    finally:
+        await bot.onShutdown(bot.dp)
+        await (await bot.bot.get_session()).close()
+        for runner in runners:
+            await runner.cleanup()
+
+    allLatencies = [latency for latencies in results.values() for latency in latencies]
+    total = len(allLatencies)
+    report = {
+        "commit": gitCommit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "updates": total,
+        "elapsed_seconds": elapsed,
+        "throughput_per_second": total / elapsed if elapsed else 0.0,
+        "errors": sum(errors.values()),
+        "error_kinds": dict(errors),
+        "latency": summarize(allLatencies),
+        "latency_by_kind": {kind: summarize(latencies) for kind, latencies in sorted(results.items())},
+        "memory": {
+            "rss_before_bytes": rssBefore,
+            "rss_after_bytes": rssAfter,
+            "peak_rss_bytes": peakRss,
+            "rss_per_chat_bytes": (rssAfter - rssBefore) / args.chats if args.chats else 0,
+        },
+        "stages": stageSummary(),
+        "telegram_calls": dict(telegramServer.calls),
+    }
+    return report
+
+def printReport(report):
+    latency = report["latency"]
+    print(f"{report['updates']} updates from {report['parameters']['chats']} chats in {report['elapsed_seconds']:.2f}s "
+          f"({report['throughput_per_second']:.1f} updates/s), {report['errors']} errors")
+    print(f"latency: p50 {latency['p50'] * 1000:.1f}ms, p95 {latency['p95'] * 1000:.1f}ms, "
+          f"p99 {latency['p99'] * 1000:.1f}ms")
+    for kind, stats in report["latency_by_kind"].items():
+        print(f"  {kind:<9} n={stats['count']:<6} p50 {stats['p50'] * 1000:8.1f}ms  p95 {stats['p95'] * 1000:8.1f}ms  "
+              f"p99 {stats['p99'] * 1000:8.1f}ms")
+    memory = report["memory"]
+    print(f"memory: rss {memory['rss_after_bytes'] / 2 ** 20:.1f}MB (peak {memory['peak_rss_bytes'] / 2 ** 20:.1f}MB), "
+          f"{memory['rss_per_chat_bytes'] / 1024:.1f}KB per chat")
+    for kind, count in sorted(report["error_kinds"].items()):
+        print(f"  error {kind}: {count}")
+
+def printComparison(report, baseline):
+    def change(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+    print(f"compared with {baseline.get('commit') or 'baseline'}:")
+    print(f"  throughput {change(report['throughput_per_second'], baseline['throughput_per_second'])}")
+    for key in ("p50", "p95", "p99"):
+        print(f"  {key} {change(report['latency'][key], baseline['latency'][key])}")
+    print(f"  peak rss {change(report['memory']['peak_rss_bytes'], baseline['memory']['peak_rss_bytes'])}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test AIBot against fake Telegram and OpenAI servers")
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=5, help="updates sent by each chat, one after another")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause between a chat's updates")
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--edit-interval", type=float, default=1.0)
+    parser.add_argument("--openai-port", type=int, default=8181)
+    parser.add_argument("--telegram-port", type=int, default=8182)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="load_test_result.json")
+    parser.add_argument("--compare", help="result file of an earlier run to compare against")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+    report = asyncio.run(main(args))
+    with open(output, "w") as resultFile:
+        json.dump(report, resultFile, indent=2)
+    printReport(report)
+    if baseline:
+        printComparison(report, baseline)
+    print(f"results written to {output}")
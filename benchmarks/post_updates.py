@@ -0,0 +1,51 @@
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+# Posts fake Telegram updates to a bot running in webhook mode, including a redelivery of
+# every update to check deduplication. Run the bot with TELEGRAM_API_BASE pointing at
+# benchmarks/fake_telegram.py and OPENAI_API_BASE at benchmarks/fake_openai.py.
+
+def textUpdate(update_id, chat_id, text):
+    user = {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+        },
+    }
+
+async def post(session, url, secret, update):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    async with session.post(url, json=update, headers=headers) as response:
+        return response.status
+
+async def main(url, secret, chats, messages, telegram):
+    updates = [textUpdate(1000 + i * chats + chat, 100000 + chat, f"hello {i}")
+               for i in range(messages) for chat in range(chats)]
+    async with aiohttp.ClientSession() as session:
+        start = time.perf_counter()
+        statuses = await asyncio.gather(*(post(session, url, secret, update) for update in updates))
+        elapsed = time.perf_counter() - start
+        duplicates = await asyncio.gather(*(post(session, url, secret, update) for update in updates))
+        print(f"posted {len(updates)} updates in {elapsed:.2f}s, statuses {sorted(set(statuses))}, "
+              f"redeliveries {sorted(set(duplicates))}")
+        if telegram:
+            async with session.get(f"{telegram.rstrip('/')}/stats") as response:
+                print(f"fake Telegram received: {await response.json()}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=3)
+    parser.add_argument("--telegram", default="http://127.0.0.1:8082")
+    args = parser.parse_args()
+    asyncio.run(main(args.url, args.secret, args.chats, args.messages, args.telegram))
@@ -1,6 +1,22 @@
-import openai
+import asyncio
+import logging
+from contextlib import aclosing
 from enum import Enum
 
+from integrations.providers import OpenAIBackend, ProviderRouter
+from utils.tokenizer import countTokens, contextTokens, truncateTokens
+from utils.metrics import STAGE_ERRORS, TOKENS, timed
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for the per-user max-context setting; the token budget usually binds first
+MAX_USER_CONTEXT = 100
+
+SUMMARY_INSTRUCTIONS = ("You keep a running summary of a conversation between a user and an assistant. "
+                        "Update the current summary with the new messages. Keep names, facts, preferences, "
+                        "decisions and open questions; drop small talk. Write at most {words} words and "
+                        "reply with the summary only.")
+
 class MessageRole(Enum):
     SYSTEM = "system"
     USER = "user"
@@ -16,62 +32,280 @@ class UsageType(Enum):
     IMAGE = "dalle"
     VOICE = "whisper"
 
+# Model names the rate limiter uses for requests that don't go to a chat model
+RATE_LIMIT_MODELS = {UsageType.IMAGE: "dall-e", UsageType.VOICE: "whisper-1"}
+
 class IntegrationOpenAI:
+    # Conversation, caching and billing logic; the requests themselves go through a
+    # ProviderRouter, by default with a single OpenAI backend built from these arguments.
+    def __init__(self, api_key, api_base=None, max_concurrency=16, pool_size=100,
+                 request_timeout=60.0, max_retries=3, retry_backoff=0.5,
+                 context_tokens=None, response_tokens=1024, response_cache=None,
+                 summary_model=None, summary_tokens=300, usage_ledger=None, router=None, transcript_cache=None,
+                 segment_concurrency=4):
+        self.router = router or ProviderRouter({"openai": OpenAIBackend("openai", api_key, api_base, max_concurrency,
+                                                                        pool_size, request_timeout, max_retries,
+                                                                        retry_backoff)})
+        self.context_tokens = context_tokens or {}
+        self.response_tokens = response_tokens
+        self.response_cache = response_cache
+        # With a summary model, turns past max-context are folded into a running summary instead of dropped
+        self.summary_model = summary_model
+        self.summary_tokens = summary_tokens
+        self.usage_ledger = usage_ledger
+        self.transcript_cache = transcript_cache
+        self.segment_concurrency = segment_concurrency
+
+    async def close(self):
+        await self.router.close()
+
+    def preferredProvider(self, user_data, capability: str):
+        return user_data.get("options", {}).get("providers", {}).get(capability)
 
-    def __init__(self, api_key):
-        openai.api_key = api_key
+    def buildPrompt(self, system_prompt: str, user_name, model: str, user_data):
+        systemPrompt = self.getMessage(MessageRole.SYSTEM, f"You are chatting with {user_name}. {system_prompt}")
+        prompt = [systemPrompt]
+        summary = user_data["history"].get("summary")
+        if summary:
+            prompt.append(self.getMessage(MessageRole.SYSTEM, f"Summary of the earlier conversation: {summary}"))
+        systemTokens = sum(countTokens(message["content"], model) for message in prompt)
+        budget = self.contextBudget(model) - systemTokens
+        context = self.packContext(user_data["context"], budget, model)
+        packedTokens = sum(turn["tokens"] for turn in user_data["context"][len(user_data["context"]) - len(context):])
+        promptTokens = systemTokens + min(packedTokens, budget)
+        return prompt + context, promptTokens
 
-    def gptCompletion(self, message: str, system_prompt: str, user_name, model: str, user_data = {}):
+    def chatCacheKey(self, model: str, system_prompt: str, fullMessage, temperature):
+        # The greeting with the user's name is left out so the same question hits across users
+        if self.response_cache is None or not self.response_cache.deterministic(temperature):
+            return None
+        return self.response_cache.chatKey(model, system_prompt, fullMessage[1:], temperature)
+
+    async def cachedAnswer(self, cacheKey, user_data):
+        # A cached answer joins the conversation like a fresh one but isn't billed
+        if cacheKey is None:
+            return None
+        assistant_message = await self.response_cache.get("chat", cacheKey)
+        if assistant_message is not None:
+            self.updateContext(user_data, assistant_message, MessageRole.ASSISTANT)
+        return assistant_message
+
+    async def gptCompletion(self, message: str, system_prompt: str, user_name, model: str, user_data = {}):
         self.updateContext(user_data, message, MessageRole.USER)
-        systemPrompt = [self.getMessage(MessageRole.SYSTEM, f"You are chatting with {user_name}. {system_prompt}")]
-        fullMessage = systemPrompt + user_data["context"]
+        fullMessage, _ = self.buildPrompt(system_prompt, user_name, model, user_data)
+        cacheKey = self.chatCacheKey(model, system_prompt, fullMessage, user_data["options"]["temperature"])
+        cached = await self.cachedAnswer(cacheKey, user_data)
+        if cached is not None:
+            return cached
         try:
-            response = openai.ChatCompletion.create(
-                model = model,
-                messages = fullMessage,
-                temperature = user_data["options"]["temperature"],
-            )
+            with timed("llm"):
+                response = await self.router.call("chat", "complete", model, fullMessage,
+                                                  user_data["options"]["temperature"],
+                                                  preferred=self.preferredProvider(user_data, "chat"), hedge=True)
         except Exception as e:
-            print(e)
+            logger.error("Chat completion failed", extra={"model": model, "error": str(e)})
             return f"There was a problem with OpenAI, so I can't answer you: \n\n{e}"
 
-        assistant_message = response.get('choices')[0].get('message').get("content")
+        assistant_message = response["content"]
         self.updateContext(user_data, assistant_message, MessageRole.ASSISTANT)
-        self.updateUsage(user_data, UsageType.CHAT, response.get('usage')["total_tokens"])
+        self.updateUsage(user_data, UsageType.CHAT, response["prompt_tokens"] + response["completion_tokens"], model,
+                         response["prompt_tokens"], response["completion_tokens"])
         if (assistant_message == None):
-            return f"OpenAI returned nothing, maybe usage limit exceeded?"    
+            return f"OpenAI returned nothing, maybe usage limit exceeded?"
+        if cacheKey is not None:
+            await self.response_cache.put("chat", cacheKey, assistant_message)
         return assistant_message
 
-    def generateImage(self, user_data, image_prompt, resolution: ImageResolution):
-        self.updateUsage(user_data, UsageType.IMAGE, 1)
-        response = openai.Image.create(
-            prompt=image_prompt,
-            n=1,
-            size=resolution.value
-        )
+    async def gptCompletionStream(self, message: str, system_prompt: str, user_name, model: str, user_data = {}):
+        # Yields the answer as it is generated; context and usage are updated once it completes
+        self.updateContext(user_data, message, MessageRole.USER)
+        fullMessage, promptTokens = self.buildPrompt(system_prompt, user_name, model, user_data)
+        cacheKey = self.chatCacheKey(model, system_prompt, fullMessage, user_data["options"]["temperature"])
+        cached = await self.cachedAnswer(cacheKey, user_data)
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        with timed("llm_stream"):
+            try:
+                async with aclosing(self.router.stream("chat", "stream", model, fullMessage,
+                                                       user_data["options"]["temperature"],
+                                                       preferred=self.preferredProvider(user_data, "chat"),
+                                                       hedge=True)) as deltas:
+                    async for delta in deltas:
+                        parts.append(delta)
+                        yield delta
+            except Exception as e:
+                STAGE_ERRORS.inc(stage="llm_stream")
+                logger.error("Chat completion stream failed", extra={"model": model, "error": str(e)})
+                error = f"There was a problem with OpenAI, so I can't answer you: \n\n{e}"
+                yield "\n\n" + error if parts else error
+                if not parts:
+                    return
+                # A cut-off answer is kept in the conversation but never served to anyone else
+                cacheKey = None
+
+        if not parts:
+            yield f"OpenAI returned nothing, maybe usage limit exceeded?"
+            return
+        assistant_message = "".join(parts)
+        self.updateContext(user_data, assistant_message, MessageRole.ASSISTANT)
+        # Streamed responses carry no usage block, so bill from our own token counts
+        answerTokens = user_data["context"][-1]["tokens"]
+        self.updateUsage(user_data, UsageType.CHAT, promptTokens + answerTokens, model, promptTokens, answerTokens)
+        if cacheKey is not None:
+            await self.response_cache.put("chat", cacheKey, assistant_message)
+
+    async def generateImage(self, user_data, image_prompt, resolution: ImageResolution):
+        cacheKey = None
+        if self.response_cache is not None:
+            cacheKey = self.response_cache.imageKey(image_prompt, resolution.value)
+            image_url = await self.response_cache.get("image", cacheKey)
+            if image_url is not None:
+                return image_url
+        self.updateUsage(user_data, UsageType.IMAGE, 1, f"dall-e {resolution.value}")
         try:
-            image_url = response['data'][0]['url']
+            with timed("image"):
+                image_url = await self.router.call("image", "generate", image_prompt, resolution.value,
+                                                   preferred=self.preferredProvider(user_data, "image"))
         except Exception as e:
+            logger.error("Image generation failed", extra={"error": str(e)})
             return "Error generating. Your prompt may contain text that is not allowed by OpenAI safety system."
+        if cacheKey is not None:
+            await self.response_cache.put("image", cacheKey, image_url)
         return image_url
 
-    def transcribeAudio(self, user_data, audio_file, duration):
-        self.updateUsage(user_data, UsageType.VOICE, duration)
+    async def transcribeAudio(self, user_data, audio_file, duration):
+        return await self.transcribeSegments(user_data, [(audio_file, duration, None)])
+
+    async def transcribeSegments(self, user_data, segments, progress=None):
+        # Segments are (file, seconds, digest) in order; up to segment_concurrency are uploaded at
+        # once and the texts joined in order. A segment whose digest is in the transcript cache is
+        # neither uploaded nor billed. progress(done, total) is awaited as segments finish.
+        semaphore = asyncio.Semaphore(self.segment_concurrency)
+        done = 0
+
+        async def transcribe(audio_file, seconds, digest):
+            nonlocal done
+            cacheKey = self.transcript_cache.transcriptKey(digest) if self.transcript_cache and digest else None
+            text = await self.transcript_cache.get("asr", cacheKey) if cacheKey else None
+            if text is None:
+                async with semaphore:
+                    text = await self.transcribeSegment(user_data, audio_file, seconds)
+                if text is not None and cacheKey:
+                    await self.transcript_cache.put("asr", cacheKey, text)
+            done += 1
+            if progress is not None:
+                await progress(done, len(segments))
+            return text
+
+        texts = await asyncio.gather(*(transcribe(*segment) for segment in segments))
+        if all(text is None for text in texts):
+            return {"text": "Transcript failed."}
+        return {"text": " ".join(text.strip() for text in texts if text and text.strip())}
+
+    async def transcribeSegment(self, user_data, audio_file, seconds):
+        self.updateUsage(user_data, UsageType.VOICE, seconds, "whisper-1")
         try:
-            transcript = openai.Audio.transcribe("whisper-1", audio_file)
+            with timed("asr"):
+                # Not hedged: the two uploads would read the same file at once
+                return await self.router.call("asr", "transcribe", audio_file,
+                                              preferred=self.preferredProvider(user_data, "asr"))
         except Exception as e:
-            print(e)
-            transcript = "Transcript failed."
-        return transcript
+            logger.error("Transcription failed", extra={"error": str(e)})
+            return None
 
     def getMessage(self, role : MessageRole, text: str):
         return {"role": role.value, "content": text}
 
+    def contextBudget(self, model: str) -> int:
+        return contextTokens(model, self.context_tokens) - self.response_tokens
+
+    def packContext(self, context, budget, model: str):
+        # Walk back from the newest turn using the stored counts; nothing is re-tokenized here
+        start = len(context)
+        used = 0
+        while start > 0 and used + context[start - 1]["tokens"] <= budget:
+            start -= 1
+            used += context[start]["tokens"]
+        if start == len(context) and context:
+            # The newest turn alone is over the budget, e.g. a pasted document. It is cut to fit
+            # here, for this request only, instead of being sent whole and refused.
+            turn = context[-1]
+            return [{"role": turn["role"], "content": truncateTokens(turn["content"], model, max(0, budget))}]
+        return [{"role": turn["role"], "content": turn["content"]} for turn in context[start:]]
+
     def updateContext(self, user_data, message, contextType: MessageRole):
-        user_data['context'].append(self.getMessage(contextType, message))
-        if len(user_data['context']) > user_data["options"]["max-context"]:
-            user_data['context'].pop(0)
+        # The full history is append-only in storage; only the last max-context turns stay in memory.
+        # Tokens are counted once here and stored with the turn.
+        history = user_data["history"]
+        history["last_seq"] += 1
+        tokens = countTokens(message, user_data["options"]["gpt_model"])
+        history["pending"].append((history["last_seq"], contextType.value, message, tokens))
+        turn = self.getMessage(contextType, message)
+        turn["tokens"] = tokens
+        turn["seq"] = history["last_seq"]
+        user_data['context'].append(turn)
+        # While compaction runs in the background the window may grow, up to twice max-context
+        limit = user_data["options"]["max-context"] * (2 if self.summary_model else 1)
+        overflow = len(user_data['context']) - limit
+        if overflow > 0:
+            del user_data['context'][:overflow]
 
-    def updateUsage(self, user_data, usageType: UsageType, usageCost):
-        user_data["usage"][usageType.value] += usageCost
+    def needsCompaction(self, user_data) -> bool:
+        return (self.summary_model is not None
+                and len(user_data["context"]) > user_data["options"]["max-context"]
+                and not user_data["history"].get("compacting"))
 
+    async def compactContext(self, user_data) -> bool:
+        # Folds the older half of the window into the summary. Only the new turns are sent along
+        # with the previous summary, so each update costs the same however long the chat gets.
+        history = user_data["history"]
+        keep = max(1, user_data["options"]["max-context"] // 2)
+        turns = user_data["context"][:-keep]
+        if not turns:
+            return False
+        start_seq = history["start_seq"]
+        history["compacting"] = True
+        try:
+            summary = await self.summarize(history.get("summary"), turns, user_data)
+        finally:
+            history["compacting"] = False
+        # Drop the result if the chat was cleared in the meantime
+        if summary is None or history["start_seq"] != start_seq:
+            return False
+        last_seq = turns[-1]["seq"]
+        history["summary"] = summary
+        history["summary_seq"] = last_seq
+        user_data["context"] = [turn for turn in user_data["context"] if turn["seq"] > last_seq]
+        return True
+
+    async def summarize(self, summary, turns, user_data):
+        transcript = "\n".join(f"{turn['role'].capitalize()}: {turn['content']}" for turn in turns)
+        instructions = SUMMARY_INSTRUCTIONS.format(words=int(self.summary_tokens * 0.75))
+        try:
+            with timed("summarize"):
+                response = await self.router.call(
+                    "chat", "complete", self.summary_model,
+                    [self.getMessage(MessageRole.SYSTEM, instructions),
+                     self.getMessage(MessageRole.USER, f"Current summary:\n{summary or '(none)'}\n\n"
+                                                       f"New messages:\n{transcript}")],
+                    0,
+                    max_tokens=self.summary_tokens,
+                    preferred=self.preferredProvider(user_data, "chat"),
+                    hedge=True,
+                )
+        except Exception as e:
+            logger.error("Summarizing the conversation failed", extra={"model": self.summary_model, "error": str(e)})
+            return None
+        self.updateUsage(user_data, UsageType.CHAT, response["prompt_tokens"] + response["completion_tokens"],
+                         self.summary_model, response["prompt_tokens"], response["completion_tokens"])
+        return response["content"] or None
+
+    def updateUsage(self, user_data, usageType: UsageType, usageCost, model=None, prompt_tokens=0, completion_tokens=0):
+        user_data["usage"][usageType.value] += usageCost
+        if usageType == UsageType.CHAT:
+            TOKENS.inc(usageCost, model=model or user_data["options"]["gpt_model"])
+        if self.usage_ledger is not None and user_data.get("chat_id") is not None:
+            self.usage_ledger.record(user_data["chat_id"], model, usageType.value,
+                                     prompt_tokens, completion_tokens, usageCost)
@@ -0,0 +1,387 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import aclosing, nullcontext
+
+import aiohttp
+
+from utils.metrics import PROVIDER_FAILOVERS, PROVIDER_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+class ChatProvider:
+    async def complete(self, model: str, messages, temperature, max_tokens=None):
+        # Returns {"content": str or None, "prompt_tokens": int, "completion_tokens": int}
+        raise NotImplementedError
+
+    async def stream(self, model: str, messages, temperature):
+        # Async generator of text deltas
+        raise NotImplementedError
+        yield
+
+class ImageProvider:
+    async def generate(self, prompt: str, size: str) -> str:
+        # Returns the URL of the image
+        raise NotImplementedError
+
+class AsrProvider:
+    async def transcribe(self, audio_file) -> str:
+        raise NotImplementedError
+
+class TtsProvider:
+    # Synthesis is blocking; TextToVoice runs it on its thread pools. single_thread engines
+    # aren't thread-safe and get a thread of their own.
+    single_thread = False
+
+    def synthesize(self, text: str, language: str) -> bytes:
+        raise NotImplementedError
+
+CAPABILITIES = {"chat": ChatProvider, "image": ImageProvider, "asr": AsrProvider}
+
+class OpenAIBackend(ChatProvider, ImageProvider, AsrProvider):
+    # Any server that speaks the OpenAI API: api.openai.com, a self-hosted gateway or the fake
+    # server in benchmarks/. Key and base URL are passed with every call, so several backends
+    # can be configured side by side.
+    def __init__(self, name="openai", api_key=None, api_base=None, max_concurrency=16, pool_size=100,
+                 request_timeout=60.0, max_retries=3, retry_backoff=0.5, asr_model="whisper-1"):
+        self.name = name
+        self.api_key = api_key
+        self.api_base = api_base
+        self.pool_size = pool_size
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.asr_model = asr_model
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.openai = None
+        self.retryable_errors = ()
+        self.session = None
+
+    def api(self):
+        # Importing openai is a large share of startup time, so it happens on the first request
+        if self.openai is None:
+            import openai
+            self.retryable_errors = (
+                openai.error.RateLimitError,
+                openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError,
+                openai.error.Timeout,
+                openai.error.TryAgain,
+                openai.error.APIError,
+                aiohttp.ClientError,
+                asyncio.TimeoutError,
+            )
+            self.openai = openai
+        return self.openai
+
+    def getSession(self) -> aiohttp.ClientSession:
+        # One pooled session shared by every chat, created lazily inside the running loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def request(self, call, *args, **kwargs):
+        return await self.retrying(call, args, kwargs, limited=True)
+
+    async def retrying(self, call, args, kwargs, limited):
+        # openai reads its aiohttp session from a ContextVar, so bind it for this task only
+        openai = self.api()
+        token = openai.aiosession.set(self.getSession())
+        kwargs = dict(kwargs, api_key=self.api_key, api_base=self.api_base)
+        endpoint = getattr(call, "__qualname__", "unknown")
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with (self.semaphore if limited else nullcontext()):
+                        response = await asyncio.wait_for(call(*args, **kwargs), timeout=self.request_timeout)
+                    PROVIDER_REQUESTS.inc(provider=self.name, endpoint=endpoint, outcome="ok")
+                    return response
+                except self.retryable_errors as e:
+                    if attempt >= self.max_retries:
+                        PROVIDER_REQUESTS.inc(provider=self.name, endpoint=endpoint, outcome="error")
+                        raise
+                    PROVIDER_REQUESTS.inc(provider=self.name, endpoint=endpoint, outcome="retry")
+                    delay = self.retry_backoff * (2 ** attempt) + random.uniform(0, self.retry_backoff)
+                    logger.warning("OpenAI request failed, retrying",
+                                   extra={"provider": self.name, "endpoint": endpoint, "error": repr(e),
+                                          "delay": round(delay, 2)})
+                    await asyncio.sleep(delay)
+                except openai.error.OpenAIError:
+                    PROVIDER_REQUESTS.inc(provider=self.name, endpoint=endpoint, outcome="error")
+                    raise
+        finally:
+            openai.aiosession.reset(token)
+
+    async def complete(self, model: str, messages, temperature, max_tokens=None):
+        params = {"model": model, "messages": messages, "temperature": temperature,
+                  "request_timeout": self.request_timeout}
+        if max_tokens:
+            params["max_tokens"] = max_tokens
+        response = await self.request(self.api().ChatCompletion.acreate, **params)
+        usage = response.get("usage") or {}
+        return {
+            "content": response.get("choices")[0].get("message").get("content"),
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+        }
+
+    async def stream(self, model: str, messages, temperature):
+        # The whole stream holds a slot, not just the request that opens it
+        async with self.semaphore:
+            response = await self.retrying(self.api().ChatCompletion.acreate, (), {
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "request_timeout": self.request_timeout,
+                "stream": True,
+            }, limited=False)
+            async for chunk in response:
+                delta = chunk["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+    async def generate(self, prompt: str, size: str) -> str:
+        response = await self.request(self.api().Image.acreate, prompt=prompt, n=1, size=size,
+                                      request_timeout=self.request_timeout)
+        return response['data'][0]['url']
+
+    async def transcribe(self, audio_file) -> str:
+        transcript = await self.request(self.transcribeOnce, audio_file)
+        return transcript["text"]
+
+    async def transcribeOnce(self, audio_file, api_key=None, api_base=None):
+        # Rewind so a retried upload sends the whole file again
+        audio_file.seek(0)
+        # Audio.atranscribe drops api_key and api_base in openai 0.27, so build its request here
+        openai = self.api()
+        requestor, files, data = openai.Audio._prepare_request(audio_file, audio_file.name, self.asr_model,
+                                                               api_key=api_key, api_base=api_base)
+        response, _, api_key = await requestor.arequest("post", openai.Audio._get_url("transcriptions"),
+                                                        files=files, params=data)
+        return openai.util.convert_to_openai_object(response, api_key)
+
+class ProviderStats:
+    # Latency and outcome of the most recent requests to one provider for one capability.
+    # Outcomes older than error_window seconds are forgotten, so a provider that was moved to
+    # the back for failing gets traffic again once it has been left alone for that long.
+    def __init__(self, window=200, error_window=60.0):
+        self.latencies = deque(maxlen=window)
+        self.errors = deque(maxlen=window)
+        self.error_window = error_window
+
+    def record(self, seconds: float, ok: bool):
+        if ok:
+            self.latencies.append(seconds)
+        self.errors.append((time.monotonic(), 0 if ok else 1))
+
+    def p95(self, min_samples=20):
+        if len(self.latencies) < min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+    def errorRate(self, min_samples=20) -> float:
+        cutoff = time.monotonic() - self.error_window
+        while self.errors and self.errors[0][0] < cutoff:
+            self.errors.popleft()
+        if len(self.errors) < min_samples:
+            return 0.0
+        return sum(failed for _, failed in self.errors) / len(self.errors)
+
+class ProviderRouter:
+    # Sends each request to the user's provider, then the default for the capability, then the
+    # others in configured order, with providers failing more than max_error_rate of recent
+    # requests moved to the back. A request that fails goes to the next provider. With hedging,
+    # a request still running after the p95 latency of its provider (at least hedge_min_delay)
+    # is also sent to the next provider and whichever answers first wins; only use it for
+    # requests that are safe to run twice. `slot(name)`, when given, is entered around every call
+    # to a provider, streams included, to cap the requests in flight to it.
+    def __init__(self, providers, defaults=None, hedge=False, hedge_min_delay=1.0, max_error_rate=0.5,
+                 min_samples=20, error_window=60.0, slot=None):
+        self.providers = providers
+        self.slot = slot or (lambda name: nullcontext())
+        self.defaults = defaults or {}
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.error_window = error_window
+        self.stats = {}
+
+    def names(self, capability: str):
+        return [name for name, provider in self.providers.items() if isinstance(provider, CAPABILITIES[capability])]
+
+    def statsFor(self, name: str, capability: str) -> ProviderStats:
+        stats = self.stats.get((name, capability))
+        if stats is None:
+            stats = self.stats[(name, capability)] = ProviderStats(error_window=self.error_window)
+        return stats
+
+    def healthy(self, name: str, capability: str) -> bool:
+        return self.statsFor(name, capability).errorRate(self.min_samples) <= self.max_error_rate
+
+    def candidates(self, capability: str, preferred=None):
+        names = self.names(capability)
+        order = [name for name in (preferred, self.defaults.get(capability)) if name in names]
+        order += [name for name in names if name not in order]
+        # sorted is stable, so the order above holds within the healthy and the failing group
+        return sorted(order, key=lambda name: not self.healthy(name, capability))
+
+    def hedgeDelay(self, name: str, capability: str) -> float:
+        p95 = self.statsFor(name, capability).p95(self.min_samples)
+        return max(self.hedge_min_delay, p95 or 0.0)
+
+    async def timedCall(self, name: str, capability: str, method: str, args, kwargs):
+        async with self.slot(name):
+            start = time.perf_counter()
+            try:
+                result = await getattr(self.providers[name], method)(*args, **kwargs)
+            except Exception:
+                self.statsFor(name, capability).record(time.perf_counter() - start, False)
+                raise
+        self.statsFor(name, capability).record(time.perf_counter() - start, True)
+        return result
+
+    async def call(self, capability: str, method: str, *args, preferred=None, hedge=False, **kwargs):
+        candidates = self.candidates(capability, preferred)
+        if not candidates:
+            raise LookupError(f"No provider configured for {capability}")
+        hedge = hedge and self.hedge
+        pending = {}
+        lastError = None
+        nextIndex = 0
+
+        def start():
+            nonlocal nextIndex
+            name = candidates[nextIndex]
+            nextIndex += 1
+            task = asyncio.ensure_future(self.timedCall(name, capability, method, args, kwargs))
+            pending[task] = name
+
+        start()
+        try:
+            while pending:
+                timeout = None
+                if hedge and len(pending) == 1 and nextIndex < len(candidates):
+                    timeout = self.hedgeDelay(next(iter(pending.values())), capability)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    PROVIDER_FAILOVERS.inc(capability=capability, reason="hedge")
+                    logger.info("Hedging slow request", extra={"capability": capability,
+                                                               "provider": candidates[nextIndex - 1],
+                                                               "hedge": candidates[nextIndex]})
+                    start()
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    lastError = task.exception()
+                    logger.warning("Provider request failed", extra={"capability": capability, "provider": name,
+                                                                     "error": str(lastError)})
+                if not pending and nextIndex < len(candidates):
+                    PROVIDER_FAILOVERS.inc(capability=capability, reason="error")
+                    start()
+            raise lastError
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def timedStream(self, name: str, capability: str, method: str, args, kwargs):
+        # Time to first delta is what the user waits for, so that is what is tracked
+        stats = self.statsFor(name, capability)
+        async with self.slot(name):
+            start = time.perf_counter()
+            started = False
+            try:
+                async with aclosing(getattr(self.providers[name], method)(*args, **kwargs)) as deltas:
+                    async for delta in deltas:
+                        if not started:
+                            started = True
+                            stats.record(time.perf_counter() - start, True)
+                        yield delta
+            except Exception:
+                if not started:
+                    stats.record(time.perf_counter() - start, False)
+                raise
+            if not started:
+                stats.record(time.perf_counter() - start, True)
+
+    async def stream(self, capability: str, method: str, *args, preferred=None, hedge=False, **kwargs):
+        # Fails over, and hedges like call does on the time to the first delta, only until the
+        # first delta has been passed on; from then on the stream that produced it is followed
+        candidates = self.candidates(capability, preferred)
+        if not candidates:
+            raise LookupError(f"No provider configured for {capability}")
+        hedge = hedge and self.hedge
+        # Task waiting for the first delta of a stream -> (provider, stream)
+        pending = {}
+        lastError = None
+        nextIndex = 0
+        winner = None
+
+        def start():
+            nonlocal nextIndex
+            name = candidates[nextIndex]
+            nextIndex += 1
+            deltas = self.timedStream(name, capability, method, args, kwargs)
+            pending[asyncio.ensure_future(deltas.__anext__())] = (name, deltas)
+
+        start()
+        try:
+            while pending and winner is None:
+                timeout = None
+                if hedge and len(pending) == 1 and nextIndex < len(candidates):
+                    timeout = self.hedgeDelay(next(iter(pending.values()))[0], capability)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    PROVIDER_FAILOVERS.inc(capability=capability, reason="hedge")
+                    logger.info("Hedging slow stream", extra={"capability": capability,
+                                                              "provider": candidates[nextIndex - 1],
+                                                              "hedge": candidates[nextIndex]})
+                    start()
+                    continue
+                for task in done:
+                    name, deltas = pending.pop(task)
+                    error = task.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        if winner is None:
+                            winner = (None if error else task.result(), deltas)
+                        else:
+                            await deltas.aclose()
+                        continue
+                    lastError = error
+                    logger.warning("Provider stream failed", extra={"capability": capability, "provider": name,
+                                                                    "error": str(error)})
+                if winner is None and not pending and nextIndex < len(candidates):
+                    PROVIDER_FAILOVERS.inc(capability=capability, reason="error")
+                    start()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for _, deltas in pending.values():
+                await deltas.aclose()
+        if winner is None:
+            raise lastError
+        first, deltas = winner
+        async with aclosing(deltas):
+            if first is None:
+                return
+            yield first
+            async for delta in deltas:
+                yield delta
+
+    async def close(self):
+        for provider in self.providers.values():
+            close = getattr(provider, "close", None)
+            if close is not None:
+                await close()
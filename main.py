@@ -1,5 +1,16 @@
+from dotenv import load_dotenv
+
 from app.app import AIBot
+from app.webhook import runWebhookCluster
+from utils.config import Config
+from utils.log import setupLogging
 
 if __name__ == '__main__':
-    bot = AIBot()
-    bot.run()
+    load_dotenv()
+    config = Config()
+    if config.bot_mode == "webhook" and config.webhook_workers > 1:
+        setupLogging(config.log_level, config.log_format)
+        runWebhookCluster(config)
+    else:
+        bot = AIBot()
+        bot.run()
@@ -0,0 +1,109 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+ADMIN = "admin"
+USER = "user"
+BANNED = "banned"
+ROLES = (ADMIN, USER, BANNED)
+
+def parseChatId(value):
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return None
+
+def readAccessFile(path: str):
+    # One "chat_id [role]" per line, # starts a comment; the role defaults to user
+    roles = {}
+    with open(path) as accessFile:
+        for line in accessFile:
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            chat_id = parseChatId(fields[0])
+            role = fields[1].lower() if len(fields) > 1 else USER
+            if chat_id is None or role not in ROLES:
+                logger.warning("Skipping invalid access entry", extra={"path": path, "line": line.strip()})
+                continue
+            roles[chat_id] = role
+    return roles
+
+class AccessControl:
+    # Roles per chat id from three layers, each overriding the one before: BOT_ALLOWED_USERS
+    # and BOT_ADMINS, the optional access file, and the access table the admin commands
+    # write to. Every reload compiles them into frozensets of ints that are swapped in
+    # whole, so a check is one set lookup on message.chat.id with nothing allocated.
+    def __init__(self, allowed_users=(), admins=(), path=None):
+        self.open = "*" in allowed_users
+        self.base = {}
+        for chat_id in map(parseChatId, allowed_users):
+            if chat_id is not None:
+                self.base[chat_id] = USER
+        for chat_id in map(parseChatId, admins):
+            if chat_id is not None:
+                self.base[chat_id] = ADMIN
+        self.path = path
+        self.fileRoles = {}
+        self.fileMtime = None
+        self.dbRoles = {}
+        self.roles = {}
+        self.allowed = frozenset()
+        self.admins = frozenset()
+        self.banned = frozenset()
+        self.compile()
+
+    def isAllowed(self, chat_id: int) -> bool:
+        if self.open:
+            return chat_id not in self.banned
+        return chat_id in self.allowed
+
+    def isAdmin(self, chat_id: int) -> bool:
+        return chat_id in self.admins
+
+    def role(self, chat_id: int):
+        return self.roles.get(chat_id)
+
+    def compile(self):
+        roles = dict(self.base)
+        roles.update(self.fileRoles)
+        roles.update(self.dbRoles)
+        self.roles = roles
+        self.allowed = frozenset(chat_id for chat_id, role in roles.items() if role != BANNED)
+        self.admins = frozenset(chat_id for chat_id, role in roles.items() if role == ADMIN)
+        self.banned = frozenset(chat_id for chat_id, role in roles.items() if role == BANNED)
+
+    def reloadFile(self) -> bool:
+        # Re-reads the access file when its modification time changed
+        if not self.path:
+            return False
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.fileMtime:
+            return False
+        self.fileMtime = mtime
+        try:
+            self.fileRoles = readAccessFile(self.path) if mtime is not None else {}
+        except OSError as e:
+            logger.error("Failed to read access file", extra={"path": self.path, "error": str(e)})
+            return False
+        return True
+
+    def reload(self, db_rows) -> bool:
+        # db_rows are (chat_id, role) from the access table; recompiles only when something changed
+        dbRoles = {}
+        for chat_id, role in db_rows:
+            chat_id = parseChatId(chat_id)
+            if chat_id is not None and role in ROLES:
+                dbRoles[chat_id] = role
+        fileChanged = self.reloadFile()
+        if not fileChanged and dbRoles == self.dbRoles:
+            return False
+        self.dbRoles = dbRoles
+        self.compile()
+        logger.info("Access list loaded", extra={"users": len(self.allowed), "admins": len(self.admins),
+                                                 "banned": len(self.banned), "open": self.open})
+        return True
@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import re
+import tempfile
+from io import BytesIO
+
+from utils.metrics import timed
+
+# Formats the Whisper endpoint accepts as-is; anything else is transcoded to mp3
+WHISPER_FORMATS = {"flac", "m4a", "mp3", "mp4", "mpeg", "mpga", "oga", "ogg", "wav", "webm"}
+
+# Containers that keep their index at the end of the file can't be demuxed from a pipe
+SEEKABLE_FORMATS = {"mp4", "m4a", "mov"}
+
+SILENCE_END = re.compile(r"silence_end: ([\d.]+) \| silence_duration: ([\d.]+)")
+
+class AudioTooLarge(Exception):
+    pass
+
+def parseSilences(log: str):
+    # (start, end) in seconds of every silence ffmpeg's silencedetect reported
+    return [(float(end) - float(duration), float(end)) for end, duration in SILENCE_END.findall(log)]
+
+def cutPoints(silences, duration, segment_seconds, search_seconds):
+    # A cut near every segment_seconds, in the middle of the longest silence within the
+    # search_seconds before it so words aren't split, or right at it if there is none. The search
+    # never reaches back past the middle of the segment, so every cut moves forward.
+    cuts = []
+    start = 0.0
+    search_seconds = min(search_seconds, segment_seconds / 2)
+    while duration - start > segment_seconds:
+        target = start + segment_seconds
+        candidates = [(end - begin, (begin + end) / 2) for begin, end in silences
+                      if target - search_seconds <= (begin + end) / 2 <= target]
+        cut = max(candidates)[1] if candidates else target
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+class AudioPipeline:
+    # Media longer than segment_seconds is cut at silences into segments that are transcribed
+    # side by side. Segments come as (file, seconds, digest), the digest being the SHA-256 of
+    # the bytes that would be uploaded, so identical media can be recognized before any upload.
+    def __init__(self, max_concurrency=2, max_download_bytes=20 * 1024 * 1024,
+                 max_upload_bytes=25 * 1024 * 1024, ffmpeg="ffmpeg", segment_seconds=600,
+                 search_seconds=30, silence_db=-35, min_silence=0.3):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_download_bytes = max_download_bytes
+        self.max_upload_bytes = max_upload_bytes
+        self.ffmpeg = ffmpeg
+        self.segment_seconds = segment_seconds
+        self.search_seconds = search_seconds
+        self.silence_db = silence_db
+        self.min_silence = min_silence
+
+    async def download(self, bot, file_id) -> bytes:
+        file = await bot.get_file(file_id)
+        if file.file_size and file.file_size > self.max_download_bytes:
+            raise AudioTooLarge(f"File is too large ({file.file_size // (1024 * 1024)}MB), "
+                                f"the limit is {self.max_download_bytes // (1024 * 1024)}MB.")
+        with timed("telegram_download"):
+            buffer = await bot.download_file(file.file_path)
+        return buffer.getvalue()
+
+    async def loadSegments(self, bot, file_id, file_format: str, duration):
+        data = await self.download(bot, file_id)
+        if not duration or duration <= self.segment_seconds:
+            audio = await self.prepare(data, file_format)
+            return [(audio, duration, hashlib.sha256(audio.getvalue()).hexdigest())]
+        return await self.split(data, file_format, duration)
+
+    async def prepare(self, data: bytes, file_format: str) -> BytesIO:
+        if file_format not in WHISPER_FORMATS or len(data) > self.max_upload_bytes:
+            data = await self.transcode(data, file_format)
+            file_format = "mp3"
+            if len(data) > self.max_upload_bytes:
+                raise AudioTooLarge("Audio is too long to transcribe.")
+        audio = BytesIO(data)
+        audio.name = f"audio.{file_format}"
+        return audio
+
+    async def transcode(self, data: bytes, src_format: str) -> bytes:
+        # Mono 16kHz at a low bitrate is all speech recognition needs and keeps uploads small
+        output = ["-vn", "-ac", "1", "-ar", "16000", "-b:a", "32k", "-f", "mp3", "pipe:1"]
+        async with self.semaphore:
+            with timed("transcode"):
+                if src_format in SEEKABLE_FORMATS:
+                    with tempfile.NamedTemporaryFile(suffix=f".{src_format}") as source:
+                        await asyncio.to_thread(self.writeFile, source, data)
+                        return await self.runFfmpeg(["-i", source.name] + output)
+                return await self.runFfmpeg(["-f", src_format, "-i", "pipe:0"] + output, data)
+
+    async def split(self, data: bytes, file_format: str, duration):
+        # ffmpeg finds the silences in one pass, then every segment is cut from the source file
+        # and transcoded on its own, so the decoded audio is never held in memory whole
+        with tempfile.NamedTemporaryFile(suffix=f".{file_format}") as source:
+            await asyncio.to_thread(self.writeFile, source, data)
+            async with self.semaphore:
+                with timed("silence_detect"):
+                    log = await self.runFfmpeg(["-i", source.name, "-af",
+                                                f"silencedetect=noise={self.silence_db}dB:d={self.min_silence}",
+                                                "-f", "null", "-"], loglevel="info", output="stderr")
+            cuts = cutPoints(parseSilences(log.decode(errors="replace")), duration,
+                             self.segment_seconds, self.search_seconds)
+            bounds = list(zip([0.0] + cuts, cuts + [float(duration)]))
+            segments = await asyncio.gather(*(self.cut(source.name, start, end, index == len(bounds) - 1)
+                                              for index, (start, end) in enumerate(bounds)))
+        # Whole seconds that add up to the duration, for billing
+        return [(audio, round(end) - round(start), hashlib.sha256(audio.getvalue()).hexdigest())
+                for audio, (start, end) in zip(segments, bounds)]
+
+    async def cut(self, path: str, start: float, end: float, last: bool) -> BytesIO:
+        length = [] if last else ["-t", f"{end - start:.3f}"]
+        output = ["-vn", "-ac", "1", "-ar", "16000", "-b:a", "32k", "-f", "mp3", "pipe:1"]
+        async with self.semaphore:
+            with timed("transcode"):
+                data = await self.runFfmpeg(["-ss", f"{start:.3f}"] + length + ["-i", path] + output)
+        if len(data) > self.max_upload_bytes:
+            raise AudioTooLarge("Audio is too long to transcribe.")
+        audio = BytesIO(data)
+        audio.name = "audio.mp3"
+        return audio
+
+    def writeFile(self, file, data):
+        file.write(data)
+        file.flush()
+
+    async def runFfmpeg(self, args, data=None, loglevel="error", output="stdout") -> bytes:
+        process = await asyncio.create_subprocess_exec(
+            self.ffmpeg, "-hide_banner", "-loglevel", loglevel, *args,
+            stdin=asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate(data)
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace').strip()}")
+        return stdout if output == "stdout" else stderr
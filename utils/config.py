@@ -1,22 +1,104 @@
 import os
 
+from utils.rate_limit import parseLimits
+
 class Config:
     def __init__(self):
         self.openai_key = os.environ.get("OPENAI_API_KEY")
         self.openai_chat_models = os.environ.get("CHATGPT_CHAT_MODELS").split(";")
         self.openai_gpt_default_temperature = os.environ.get("CHATGPT_DEFAULT_TEMPERATURE")
+        self.openai_context_tokens = dict(
+            (model, int(tokens)) for model, tokens in
+            (entry.split("=") for entry in os.environ.get("CHATGPT_CONTEXT_TOKENS", "").split(";") if entry))
+        self.openai_response_tokens = int(os.environ.get("CHATGPT_RESPONSE_TOKENS", "1024"))
+        self.openai_api_base = os.environ.get("OPENAI_API_BASE")
+        self.openai_max_concurrency = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "16"))
+        self.openai_pool_size = int(os.environ.get("OPENAI_POOL_SIZE", "100"))
+        self.openai_request_timeout = float(os.environ.get("OPENAI_REQUEST_TIMEOUT", "60"))
+        self.openai_max_retries = int(os.environ.get("OPENAI_MAX_RETRIES", "3"))
+        self.openai_retry_backoff = float(os.environ.get("OPENAI_RETRY_BACKOFF", "0.5"))
+        # Backends as name or name=base_url; each reads <NAME>_API_KEY, falling back to OPENAI_API_KEY
+        self.providers = {}
+        for entry in os.environ.get("PROVIDERS", "openai").split(";"):
+            if not entry:
+                continue
+            name, _, api_base = entry.partition("=")
+            self.providers[name] = {
+                "api_key": os.environ.get(f"{name.upper()}_API_KEY") or self.openai_key,
+                "api_base": api_base or (self.openai_api_base if name == "openai" else None),
+            }
+        self.provider_hedge = os.environ.get("PROVIDER_HEDGE", "0") == "1"
+        self.provider_hedge_min_delay = float(os.environ.get("PROVIDER_HEDGE_MIN_DELAY", "1.0"))
+        self.provider_max_error_rate = float(os.environ.get("PROVIDER_MAX_ERROR_RATE", "0.5"))
+        self.response_cache = os.environ.get("RESPONSE_CACHE", "0") == "1"
+        self.response_cache_size = int(os.environ.get("RESPONSE_CACHE_SIZE", "1000"))
+        self.response_cache_ttl = float(os.environ.get("RESPONSE_CACHE_TTL", "86400"))
+        self.response_cache_image_ttl = float(os.environ.get("RESPONSE_CACHE_IMAGE_TTL", "3000"))
+        self.response_cache_max_temperature = float(os.environ.get("RESPONSE_CACHE_MAX_TEMPERATURE", "0"))
 
         self.chat_provider = os.environ.get("CHAT_PROVIDER")
         self.chat_default_system_prompt = os.environ.get("CHAT_DEFAULT_SYSTEM_PROMPT")
         self.chat_max_context = os.environ.get("CHAT_MAX_CONTEXT")
+        self.chat_streaming = os.environ.get("CHAT_STREAMING", "1") == "1"
+        self.chat_compaction = os.environ.get("CHAT_COMPACTION", "0") == "1"
+        self.chat_summary_model = os.environ.get("CHAT_SUMMARY_MODEL") or self.openai_chat_models[0]
+        self.chat_summary_tokens = int(os.environ.get("CHAT_SUMMARY_TOKENS", "300"))
 
         self.tti_provider = os.environ.get("TTI_PROVIDER")
         self.asr_provider = os.environ.get("ASR_PROVIDER")
-        self.asr_model = os.environ.get("ASR_MODEL")
+        self.asr_model = os.environ.get("ASR_MODEL") or "whisper-1"
+        self.asr_max_upload_bytes = int(os.environ.get("ASR_MAX_UPLOAD_MB", "25")) * 1024 * 1024
+        self.audio_max_download_bytes = int(os.environ.get("AUDIO_MAX_DOWNLOAD_MB", "20")) * 1024 * 1024
+        self.audio_max_concurrency = int(os.environ.get("AUDIO_MAX_CONCURRENCY", "2"))
+        self.asr_segment_seconds = int(os.environ.get("ASR_SEGMENT_SECONDS", "600"))
+        self.asr_segment_concurrency = int(os.environ.get("ASR_SEGMENT_CONCURRENCY", "4"))
+        self.asr_cache = os.environ.get("ASR_CACHE", "0") == "1"
+        self.asr_cache_size = int(os.environ.get("ASR_CACHE_SIZE", "1000"))
+        self.asr_cache_ttl = float(os.environ.get("ASR_CACHE_TTL", str(30 * 24 * 3600)))
 
         self.bot_asr_to_chat = os.environ.get("ASR_TO_CHAT")
-        self.bot_use_tts = os.environ.get("ENABLE_TTS")
+        self.bot_use_tts = os.environ.get("ENABLE_TTS", "1") == "1"
+        self.bot_tts_workers = int(os.environ.get("TTS_WORKERS", "4"))
+        self.bot_tts_cache_bytes = int(os.environ.get("TTS_CACHE_MB", "32")) * 1024 * 1024
         self.bot_default_tts_language = os.environ.get("VOICE_LANGUAGE")
+        self.voice_pipeline = os.environ.get("VOICE_PIPELINE", "1") == "1"
+        self.voice_pipeline_buffer = int(os.environ.get("VOICE_PIPELINE_BUFFER", "2"))
+        self.bot_edit_interval = float(os.environ.get("BOT_EDIT_INTERVAL", "1.0"))
         self.bot_access_token = os.environ.get("BOT_TOKEN")
+        self.bot_mode = os.environ.get("BOT_MODE", "polling")
+        self.telegram_api_base = os.environ.get("TELEGRAM_API_BASE")
+
+        self.webhook_url = os.environ.get("WEBHOOK_URL")
+        self.webhook_path = os.environ.get("WEBHOOK_PATH", "/webhook")
+        self.webhook_host = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+        self.webhook_port = int(os.environ.get("WEBHOOK_PORT", "8080"))
+        self.webhook_secret = os.environ.get("WEBHOOK_SECRET")
+        self.webhook_workers = int(os.environ.get("WEBHOOK_WORKERS", "1"))
+        self.webhook_max_connections = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+        self.scheduler_max_jobs = int(os.environ.get("SCHEDULER_MAX_JOBS", "32"))
+        self.scheduler_provider_limits = dict(
+            (provider, int(limit)) for provider, limit in
+            (entry.split("=") for entry in os.environ.get("SCHEDULER_PROVIDER_LIMITS", "").split(";") if entry))
+        self.scheduler_stats_interval = float(os.environ.get("SCHEDULER_STATS_INTERVAL", "60"))
+        self.shutdown_timeout = float(os.environ.get("SHUTDOWN_TIMEOUT", "20"))
+
+        self.rate_limits = parseLimits(os.environ.get("RATE_LIMITS", ""))
+        self.daily_quotas = dict(
+            (kind, float(units)) for kind, units in
+            (entry.split("=") for entry in os.environ.get("DAILY_QUOTAS", "").split(";") if entry))
+        self.rate_limit_persist = os.environ.get("RATE_LIMIT_PERSIST", "0") == "1"
+
+        self.db_cache_size = int(os.environ.get("DB_CACHE_SIZE", "10000"))
+        self.db_flush_interval = float(os.environ.get("DB_FLUSH_INTERVAL", "5"))
+        self.db_flush_batch = int(os.environ.get("DB_FLUSH_BATCH", "200"))
+
+        self.metrics_host = os.environ.get("METRICS_HOST", "127.0.0.1")
+        self.metrics_port = int(os.environ.get("METRICS_PORT", "9100"))
+        self.log_level = os.environ.get("LOG_LEVEL", "INFO")
+        self.log_format = os.environ.get("LOG_FORMAT", "text")
+
         self.bot_allowed_users = os.environ.get("BOT_ALLOWED_USERS").split(";")
+        self.bot_admins = [admin for admin in os.environ.get("BOT_ADMINS", "").split(";") if admin]
+        self.access_file = os.environ.get("ACCESS_FILE")
+        self.access_reload_interval = float(os.environ.get("ACCESS_RELOAD_INTERVAL", "30"))
         self.chatgpt_default_model = os.environ.get("CHATGPT_DEFAULT_MODEL")
@@ -1,94 +1,464 @@
 import sqlite3
 import json
 import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from integrations.openai_integration import ImageResolution
+from utils.user_cache import UserCache
+from utils.usage_ledger import ALL_USERS, UsageLedger, addDelta, today
+from utils.job_journal import JobJournal
+from utils.tokenizer import countTokens
+from utils.metrics import timed
+
+logger = logging.getLogger(__name__)
 
 DB_PATH = "db_data/users.db"
 
-def init_database():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            chat_id TEXT PRIMARY KEY,
-            context TEXT,
-            usage_chatgpt INTEGER,
-            usage_whisper INTEGER,
-            usage_dalle INTEGER,
-            whisper_to_chat INTEGER,
-            assistant_voice_chat INTEGER,
-            image_resolution TEXT,
-            temperature REAL,
-            max_context INTEGER,
-            gpt_model TEXT
-        )
-    """)
-    print("Database initialized")
-    conn.commit()
-    conn.close()
-
-def clearUserContext(chat_id, user_data):
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=67108864",
+    "PRAGMA busy_timeout=5000",
+)
+
+SCHEMA_VERSION = 4
+
+# Processed update ids are remembered this long to drop redeliveries
+UPDATE_RETENTION_SECONDS = 2 * 24 * 3600
+
+# A journaled job is picked up again this many times before it is given up on
+JOB_MAX_ATTEMPTS = 3
+
+USER_COLUMNS = """
+    chat_id, context_start, usage_chatgpt, usage_whisper, usage_dalle,
+    whisper_to_chat, assistant_voice_chat, image_resolution, temperature, max_context, gpt_model,
+    summary, summary_seq, providers
+"""
+
+SELECT_USER = f"SELECT {USER_COLUMNS} FROM users WHERE chat_id = ?"
+
+INSERT_USER = f"INSERT INTO users ({USER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+UPDATE_USER = """
+    UPDATE users
+    SET
+        context_start = ?,
+        usage_chatgpt = ?,
+        usage_whisper = ?,
+        usage_dalle = ?,
+        whisper_to_chat = ?,
+        assistant_voice_chat = ?,
+        image_resolution = ?,
+        temperature = ?,
+        max_context = ?,
+        gpt_model = ?,
+        summary = ?,
+        summary_seq = ?,
+        providers = ?
+    WHERE chat_id = ?
+"""
+
+INSERT_MESSAGE = """
+    INSERT OR IGNORE INTO messages (chat_id, seq, role, content, token_count) VALUES (?, ?, ?, ?, ?)
+"""
+
+# Last N turns after the /clear marker, newest first so LIMIT can use the primary key
+SELECT_CONTEXT = """
+    SELECT seq, role, content, token_count FROM messages
+    WHERE chat_id = ? AND seq > ?
+    ORDER BY seq DESC LIMIT ?
+"""
+
+UPSERT_LEDGER = """
+    INSERT INTO usage_ledger (chat_id, day, model, kind, prompt_tokens, completion_tokens, units)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (chat_id, day, model, kind) DO UPDATE SET
+        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+        completion_tokens = completion_tokens + excluded.completion_tokens,
+        units = units + excluded.units
+"""
+
+UPSERT_ROLLUP = """
+    INSERT INTO usage_rollup (chat_id, model, kind, prompt_tokens, completion_tokens, units)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (chat_id, model, kind) DO UPDATE SET
+        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+        completion_tokens = completion_tokens + excluded.completion_tokens,
+        units = units + excluded.units
+"""
+
+SELECT_ROLLUP = "SELECT model, kind, prompt_tokens, completion_tokens, units FROM usage_rollup WHERE chat_id = ?"
+
+SELECT_LEDGER_DAY = """
+    SELECT model, kind, prompt_tokens, completion_tokens, units FROM usage_ledger WHERE chat_id = ? AND day = ?
+"""
+
+INSERT_JOB = """
+    INSERT OR IGNORE INTO jobs (update_id, chat_id, payload, stage, attempts, accepted_at, updated_at)
+    VALUES (?, ?, ?, 'accepted', 0, ?, ?)
+"""
+
+UPDATE_JOB = "UPDATE jobs SET stage = ?, checkpoint = ?, updated_at = ? WHERE update_id = ?"
+
+DELETE_JOB = "DELETE FROM jobs WHERE update_id = ?"
+
+# A single long-lived connection. Every async call is funnelled through one worker
+# thread so writes are serialized off the event loop; the lock covers sync callers.
+_connection = None
+_lock = threading.RLock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+# Hot users are served from memory; dirty records are written back in batches at most
+# FLUSH_INTERVAL seconds apart, which bounds how many seconds of updates a crash can lose.
+# FLUSH_INTERVAL = 0 turns the cache into write-through. Usage is batched the same way.
+# While a chat has a journaled job in flight its changes are held back; the job's checkpoints
+# and its end seal them into _staged, so they are written with the journal update or not at all.
+cache = UserCache()
+usage = UsageLedger()
+journal = JobJournal()
+_staged = []
+FLUSH_INTERVAL = 5.0
+FLUSH_BATCH = 200
+_flush_task = None
+_flush_lock = None
+_background_flushes = set()
+
+def get_connection() -> sqlite3.Connection:
+    global _connection
+    with _lock:
+        if _connection is None:
+            _connection = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+            for pragma in PRAGMAS:
+                _connection.execute(pragma)
+        return _connection
+
+def close_database():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
+async def run(function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, function, *args)
+
+def init_database(path=None, cache_size=None, flush_interval=None, flush_batch=None):
+    global DB_PATH, cache, FLUSH_INTERVAL, FLUSH_BATCH
+    if path:
+        close_database()
+        DB_PATH = path
+        cache = UserCache(cache.max_size)
+    if cache_size is not None:
+        cache = UserCache(cache_size)
+    if flush_interval is not None:
+        FLUSH_INTERVAL = flush_interval
+    if flush_batch is not None:
+        FLUSH_BATCH = flush_batch
+    with _lock:
+        conn = get_connection()
+        with conn:
+            # context holds the pre-migration JSON history and is left NULL afterwards
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    chat_id TEXT PRIMARY KEY,
+                    context TEXT,
+                    usage_chatgpt INTEGER,
+                    usage_whisper INTEGER,
+                    usage_dalle INTEGER,
+                    whisper_to_chat INTEGER,
+                    assistant_voice_chat INTEGER,
+                    image_resolution TEXT,
+                    temperature REAL,
+                    max_context INTEGER,
+                    gpt_model TEXT,
+                    context_start INTEGER DEFAULT 0,
+                    summary TEXT,
+                    summary_seq INTEGER DEFAULT 0,
+                    providers TEXT
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    chat_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT,
+                    token_count INTEGER,
+                    PRIMARY KEY (chat_id, seq)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS processed_updates (
+                    update_id INTEGER PRIMARY KEY,
+                    received_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS response_cache_expiry ON response_cache (expires_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS response_cache_kind ON response_cache (kind, expires_at)")
+            # Usage per chat, day, model and kind, and running totals per chat; chat_id '*' adds up everyone
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_ledger (
+                    chat_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                    completion_tokens INTEGER NOT NULL DEFAULT 0,
+                    units INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (chat_id, day, model, kind)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_rollup (
+                    chat_id TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                    completion_tokens INTEGER NOT NULL DEFAULT 0,
+                    units INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (chat_id, model, kind)
+                ) WITHOUT ROWID
+            """)
+            # Token buckets of the rate limiter, saved on shutdown when RATE_LIMIT_PERSIST is on
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    chat_id TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (chat_id, model)
+                ) WITHOUT ROWID
+            """)
+            # Accepted updates whose job has not finished, picked up again on startup
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    update_id INTEGER PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    checkpoint TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    accepted_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            # Roles set with the admin commands, on top of BOT_ALLOWED_USERS and the access file
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS access (
+                    chat_id TEXT PRIMARY KEY,
+                    role TEXT NOT NULL,
+                    updated REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            migrate_database(conn)
+    logger.info("Database initialized", extra={"path": DB_PATH})
+
+def migrate_database(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        columns = [column[1] for column in conn.execute("PRAGMA table_info(users)")]
+        if "context_start" not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN context_start INTEGER DEFAULT 0")
+        users = conn.execute("SELECT chat_id, context FROM users WHERE context IS NOT NULL").fetchall()
+        for chat_id, context in users:
+            messages = json.loads(context) if context else []
+            conn.executemany(INSERT_MESSAGE, [(chat_id, seq, message["role"], message["content"], None)
+                                              for seq, message in enumerate(messages, 1)])
+        conn.execute("UPDATE users SET context = NULL, context_start = COALESCE(context_start, 0)")
+        if users:
+            logger.info("Migrated context to the messages table", extra={"users": len(users)})
+    if version < 2:
+        columns = [column[1] for column in conn.execute("PRAGMA table_info(users)")]
+        if "summary" not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN summary TEXT")
+        if "summary_seq" not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN summary_seq INTEGER DEFAULT 0")
+    if version < 3:
+        # Seed the totals with the counters kept so far, which don't say which model was used
+        for kind in ("chatgpt", "whisper", "dalle"):
+            conn.execute(f"""
+                INSERT OR IGNORE INTO usage_rollup (chat_id, model, kind, units)
+                SELECT chat_id, '', '{kind}', usage_{kind} FROM users WHERE usage_{kind} > 0
+            """)
+            conn.execute(f"""
+                INSERT OR IGNORE INTO usage_rollup (chat_id, model, kind, units)
+                SELECT '{ALL_USERS}', '', '{kind}', SUM(usage_{kind}) FROM users HAVING SUM(usage_{kind}) > 0
+            """)
+    if version < 4:
+        columns = [column[1] for column in conn.execute("PRAGMA table_info(users)")]
+        if "providers" not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN providers TEXT")
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+async def clearUserContext(chat_id, user_data):
     if (user_data):
+        # History is append-only; clearing just moves the start of the context window
         user_data["context"] = []
-        update_user(chat_id, user_data)
+        user_data["history"]["start_seq"] = user_data["history"]["last_seq"]
+        user_data["history"]["summary"] = None
+        user_data["history"]["summary_seq"] = user_data["history"]["start_seq"]
+        await saveUserData(chat_id, user_data)
     return
 
-async def getUserData(chat_id, config):
-    user_data = get_user(chat_id)
-    if not user_data:
-        user_data = {
-            "context": [],
-            "usage": {"chatgpt": 0, "whisper": 0, "dalle": 0},
-            "options": {
-                "whisper_to_chat": config.bot_asr_to_chat,
-                "assistant_voice_chat": False,
-                "image_resolution": ImageResolution.MEDIUM.value,
-                "temperature": float(config.openai_gpt_default_temperature),
-                "max-context": config.chat_max_context,
-                "gpt_model": config.chatgpt_default_model
-            }
+def newUserData(config, chat_id=None):
+    return {
+        "chat_id": chat_id,
+        "context": [],
+        "history": {"start_seq": 0, "last_seq": 0, "summary": None, "summary_seq": 0, "pending": []},
+        "usage": {"chatgpt": 0, "whisper": 0, "dalle": 0},
+        "options": {
+            "whisper_to_chat": bool(int(config.bot_asr_to_chat or 0)),
+            "assistant_voice_chat": False,
+            "image_resolution": ImageResolution.MEDIUM.value,
+            "temperature": float(config.openai_gpt_default_temperature),
+            "max-context": int(config.chat_max_context),
+            "gpt_model": config.chatgpt_default_model,
+            "providers": {}
         }
-        add_user(chat_id, user_data)
+    }
+
+def get_or_add_user(chat_id: str, config):
+    with _lock:
         user_data = get_user(chat_id)
+        if not user_data:
+            user_data = newUserData(config, chat_id)
+            add_user(chat_id, user_data)
+        return user_data
+
+async def getUserData(chat_id, config):
+    chat_id = str(chat_id)
+    user_data = cache.get(chat_id)
+    if user_data is None:
+        with timed("db_read"):
+            user_data = cache.put(chat_id, await run(get_or_add_user, chat_id, config))
     return user_data
 
-def get_user(chat_id: str):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
-    user = c.fetchone()
-    conn.close()
-    if user:
-        return {
-            "context": json.loads(user[1]),
-            "usage": {
-                "chatgpt": user[2],
-                "whisper": user[3],
-                "dalle": user[4]
-            },
-            "options": {
-                "whisper_to_chat": bool(user[5]),
-                "assistant_voice_chat": bool(user[6]),
-                "image_resolution": str(user[7]),
-                "temperature": user[8],
-                "max-context": user[9],
-                "gpt_model": user[10] 
-            }
+def getFlushLock() -> asyncio.Lock:
+    global _flush_lock
+    if _flush_lock is None:
+        _flush_lock = asyncio.Lock()
+    return _flush_lock
+
+async def saveUserData(chat_id, user_data):
+    chat_id = str(chat_id)
+    cache.markDirty(chat_id, user_data)
+    if FLUSH_INTERVAL <= 0:
+        # Write-through; chats with a job in flight are written when it seals them
+        if chat_id not in journal.running:
+            await flushUsers(raise_errors=True)
+        return
+    if len(cache.dirty) >= FLUSH_BATCH:
+        task = asyncio.get_running_loop().create_task(flushUsers())
+        _background_flushes.add(task)
+        task.add_done_callback(_background_flushes.discard)
+
+async def flushUsers(raise_errors=False):
+    global _staged
+    async with getFlushLock():
+        batch = cache.takeDirty(journal.running)
+        if not batch and not _staged and not usage.hasPending() and not journal.hasPending():
+            return
+        # Collect rows on the loop thread so handlers can't mutate a record mid-write; sealed
+        # snapshots go first, a chat's later changes are in the batch
+        staged, _staged = _staged, []
+        sealed = {chat_id: user_data for chat_id, user_data, user_row, rows in staged}
+        user_rows = [user_row for chat_id, user_data, user_row, rows in staged]
+        message_rows = [row for chat_id, user_data, user_row, rows in staged for row in rows]
+        taken = []
+        for chat_id, user_data in batch.items():
+            user_row, rows, pending = take_rows(chat_id, user_data)
+            user_rows.append(user_row)
+            message_rows.extend(rows)
+            taken.append((user_data, pending))
+        usage_rows = usage.take()
+        job_rows = journal.take()
+        try:
+            with timed("db_write"):
+                await run(write_rows, user_rows, message_rows, usage_rows, job_rows)
+        except Exception as e:
+            logger.error("Failed to flush users", extra={"users": len(batch), "error": str(e)})
+            for user_data, pending in taken:
+                restore_pending(user_data, pending)
+            _staged[:0] = staged
+            cache.flushDone(batch, success=False)
+            usage.flushDone(success=False)
+            journal.flushDone(success=False)
+            if raise_errors:
+                raise
+            return
+        cache.flushDone({**sealed, **batch})
+        usage.flushDone()
+        journal.flushDone()
+
+async def flushLoop():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flushUsers()
+
+def startFlusher():
+    global _flush_task
+    if FLUSH_INTERVAL > 0 and _flush_task is None:
+        _flush_task = asyncio.get_running_loop().create_task(flushLoop())
+
+async def shutdown():
+    global _flush_task, _flush_lock
+    if _flush_task is not None:
+        _flush_task.cancel()
+        _flush_task = None
+    await flushUsers()
+    _flush_lock = None
+    close_database()
+
+def user_from_row(user, messages):
+    messages.reverse()
+    start_seq = user[1] or 0
+    model = user[10]
+    summary_seq = user[12] or 0
+    return {
+        "chat_id": user[0],
+        "context": [{"role": role, "content": content, "seq": seq,
+                     "tokens": token_count if token_count is not None else countTokens(content, model)}
+                    for seq, role, content, token_count in messages],
+        "history": {
+            "start_seq": start_seq,
+            "last_seq": messages[-1][0] if messages else max(start_seq, summary_seq),
+            "summary": user[11],
+            "summary_seq": summary_seq,
+            "pending": []
+        },
+        "usage": {
+            "chatgpt": user[2],
+            "whisper": user[3],
+            "dalle": user[4]
+        },
+        "options": {
+            "whisper_to_chat": bool(user[5]),
+            "assistant_voice_chat": bool(user[6]),
+            "image_resolution": str(user[7]),
+            "temperature": user[8],
+            "max-context": user[9],
+            "gpt_model": user[10],
+            "providers": json.loads(user[13]) if user[13] else {}
         }
-    return None
+    }
 
-def add_user(chat_id: str, user_data):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO users (
-            chat_id, context, usage_chatgpt, usage_whisper, usage_dalle,
-            whisper_to_chat, assistant_voice_chat, image_resolution, temperature, max_context, gpt_model
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        chat_id,
-        json.dumps(user_data["context"]),
+def user_params(user_data):
+    return (
+        user_data["history"]["start_seq"],
         user_data["usage"]["chatgpt"],
         user_data["usage"]["whisper"],
         user_data["usage"]["dalle"],
@@ -97,58 +467,234 @@ def add_user(chat_id: str, user_data):
         user_data["options"]["image_resolution"],
         user_data["options"]["temperature"],
         user_data["options"]["max-context"],
-        user_data["options"]["gpt_model"]
-    ))
-    conn.commit()
-    conn.close()
+        user_data["options"]["gpt_model"],
+        user_data["history"]["summary"],
+        user_data["history"]["summary_seq"],
+        json.dumps(user_data["options"]["providers"]) if user_data["options"]["providers"] else None
+    )
+
+def take_rows(chat_id: str, user_data):
+    # Turns appended since the last write, as (seq, role, content, token_count) tuples
+    pending = user_data["history"]["pending"]
+    user_data["history"]["pending"] = []
+    return user_params(user_data) + (chat_id,), [(chat_id,) + message for message in pending], pending
+
+def restore_pending(user_data, pending):
+    user_data["history"]["pending"][:0] = pending
+
+def write_rows(user_rows, message_rows, usage_rows=(), job_rows=((), ())):
+    with _lock:
+        conn = get_connection()
+        with conn:
+            conn.executemany(UPDATE_USER, user_rows)
+            conn.executemany(INSERT_MESSAGE, message_rows)
+            if usage_rows:
+                write_usage(conn, usage_rows)
+            stages, done = job_rows
+            conn.executemany(UPDATE_JOB, stages)
+            conn.executemany(DELETE_JOB, done)
+
+def write_usage(conn, usage_rows):
+    # Each batch is added to the per-chat rows and, summed up, to the '*' rows
+    ledger, rollup = {}, {}
+    for chat_id, day, model, kind, prompt, completion, units in usage_rows:
+        delta = (prompt, completion, units)
+        addDelta(ledger, (ALL_USERS, day, model, kind), delta)
+        addDelta(rollup, (chat_id, model, kind), delta)
+        addDelta(rollup, (ALL_USERS, model, kind), delta)
+    conn.executemany(UPSERT_LEDGER, usage_rows)
+    conn.executemany(UPSERT_LEDGER, [(*key, *entry) for key, entry in ledger.items()])
+    conn.executemany(UPSERT_ROLLUP, [(*key, *entry) for key, entry in rollup.items()])
+
+def get_usage_rows(scope: str, day: str):
+    with _lock:
+        conn = get_connection()
+        return conn.execute(SELECT_ROLLUP, (scope,)).fetchall(), conn.execute(SELECT_LEDGER_DAY, (scope, day)).fetchall()
+
+def get_usage_day(scope: str, day: str):
+    with _lock:
+        return get_connection().execute(SELECT_LEDGER_DAY, (scope, day)).fetchall()
+
+async def getUsageReport(scope=ALL_USERS):
+    # Totals and today's usage for one chat, or for everyone; the flush lock keeps what is
+    # read from disk and what is still in memory from overlapping
+    async with getFlushLock():
+        rollup_rows, today_rows = await run(get_usage_rows, str(scope), today())
+        return usage.report(str(scope), rollup_rows, today_rows)
+
+async def getDailyUsage(chat_id):
+    # {kind: units} used today; read from disk once per chat and day, then kept up to date in memory
+    chat_id = str(chat_id)
+    usage.rollover()
+    daily = usage.daily.get(chat_id)
+    if daily is None:
+        async with getFlushLock():
+            daily = usage.daily.get(chat_id)
+            if daily is None:
+                daily = usage.loadDaily(chat_id, await run(get_usage_day, chat_id, usage.day))
+    return daily
+
+def get_access():
+    with _lock:
+        return get_connection().execute("SELECT chat_id, role FROM access").fetchall()
+
+def set_access(chat_id: str, role: str):
+    with _lock:
+        conn = get_connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO access (chat_id, role, updated) VALUES (?, ?, ?)",
+                         (str(chat_id), role, time.time()))
+
+def delete_access(chat_id: str):
+    with _lock:
+        conn = get_connection()
+        with conn:
+            return conn.execute("DELETE FROM access WHERE chat_id = ?", (str(chat_id),)).rowcount > 0
+
+def load_rate_limits():
+    with _lock:
+        return get_connection().execute("SELECT chat_id, model, tokens, updated FROM rate_limits").fetchall()
+
+def save_rate_limits(rows, window: float):
+    # Workers of a sharded deployment share the table, so rows are replaced per bucket and
+    # only rows older than the longest refill window (full buckets by now) are deleted
+    with _lock:
+        conn = get_connection()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO rate_limits (chat_id, model, tokens, updated) VALUES (?, ?, ?, ?)",
+                             rows)
+            conn.execute("DELETE FROM rate_limits WHERE updated < ?", (time.time() - window,))
+
+def get_context(chat_id: str, start_seq, limit):
+    with _lock:
+        return get_connection().execute(SELECT_CONTEXT, (str(chat_id), start_seq, limit)).fetchall()
+
+def get_user(chat_id: str):
+    with _lock:
+        user = get_connection().execute(SELECT_USER, (str(chat_id),)).fetchone()
+        if user:
+            # Turns folded into the summary are not loaded again
+            return user_from_row(user, get_context(chat_id, max(user[1] or 0, user[12] or 0), user[9]))
+    return None
+
+def add_user(chat_id: str, user_data):
+    user_row, message_rows, _ = take_rows(str(chat_id), user_data)
+    with _lock:
+        conn = get_connection()
+        with conn:
+            conn.execute(INSERT_USER, user_row[-1:] + user_row[:-1])
+            conn.executemany(INSERT_MESSAGE, message_rows)
 
 def update_user(chat_id: str, user_data):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        UPDATE users
-        SET
-            context = ?,
-            usage_chatgpt = ?,
-            usage_whisper = ?,
-            usage_dalle = ?,
-            whisper_to_chat = ?,
-            assistant_voice_chat = ?,
-            image_resolution = ?,
-            temperature = ?,
-            max_context = ?,
-            gpt_model = ?
-        WHERE chat_id = ?
-    """, (
-        json.dumps(user_data["context"]),
-        user_data["usage"]["chatgpt"],
-        user_data["usage"]["whisper"],
-        user_data["usage"]["dalle"],
-        int(user_data["options"]["whisper_to_chat"]),
-        int(user_data["options"]["assistant_voice_chat"]),
-        user_data["options"]["image_resolution"],
-        user_data["options"]["temperature"],
-        user_data["options"]["max-context"],
-        user_data["options"]["gpt_model"],
-        chat_id
-    ))
-    conn.commit()
-    conn.close()
-    
+    user_row, message_rows, _ = take_rows(str(chat_id), user_data)
+    write_rows([user_row], message_rows)
+
+def claim_update(update_id: int, chat_id=None, payload=None) -> bool:
+    # True only for the first delivery of an update, across every process sharing the database;
+    # with a payload the update is journaled in the same transaction
+    with _lock:
+        conn = get_connection()
+        with conn:
+            now = time.time()
+            claimed = conn.execute("INSERT OR IGNORE INTO processed_updates (update_id, received_at) VALUES (?, ?)",
+                                   (update_id, now)).rowcount == 1
+            if claimed and payload is not None:
+                conn.execute(INSERT_JOB, (update_id, chat_id, payload, now, now))
+            if claimed and update_id % 1000 == 0:
+                conn.execute("DELETE FROM processed_updates WHERE received_at < ?", (now - UPDATE_RETENTION_SECONDS,))
+        return claimed
+
+@timed("db_claim")
+async def claimUpdate(update_id: int, chat_id=None, payload=None) -> bool:
+    return await run(claim_update, update_id, chat_id, payload)
+
+def take_unfinished_jobs(shard=0, shards=1):
+    # Jobs the previous run left behind, oldest first, for the chats this process serves. Every
+    # pick-up counts as an attempt, so an update that keeps taking the bot down is given up on.
+    with _lock:
+        conn = get_connection()
+        with conn:
+            rows = [row for row in conn.execute("SELECT update_id, chat_id, payload, stage, checkpoint, attempts "
+                                                "FROM jobs ORDER BY update_id")
+                    if row[1] % shards == shard]
+            expired = [(row[0],) for row in rows if row[5] >= JOB_MAX_ATTEMPTS]
+            conn.executemany(DELETE_JOB, expired)
+            conn.executemany("UPDATE jobs SET attempts = attempts + 1 WHERE update_id = ?",
+                             [(row[0],) for row in rows if row[5] < JOB_MAX_ATTEMPTS])
+    jobs = [(update_id, json.loads(payload), stage, json.loads(checkpoint) if checkpoint else None)
+            for update_id, chat_id, payload, stage, checkpoint, attempts in rows if attempts < JOB_MAX_ATTEMPTS]
+    return jobs, len(expired)
+
+def seal_chat(chat_id: str):
+    # Snapshot of the chat's changes so far for the next flush, whatever its job does later
+    user_data = cache.seal(chat_id)
+    if user_data is not None:
+        user_row, message_rows, _ = take_rows(chat_id, user_data)
+        _staged.append((chat_id, user_data, user_row, message_rows))
+    usage.commit(chat_id)
+
+def beginJob(chat_id, update_id: int):
+    chat_id = str(chat_id)
+    seal_chat(chat_id)
+    journal.begin(chat_id, update_id)
+    usage.hold(chat_id)
+
+async def checkpointJob(chat_id, user_data, stage: str, data):
+    # The stage is written in one transaction with everything the job did up to here
+    chat_id = str(chat_id)
+    cache.markDirty(chat_id, user_data)
+    journal.checkpoint(chat_id, stage, data)
+    seal_chat(chat_id)
+    if FLUSH_INTERVAL <= 0:
+        await flushUsers()
+
+async def finishJob(chat_id):
+    chat_id = str(chat_id)
+    update_id = journal.end(chat_id)
+    seal_chat(chat_id)
+    usage.release(chat_id)
+    if update_id is not None:
+        journal.finish(update_id)
+    if FLUSH_INTERVAL <= 0:
+        await flushUsers()
+
+def abortJob(chat_id):
+    # Drops what the job did since its last checkpoint; the update stays journaled and runs again
+    chat_id = str(chat_id)
+    journal.end(chat_id)
+    usage.release(chat_id, commit=False)
+    cache.drop(chat_id)
+
+async def settleUpdate(update_id: int):
+    journal.settle(update_id)
+    if FLUSH_INTERVAL <= 0 and journal.hasPending():
+        await flushUsers()
+
+def get_cached_response(key: str):
+    with _lock:
+        row = get_connection().execute("SELECT value, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+                                       (key, time.time())).fetchone()
+    return row
+
+def put_cached_response(key: str, kind: str, value: str, expires_at: float, max_rows: int):
+    with _lock:
+        conn = get_connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO response_cache (key, kind, value, expires_at) VALUES (?, ?, ?, ?)",
+                         (key, kind, value, expires_at))
+            # Drop expired rows, then the entries of this kind closest to expiry once over the size bound
+            conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+            conn.execute("""
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache WHERE kind = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (kind, max_rows))
+
 def get_total_usage():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        SELECT
-            SUM(usage_chatgpt) AS total_chatgpt,
-            SUM(usage_whisper) AS total_whisper,
-            SUM(usage_dalle) AS total_dalle
-        FROM users
-    """)
-    total_usage = c.fetchone()
-    conn.close()
-    return {
-        "chatgpt": total_usage[0],
-        "whisper": total_usage[1],
-        "dalle": total_usage[2]
-    }
+    # Flushed totals for all users, read from the rollup instead of summing every user
+    with _lock:
+        rows = get_connection().execute("SELECT kind, SUM(units) FROM usage_rollup WHERE chat_id = ? GROUP BY kind",
+                                        (ALL_USERS,)).fetchall()
+    totals = {"chatgpt": 0, "whisper": 0, "dalle": 0}
+    totals.update(dict(rows))
+    return totals
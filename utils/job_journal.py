@@ -0,0 +1,86 @@
+import json
+import time
+
+class JobJournal:
+    # Tracks the updates in the jobs table. An update is journaled in the transaction that
+    # claims it and stays there until its job finishes; stage changes and deletions wait here
+    # for the next flush, which writes them together with the sealed changes of the chat, so
+    # a job's progress, its context turns and its billing reach the disk at the same time.
+    def __init__(self):
+        self.pending = {}
+        self.flushing = {}
+        # Chat -> update whose job is running; one at a time, the scheduler keeps chats in order
+        self.running = {}
+        # Updates handed to the scheduler -> whether their job has finished
+        self.jobs = {}
+        # (stage, checkpoint) of the jobs picked up from the previous run
+        self.resumed = {}
+        self.finished = 0
+
+    def submit(self, update_id: int):
+        self.jobs[update_id] = False
+
+    def begin(self, chat_id: str, update_id: int):
+        self.running[chat_id] = update_id
+
+    def end(self, chat_id: str):
+        return self.running.pop(chat_id, None)
+
+    def checkpoint(self, chat_id: str, stage: str, data):
+        update_id = self.running.get(chat_id)
+        if update_id is not None:
+            self.pending[update_id] = (stage, json.dumps(data))
+
+    def restored(self, chat_id: str):
+        # (stage, checkpoint) the running job of the chat left off at, or None for a fresh job
+        update_id = self.running.get(chat_id)
+        return self.resumed.get(update_id) if update_id is not None else None
+
+    def resume(self, update_id: int, stage: str, checkpoint):
+        self.resumed[update_id] = (stage, checkpoint)
+
+    def isResumed(self, update_id: int) -> bool:
+        return update_id in self.resumed
+
+    def finish(self, update_id: int):
+        if update_id in self.jobs:
+            self.jobs[update_id] = True
+        self.resumed.pop(update_id, None)
+        self.pending[update_id] = None
+        self.finished += 1
+
+    def settle(self, update_id: int):
+        # Called once the dispatcher is through with an update. Updates that never became a job
+        # (turned away, or content nobody handles) are done now; a job that has not finished
+        # is still queued, or was left for the next start, and keeps its row
+        finished = self.jobs.pop(update_id, None)
+        if finished is None:
+            self.finish(update_id)
+        elif not finished:
+            self.jobs[update_id] = False
+
+    def hasPending(self) -> bool:
+        return bool(self.pending)
+
+    def take(self):
+        self.flushing, self.pending = self.pending, {}
+        now = time.time()
+        stages = [(entry[0], entry[1], now, update_id) for update_id, entry in self.flushing.items()
+                  if entry is not None]
+        done = [(update_id,) for update_id, entry in self.flushing.items() if entry is None]
+        return stages, done
+
+    def flushDone(self, success=True):
+        if not success:
+            # Anything recorded for the same update since the batch was taken is newer
+            for update_id, entry in self.flushing.items():
+                self.pending.setdefault(update_id, entry)
+        self.flushing = {}
+
+    def stats(self):
+        return {
+            "active": sum(not finished for finished in self.jobs.values()),
+            "running": len(self.running),
+            "resumed": len(self.resumed),
+            "finished": self.finished,
+        }
@@ -0,0 +1,201 @@
+import asyncio
+import bisect
+import functools
+import inspect
+import time
+from contextlib import aclosing
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def formatLabels(names, key, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, key)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def formatValue(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    def __init__(self, name, help, kind, labelnames=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{formatLabels(self.labelnames, key)} {formatValue(value)}")
+        return lines
+
+class Counter(Metric):
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, "counter", labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, "gauge", labelnames)
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Histogram(Metric):
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, "histogram", labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        series = self.values.get(key)
+        if series is None:
+            # Per-bucket counts (the last one is +Inf), then sum and count
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = 'le="' + formatValue(bound) + '"'
+                lines.append(f"{self.name}_bucket{formatLabels(self.labelnames, key, le)} {cumulative}")
+            labels = formatLabels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {formatValue(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def addCollector(self, collector):
+        # Called before every scrape to copy queue depths and cache counters into gauges
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("bot_stage_seconds", "Time spent in each processing stage", ("stage",))
+STAGE_ERRORS = REGISTRY.counter("bot_stage_errors_total", "Stages that ended with an exception", ("stage",))
+PROVIDER_REQUESTS = REGISTRY.counter("bot_provider_requests_total", "Upstream API attempts by outcome",
+                                     ("provider", "endpoint", "outcome"))
+TELEGRAM_REQUESTS = REGISTRY.counter("bot_telegram_requests_total", "Telegram Bot API calls by outcome",
+                                     ("method", "outcome"))
+TOKENS = REGISTRY.counter("bot_tokens_total", "Chat tokens billed", ("model",))
+JOBS = REGISTRY.counter("bot_jobs_total", "Journaled jobs by outcome", ("outcome",))
+QUEUE_DEPTH = REGISTRY.gauge("bot_queue_depth", "Work waiting or in flight", ("queue",))
+# Mirrors of the counts each cache keeps, which start over when the cache is rebuilt
+CACHE_HITS = REGISTRY.gauge("bot_cache_hits", "Cache hits since the cache was created", ("cache",))
+CACHE_LOOKUPS = REGISTRY.gauge("bot_cache_lookups", "Cache lookups since the cache was created", ("cache",))
+ACCESS_DENIED = REGISTRY.counter("bot_access_denied_total", "Messages from users that are not allowed")
+RATE_LIMITED = REGISTRY.counter("bot_rate_limited_total", "Requests turned away by rate limits or daily quotas",
+                                ("kind", "reason"))
+PROVIDER_FAILOVERS = REGISTRY.counter("bot_provider_failovers_total",
+                                      "Requests sent on to another provider after an error or as a hedge",
+                                      ("capability", "reason"))
+PROVIDER_P95 = REGISTRY.gauge("bot_provider_p95_seconds", "p95 latency of recent requests per provider",
+                              ("provider", "capability"))
+PROVIDER_ERROR_RATE = REGISTRY.gauge("bot_provider_error_rate", "Share of recent requests per provider that failed",
+                                     ("provider", "capability"))
+
+class timed:
+    # Records how long a stage took into bot_stage_seconds, and counts it in
+    # bot_stage_errors_total when it raises. Works as `with`/`async with timed("stage"):` and as
+    # a decorator on plain functions, coroutines and async generators.
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, stage=self.stage)
+        if exc_type is not None and not issubclass(exc_type, (asyncio.CancelledError, GeneratorExit)):
+            STAGE_ERRORS.inc(stage=self.stage)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+    def __call__(self, function):
+        stage = self.stage
+        if inspect.isasyncgenfunction(function):
+            @functools.wraps(function)
+            async def generatorWrapper(*args, **kwargs):
+                with timed(stage):
+                    async with aclosing(function(*args, **kwargs)) as generator:
+                        async for item in generator:
+                            yield item
+            return generatorWrapper
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def coroutineWrapper(*args, **kwargs):
+                with timed(stage):
+                    return await function(*args, **kwargs)
+            return coroutineWrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return function(*args, **kwargs)
+        return wrapper
+
+async def startServer(host: str, port: int, registry: Registry = REGISTRY) -> web.AppRunner:
+    async def metrics(request):
+        return web.Response(body=registry.render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,81 @@
+import time
+
+DAY_SECONDS = 24 * 3600
+
+def parseLimits(spec: str):
+    # "gpt-4=5/60;dall-e=3/60;*=20/60" -> {model: (requests, seconds)}; "*" covers unlisted models
+    limits = {}
+    for entry in spec.split(";"):
+        if entry:
+            model, rate = entry.split("=")
+            requests, seconds = rate.split("/")
+            limits[model] = (float(requests), float(seconds))
+    return limits
+
+class RateLimiter:
+    # Token buckets per chat and model, plus daily quotas per usage kind. A bucket is a
+    # [tokens, updated] pair that refills lazily when it is next used; buckets that have
+    # refilled completely carry no state and are pruned, so memory follows the chats that
+    # were active within the last window rather than everyone who ever wrote.
+    def __init__(self, limits=None, quotas=None):
+        self.limits = limits or {}
+        self.quotas = quotas or {}
+        self.buckets = {}
+        self.pruneAt = 4096
+        self.rejected = 0
+
+    def limitFor(self, model):
+        return self.limits.get(model) or self.limits.get("*")
+
+    def acquire(self, chat_id: str, model: str, now=None) -> float:
+        # Takes one request from the bucket; returns 0 or the seconds until one is available
+        limit = self.limitFor(model)
+        if limit is None:
+            return 0.0
+        capacity, seconds = limit
+        rate = capacity / seconds
+        now = time.time() if now is None else now
+        key = (chat_id, model)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.pruneAt:
+                self.prune(now)
+            bucket = self.buckets[key] = [capacity, now]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        self.rejected += 1
+        return (1 - bucket[0]) / rate
+
+    def quotaRetry(self, kind: str, used, now=None) -> float:
+        # Quotas are per UTC day, like the usage ledger
+        quota = self.quotas.get(kind)
+        if quota is None or used < quota:
+            return 0.0
+        now = time.time() if now is None else now
+        self.rejected += 1
+        return DAY_SECONDS - now % DAY_SECONDS
+
+    def prune(self, now):
+        for key, (tokens, updated) in list(self.buckets.items()):
+            limit = self.limitFor(key[1])
+            if limit is None or tokens + (now - updated) * limit[0] / limit[1] >= limit[0]:
+                del self.buckets[key]
+        self.pruneAt = max(4096, 2 * len(self.buckets))
+
+    def window(self) -> float:
+        # Longest time any bucket takes to refill
+        return max((seconds for _, seconds in self.limits.values()), default=0.0)
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        self.prune(now)
+        return [(chat_id, model, tokens, updated) for (chat_id, model), (tokens, updated) in self.buckets.items()]
+
+    def restore(self, rows, now=None):
+        for chat_id, model, tokens, updated in rows:
+            self.buckets[(chat_id, model)] = [tokens, updated]
+        self.prune(time.time() if now is None else now)
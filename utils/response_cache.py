@@ -0,0 +1,89 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from utils import database
+
+logger = logging.getLogger(__name__)
+
+def normalize(text) -> str:
+    return " ".join(str(text or "").split())
+
+class ResponseCache:
+    # Answers to identical deterministic requests, kept in a bounded in-memory LRU in front of
+    # the response_cache table so they survive restarts. Only requests at or below
+    # max_temperature are cached, since anything hotter is expected to vary between calls.
+    # Transcripts of audio segments are kept by the digest of the audio.
+    def __init__(self, max_entries=1000, chat_ttl=24 * 3600, image_ttl=50 * 60, max_temperature=0.0,
+                 asr_ttl=30 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = {"chat": chat_ttl, "image": image_ttl, "asr": asr_ttl}
+        self.max_temperature = max_temperature
+        self.entries = OrderedDict()
+        self.hits = {"chat": 0, "image": 0, "asr": 0}
+        self.misses = {"chat": 0, "image": 0, "asr": 0}
+
+    def deterministic(self, temperature) -> bool:
+        return float(temperature) <= self.max_temperature + 1e-9
+
+    def key(self, kind: str, *parts) -> str:
+        return hashlib.sha256(json.dumps([kind, *parts], ensure_ascii=False).encode()).hexdigest()
+
+    def chatKey(self, model: str, system_prompt: str, messages, temperature) -> str:
+        # Temperature steps of 0.1 accumulate float noise, so compare it rounded
+        return self.key("chat", model, normalize(system_prompt),
+                        [(message["role"], normalize(message["content"])) for message in messages],
+                        round(float(temperature), 2))
+
+    def imageKey(self, prompt: str, resolution: str) -> str:
+        return self.key("image", normalize(prompt), resolution)
+
+    def transcriptKey(self, digest: str) -> str:
+        return self.key("asr", digest)
+
+    async def get(self, kind: str, key: str):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] <= now:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            row = await database.run(database.get_cached_response, key)
+            if row is not None:
+                entry = row
+                self.remember(key, entry)
+        if entry is None:
+            self.misses[kind] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits[kind] += 1
+        return entry[0]
+
+    async def put(self, kind: str, key: str, value: str):
+        expires_at = time.time() + self.ttl[kind]
+        self.remember(key, (value, expires_at))
+        try:
+            await database.run(database.put_cached_response, key, kind, value, expires_at, self.max_entries)
+        except Exception as e:
+            logger.warning("Failed to persist cached response", extra={"error": str(e)})
+
+    def remember(self, key: str, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        hits = sum(self.hits.values())
+        lookups = hits + sum(self.misses.values())
+        return {
+            "entries": len(self.entries),
+            "hits": hits,
+            "lookups": lookups,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "chat_hits": self.hits["chat"],
+            "image_hits": self.hits["image"],
+            "asr_hits": self.hits["asr"],
+        }
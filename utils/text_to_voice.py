@@ -1,42 +1,234 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
 import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from gtts import gTTS
-import pyttsx3
-import os
 
-class TextToVoice:
-    def __init__(self, default_language: str):
-        self.voiceLanguage = default_language
+from integrations.providers import TtsProvider
+from utils.metrics import timed
 
-    def setLanguage(self, language_code):
-        self.voiceLanguage = language_code
+logger = logging.getLogger(__name__)
 
-    async def textToVoice(self, text: str) -> BytesIO:
-        with tempfile.NamedTemporaryFile(mode='wb', suffix='.ogg', delete=False) as ogg_file:
-            temp_filename = ogg_file.name
-        gttsSuccess = False
-        try:
-            tts = gTTS(text, lang=self.voiceLanguage)
-            tts.save(temp_filename)
-            gttsSuccess = True
-        except Exception as e:
-            print("Google TTS failed, falling back to pyttsx3: --> ", e)
-
-        # If Google TTS is disabled or failed, use pyttsx3
-        if not gttsSuccess:
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+def splitSentences(text: str, max_chars=400):
+    # Groups whole sentences into chunks of up to max_chars so long answers synthesize in parallel
+    chunks, current = [], ""
+    for sentence in SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:cut])
+            sentence = sentence[cut:].strip()
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+class SentenceChunker:
+    # Incremental splitSentences for text that arrives in pieces. The first chunk is cut at the
+    # first sentence end past first_chars so speech can start early; later ones gather sentences
+    # up to at least half of max_chars so an answer doesn't turn into dozens of voice notes.
+    def __init__(self, max_chars=400, first_chars=60):
+        self.max_chars = max_chars
+        self.min_chars = first_chars
+        self.buffer = ""
+
+    def feed(self, text: str):
+        self.buffer += text
+        chunks = []
+        while True:
+            chunk = self.cut()
+            if chunk is None:
+                return chunks
+            if chunk:
+                chunks.append(chunk)
+                self.min_chars = self.max_chars // 2
+
+    def cut(self):
+        for match in SENTENCE_END.finditer(self.buffer):
+            if match.start() >= self.min_chars:
+                chunk = self.buffer[:match.start()].strip()
+                self.buffer = self.buffer[match.end():]
+                return chunk
+            if match.start() > self.max_chars:
+                break
+        if len(self.buffer) <= self.max_chars:
+            return None
+        cut = self.buffer.rfind(" ", 0, self.max_chars)
+        cut = cut if cut > 0 else self.max_chars
+        chunk = self.buffer[:cut].strip()
+        self.buffer = self.buffer[cut:]
+        return chunk
+
+    def flush(self):
+        chunks = splitSentences(self.buffer, self.max_chars)
+        self.buffer = ""
+        return chunks
+
+class VoiceCache:
+    # Content-addressed LRU of synthesized audio, bounded by total bytes
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, engine: str, language: str, text: str) -> str:
+        return hashlib.sha256(f"{engine}\0{language}\0{text}".encode()).hexdigest()
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data: bytes):
+        if len(data) > self.max_bytes or key in self.entries:
+            return
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+class GoogleTTS(TtsProvider):
+    name = "gtts"
+
+    # The engines are imported on first use, and only the one that is enabled
+    def synthesize(self, text: str, language: str) -> bytes:
+        from gtts import gTTS
+        buffer = BytesIO()
+        gTTS(text, lang=language).write_to_fp(buffer)
+        return buffer.getvalue()
+
+class OfflineTTS(TtsProvider):
+    name = "offline"
+    # pyttsx3 drives a single native engine that isn't thread-safe
+    single_thread = True
+
+    def synthesize(self, text: str, language: str) -> bytes:
+        # pyttsx3 can only render to a file, so use a private temp file and read it back
+        import pyttsx3
+        with tempfile.TemporaryDirectory() as directory:
+            temp_filename = os.path.join(directory, "voice.mp3")
             engine = pyttsx3.init()
             engine.setProperty('rate', 160)
-            engine.save_to_file(text, temp_filename)
             for voice in engine.getProperty('voices'):
-                if VOICE_LANGUAGE in voice.languages[0].decode('utf-8') and gender == voice.gender:
+                languages = [code.decode('utf-8', 'ignore') if isinstance(code, bytes) else code
+                             for code in voice.languages]
+                if any(language in code for code in languages):
                     engine.setProperty('voice', voice.id)
+                    break
+            engine.save_to_file(text, temp_filename)
             engine.runAndWait()
             engine.stop()
-            await asyncio.sleep(1)
+            with open(temp_filename, "rb") as audio_file:
+                return audio_file.read()
+
+class TextToVoice:
+    # providers maps engine names to TtsProviders in the order they are tried; by default
+    # Google TTS with the offline engine as fallback, or only the offline engine.
+    def __init__(self, default_language: str, use_gtts=True, workers=4, cache_bytes=32 * 1024 * 1024,
+                 chunk_chars=400, providers=None):
+        self.voiceLanguage = default_language
+        if providers is None:
+            providers = {"gtts": GoogleTTS(), "offline": OfflineTTS()} if use_gtts else {"offline": OfflineTTS()}
+        self.providers = providers
+        self.chunk_chars = chunk_chars
+        self.cache = VoiceCache(cache_bytes)
+        self.inflight = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts")
+        self.singleExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts-single")
+
+    def setLanguage(self, language_code):
+        self.voiceLanguage = language_code
 
-        with open(temp_filename, "rb") as audio_file:
-            voice_data = BytesIO(audio_file.read())
+    def candidates(self, preferred=None):
+        names = list(self.providers)
+        if preferred in self.providers:
+            names.remove(preferred)
+            names.insert(0, preferred)
+        return names
 
-        os.remove(temp_filename)
+    async def textToVoice(self, text: str, preferred=None) -> BytesIO:
+        # MP3 frames concatenate cleanly, so the chunks make up one playable file
+        voice_data = BytesIO()
+        async for chunk in self.textToVoiceChunks(text, preferred):
+            voice_data.write(chunk.getvalue())
         voice_data.seek(0)
         return voice_data
+
+    async def textToVoiceChunks(self, text: str, preferred=None):
+        # Every chunk starts synthesizing at once; they are yielded in order as soon as each is ready
+        language = self.voiceLanguage
+        engines = self.candidates(preferred)
+        tasks = [asyncio.ensure_future(self.synthesizeCached(chunk, language, engines))
+                 for chunk in splitSentences(text, self.chunk_chars)]
+        try:
+            for task in tasks:
+                voice_data = BytesIO(await task)
+                voice_data.seek(0)
+                yield voice_data
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def synthesizeChunk(self, text: str, preferred=None) -> BytesIO:
+        voice_data = BytesIO(await self.synthesizeCached(text, self.voiceLanguage, self.candidates(preferred)))
+        voice_data.seek(0)
+        return voice_data
+
+    async def synthesizeCached(self, text: str, language: str, engines) -> bytes:
+        key = self.cache.key(engines[0], language, text)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        # Identical phrases requested at the same time share one synthesis
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.synthesize(text, language, engines))
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        engine, data = await asyncio.shield(future)
+        # Audio from a fallback engine is kept under that engine's key, so the preferred engine
+        # is asked again for this text once it has recovered
+        self.cache.put(self.cache.key(engine, language, text), data)
+        return data
+
+    @timed("tts")
+    async def synthesize(self, text: str, language: str, engines):
+        # (engine that produced the audio, audio)
+        loop = asyncio.get_running_loop()
+        for index, name in enumerate(engines):
+            provider = self.providers[name]
+            executor = self.singleExecutor if provider.single_thread else self.executor
+            try:
+                return name, await loop.run_in_executor(executor, provider.synthesize, text, language)
+            except Exception as e:
+                if index == len(engines) - 1:
+                    raise
+                logger.warning("TTS engine failed, falling back", extra={"engine": name, "fallback": engines[index + 1],
+                                                                         "error": str(e)})
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.singleExecutor.shutdown(wait=False, cancel_futures=True)
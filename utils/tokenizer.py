@@ -0,0 +1,65 @@
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Context window sizes; override or extend with CHATGPT_CONTEXT_TOKENS
+MODEL_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+DEFAULT_CONTEXT_TOKENS = 4096
+
+# Every chat message costs a few tokens of framing on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+@lru_cache(maxsize=None)
+def getEncoding(model: str):
+    # tiktoken is imported with the first count rather than at startup
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Models tiktoken doesn't know, such as those of other providers, share the common encoding
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # The BPE files are downloaded on first use; estimate if that isn't possible
+        logger.warning("Tokenizer unavailable, estimating token counts", extra={"model": model, "error": str(e)})
+        return None
+
+@lru_cache(maxsize=4096)
+def countTokens(text: str, model: str) -> int:
+    if not text:
+        return MESSAGE_OVERHEAD_TOKENS
+    encoding = getEncoding(model)
+    if encoding is None:
+        return MESSAGE_OVERHEAD_TOKENS + len(text) // 4 + 1
+    return MESSAGE_OVERHEAD_TOKENS + len(encoding.encode(text, disallowed_special=()))
+
+def truncateTokens(text: str, model: str, limit: int) -> str:
+    # Longest start of text that countTokens puts at no more than limit
+    limit -= MESSAGE_OVERHEAD_TOKENS
+    if limit <= 0:
+        return ""
+    encoding = getEncoding(model)
+    if encoding is None:
+        return text[:(limit - 1) * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= limit else encoding.decode(tokens[:limit])
+
+def contextTokens(model: str, overrides=None) -> int:
+    if overrides and model in overrides:
+        return overrides[model]
+    if model in MODEL_CONTEXT_TOKENS:
+        return MODEL_CONTEXT_TOKENS[model]
+    # Dated snapshots like gpt-4-0613 share the window of their base model
+    for name in sorted(MODEL_CONTEXT_TOKENS, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_CONTEXT_TOKENS[name]
+    return DEFAULT_CONTEXT_TOKENS
@@ -0,0 +1,123 @@
+import time
+
+# Scope of the rollup rows that add up every user
+ALL_USERS = "*"
+
+def today() -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+def addDelta(entries, key, delta):
+    entry = entries.get(key)
+    if entry is None:
+        entries[key] = list(delta)
+    else:
+        for i, value in enumerate(delta):
+            entry[i] += value
+
+class UsageLedger:
+    # Accumulates usage per chat, day, model and kind in memory. Each flush writes the batch to
+    # the usage_ledger table and adds it to the usage_rollup totals (per chat and for all users)
+    # in one transaction, so a report is a primary-key lookup plus whatever is still unflushed.
+    def __init__(self):
+        self.pending = {}
+        self.flushing = {}
+        # Usage of chats with a job in flight, kept out of flushes until the job seals it
+        self.held = {}
+        self.records = 0
+        # Units used today per kind, for the chats that have been asked about (quota checks)
+        self.day = today()
+        self.daily = {}
+
+    def record(self, chat_id, model, kind, prompt_tokens=0, completion_tokens=0, units=0):
+        chat_id = str(chat_id)
+        self.rollover()
+        entries = self.held[chat_id] if chat_id in self.held else self.pending.setdefault(chat_id, {})
+        addDelta(entries, (self.day, model or "", kind), (prompt_tokens, completion_tokens, units))
+        daily = self.daily.get(chat_id)
+        if daily is not None:
+            daily[kind] = daily.get(kind, 0) + units
+        self.records += 1
+
+    def rollover(self):
+        day = today()
+        if day != self.day:
+            self.day = day
+            self.daily = {}
+
+    def loadDaily(self, chat_id: str, today_rows):
+        # today_rows come from the usage_ledger table and must be read while nothing is being flushed
+        units = {}
+        for model, kind, prompt, completion, amount in today_rows:
+            units[kind] = units.get(kind, 0) + amount
+        for (day, model, kind), delta in self.unflushed(chat_id):
+            if day == self.day:
+                units[kind] = units.get(kind, 0) + delta[2]
+        self.daily[chat_id] = units
+        return units
+
+    def hold(self, chat_id: str):
+        self.held.setdefault(str(chat_id), {})
+
+    def commit(self, chat_id: str):
+        # Hands what the chat's job used so far to the next flush
+        entries = self.held.get(str(chat_id))
+        if entries:
+            merged = self.pending.setdefault(str(chat_id), {})
+            for key, delta in entries.items():
+                addDelta(merged, key, delta)
+            entries.clear()
+
+    def release(self, chat_id: str, commit=True):
+        # commit=False drops the usage of a job that was cut short and will run again
+        if commit:
+            self.commit(chat_id)
+        self.held.pop(str(chat_id), None)
+
+    def hasPending(self) -> bool:
+        return bool(self.pending)
+
+    def take(self):
+        self.flushing, self.pending = self.pending, {}
+        return [(chat_id, day, model, kind, prompt, completion, units)
+                for chat_id, entries in self.flushing.items()
+                for (day, model, kind), (prompt, completion, units) in entries.items()]
+
+    def flushDone(self, success=True):
+        if not success:
+            # Merge the batch back so the next flush retries it
+            for chat_id, entries in self.flushing.items():
+                merged = self.pending.setdefault(chat_id, {})
+                for key, delta in entries.items():
+                    addDelta(merged, key, delta)
+        self.flushing = {}
+
+    def unflushed(self, scope: str):
+        # Entries not on disk yet, for one chat or for everyone
+        for source in (self.pending, self.flushing, self.held):
+            chats = source.values() if scope == ALL_USERS else [source.get(scope, {})]
+            for entries in chats:
+                yield from entries.items()
+
+    def report(self, scope: str, rollup_rows, today_rows):
+        # ({kind: units}, {model: [prompt, completion]}) for all time and for today
+        day = today()
+        total, current = {}, {}
+        for model, kind, prompt, completion, units in rollup_rows:
+            addDelta(total, (model, kind), (prompt, completion, units))
+        for model, kind, prompt, completion, units in today_rows:
+            addDelta(current, (model, kind), (prompt, completion, units))
+        for (entryDay, model, kind), delta in self.unflushed(scope):
+            addDelta(total, (model, kind), delta)
+            if entryDay == day:
+                addDelta(current, (model, kind), delta)
+        return self.split(total), self.split(current)
+
+    def split(self, entries):
+        units, tokens = {}, {}
+        for (model, kind), (prompt, completion, amount) in entries.items():
+            units[kind] = units.get(kind, 0) + amount
+            if prompt or completion:
+                modelTokens = tokens.setdefault(model, [0, 0])
+                modelTokens[0] += prompt
+                modelTokens[1] += completion
+        return units, tokens
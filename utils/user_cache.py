@@ -0,0 +1,95 @@
+from collections import OrderedDict
+
+# LRU cache of user records keyed by chat_id, with dirty tracking for write-behind.
+# Dirty records are never dropped by eviction: they stay reachable until the next
+# flush has written them, so a reload can't read a stale row from disk.
+class UserCache:
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.users = OrderedDict()
+        self.dirty = {}
+        self.flushing = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def get(self, chat_id: str):
+        user_data = self.users.get(chat_id)
+        if user_data is None:
+            user_data = self.dirty.get(chat_id) or self.flushing.get(chat_id)
+            if user_data is None:
+                self.misses += 1
+                return None
+            self.put(chat_id, user_data)
+        else:
+            self.users.move_to_end(chat_id)
+        self.hits += 1
+        return user_data
+
+    def put(self, chat_id: str, user_data):
+        # Another coroutine may have loaded the same user meanwhile; keep the first copy
+        current = self.users.get(chat_id)
+        if current is not None:
+            self.users.move_to_end(chat_id)
+            return current
+        self.users[chat_id] = user_data
+        while len(self.users) > self.max_size:
+            self.users.popitem(last=False)
+            self.evictions += 1
+        return user_data
+
+    def markDirty(self, chat_id: str, user_data):
+        self.put(chat_id, user_data)
+        self.dirty[chat_id] = user_data
+
+    def takeDirty(self, held=()):
+        # Chats in held have a job in flight and stay dirty until it is sealed
+        if held:
+            batch = {chat_id: user_data for chat_id, user_data in self.dirty.items() if chat_id not in held}
+            self.dirty = {chat_id: user_data for chat_id, user_data in self.dirty.items() if chat_id in held}
+        else:
+            batch, self.dirty = self.dirty, {}
+        self.flushing.update(batch)
+        return batch
+
+    def seal(self, chat_id: str):
+        # Moves a dirty record to flushing, where it stays reachable until its snapshot is written
+        user_data = self.dirty.pop(chat_id, None)
+        if user_data is not None:
+            self.flushing[chat_id] = user_data
+        return user_data
+
+    def drop(self, chat_id: str):
+        # Forgets in-memory changes so the next read comes from disk
+        self.dirty.pop(chat_id, None)
+        self.flushing.pop(chat_id, None)
+        self.users.pop(chat_id, None)
+
+    def flushDone(self, batch, success=True):
+        for chat_id, user_data in batch.items():
+            if self.flushing.get(chat_id) is user_data:
+                del self.flushing[chat_id]
+            if not success:
+                self.dirty.setdefault(chat_id, user_data)
+        if success:
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+
+    def clear(self):
+        self.users.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.users),
+            "dirty": len(self.dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+        }
@@ -1,7 +1,7 @@
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
 from utils.config import Config
 
-def generateInlineKeyboard(chat_id) -> InlineKeyboardMarkup:
+def generateInlineKeyboard() -> InlineKeyboardMarkup:
     keyboard = [
             [
                 InlineKeyboardButton("OPENAI-GPT: Increase Temperature", callback_data=f"/setting_inc_temp"),
@@ -37,15 +37,66 @@ def getSettingsReport(options):
     fullReport = header + gptModel + imageResolution + gptTemperature + whisperStatus + assistantVoice + contextLength
     return fullReport
 
-def getUsageReport(user_data):
+def getUsageReport(user_data, cache_stats=None, ledger=None):
     user_usage = user_data["usage"]
     chatUsage = f"""- Used ~{user_usage["chatgpt"]} tokens with ChatGPT.\n"""
     imageUsage = f"""- Generated {user_usage["dalle"]} images with DALL-E.\n"""
     whisperUsage = f"""- Transcribed {round(float(user_usage["whisper"]) / 60.0, 2)}min with Whisper."""
     info_message = chatUsage + imageUsage + whisperUsage
+    if ledger:
+        info_message += getLedgerReport(ledger)
+    if cache_stats:
+        info_message += (f"""\n- Response cache: {cache_stats["hit_rate"]:.0%} hit rate """
+                         f"""({cache_stats["hits"]} of {cache_stats["lookups"]} requests, not billed).""")
     return info_message
 
-def getHelpReport():
+def formatWait(seconds) -> str:
+    seconds = int(seconds + 0.999)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}min {seconds % 60}s"
+    return f"{seconds // 3600}h {seconds // 60 % 60}min"
+
+def getRateLimitReport(kind, retry_after, quota=False):
+    what = {"chatgpt": "messages", "dalle": "images", "whisper": "transcriptions"}.get(kind, "requests")
+    if quota:
+        return f"You have used up today's quota for {what}. It resets in {formatWait(retry_after)}."
+    return f"You are sending {what} too quickly. Please try again in {formatWait(retry_after)}."
+
+def getLedgerReport(ledger):
+    (_, modelTokens), (todayUsage, _) = ledger
+    info_message = ""
+    for model, (prompt, completion) in sorted(modelTokens.items()):
+        info_message += f"""\n- {model}: {prompt} prompt + {completion} completion tokens."""
+    info_message += (f"""\n- Today: ~{todayUsage.get("chatgpt", 0)} tokens, {todayUsage.get("dalle", 0)} images, """
+                     f"""{round(float(todayUsage.get("whisper", 0)) / 60.0, 2)}min transcribed.""")
+    return info_message
+
+def getTotalUsageReport(ledger):
+    totalUsage = ledger[0][0]
+    info_message = (f"""All users:\n- Used ~{totalUsage.get("chatgpt", 0)} tokens with ChatGPT.\n"""
+                    f"""- Generated {totalUsage.get("dalle", 0)} images with DALL-E.\n"""
+                    f"""- Transcribed {round(float(totalUsage.get("whisper", 0)) / 60.0, 2)}min with Whisper.""")
+    return info_message + getLedgerReport(ledger)
+
+def getAccessReport(access):
+    admins = ", ".join(str(chat_id) for chat_id in sorted(access.admins)) or "none"
+    banned = ", ".join(str(chat_id) for chat_id in sorted(access.banned)) or "none"
+    users = "everyone" if access.open else str(len(access.allowed - access.admins))
+    return f"Admins: {admins}\nUsers: {users}\nBanned: {banned}"
+
+def getProviderReport(choices, available, latencies):
+    # available maps each capability to its provider names, default first; latencies has p95 per (name, capability)
+    info_message = "Providers:\n"
+    for capability, names in available.items():
+        current = choices.get(capability) or f"{names[0]} (default)"
+        details = [f"{name} p95 {latencies[(name, capability)]:.2f}s" if latencies.get((name, capability)) else name
+                   for name in names]
+        info_message += f"\n- {capability}: {current} [{', '.join(details)}]"
+    return info_message
+
+def getHelpReport(admin=False):
     header          = "Commands: \n\n"
     clearContext    = "/clear: Clear the context.\n"
     dalle           = "/imagine 'prompt': Generate image with Dall-E.\n"
@@ -53,5 +104,13 @@ def getHelpReport():
     config          = "/config: View current configuration.\n"
     switch          = "/switch: Switch between language models.\n"
     usage           = "/usage: See usage statistics.\n"
-    help_message = header + clearContext + dalle + settings + config + switch + usage
+    provider        = "/provider [chat|image|asr|tts] [name|default]: Choose the backend for each task.\n"
+    help_message = header + clearContext + dalle + settings + config + switch + usage + provider
+    if admin:
+        help_message += ("\nAdmin commands: \n\n"
+                         "/usage all: See usage statistics of all users.\n"
+                         "/users: List admins and banned users.\n"
+                         "/adduser chat_id [admin|user]: Give a chat access.\n"
+                         "/ban chat_id: Block a chat.\n"
+                         "/removeuser chat_id: Drop a chat's entry, back to BOT_ALLOWED_USERS and the access file.\n")
     return help_message